@@ -3,24 +3,39 @@ import dash_core_components as dcc
 import dash_html_components as html
 import dash_daq as daq
 import plotly.express as px
-import pandas as pd
 from dash.dependencies import Input, Output, State
-import joblib
-import math
-from currency_converter import CurrencyConverter
-from datetime import date
+from dash.exceptions import PreventUpdate
+import os
+from pricing.admin import create_admin
+from pricing.aggregates import AggregateStore
+from pricing.api import create_api
+from pricing.batching import MicroBatcher
+from pricing.cache import PredictionCache
+from pricing.comparables import describe_comparables, listing_url
+from pricing.features import BINARY_FEATURES, LISTING_INPUTS, validate_listings
+from pricing.features import yearly_earnings as calc_yearly_earnings
+from pricing.figures import FigureCache, aggregate_figure, subset_points
+from pricing.metrics import METRICS, PREDICT_STAGE_SECONDS, create_metrics, timed
+from pricing.profiling import Profiler
+from pricing.registry import CityRegistry
+from pricing.sensitivity import MAX_SWEEP_INPUTS, SWEEP_LABELS, sensitivity
+from pricing.spatial import viewport_bounds
 
 #external_stylesheets = ['https://codepen.io/rurbinasal/pen/QWNdogQ']
 
-app = dash.Dash(__name__)#, external_stylesheets=external_stylesheets)
+app = dash.Dash(__name__, compress=True)#, external_stylesheets=external_stylesheets)
 #app.css.append_css({
 #    "external_url": "https://codepen.io/rurbinasal/pen/QWNdogQ.css"
 #})
 app.config.suppress_callback_exceptions = True
 server = app.server
+# Callback responses are compressed by Flask-Compress (gzip by default, "br" needs the brotli package)
+server.config.update(
+    COMPRESS_ALGORITHM=os.environ.get('COMPRESS_ALGORITHM', 'gzip'),
+    COMPRESS_LEVEL=int(os.environ.get('COMPRESS_LEVEL', 6)),
+    COMPRESS_MIN_SIZE=500)
 
 # Import and definition of variables
-curr = CurrencyConverter()
 data_options = {
     'amsterdam': ['2020-03-14'], #, '2020-07-09'
     'barcelona': ['2020-03-16'],
@@ -36,53 +51,55 @@ px.defaults.color_discrete_sequence = ["#767676", "#00A699", "#FF5A5F", "#F9C70C
 px.defaults.width = 900
 px.defaults.height = 600
 
-# Import data for Berlin 2020-03-17
-dataset_loc = 'berlin'
-dataset_date = '2020-03-17'
-data = joblib.load(f"data/{dataset_loc}_{dataset_date}/APP_data_engineered.pkl")
-model = joblib.load(f"data/{dataset_loc}_{dataset_date}/APP_best_model.pkl")
-preprocessor = joblib.load(f"data/{dataset_loc}_{dataset_date}/APP_preprocessor.pkl")
-X_test = joblib.load(f"data/{dataset_loc}_{dataset_date}/APP_X_test.pkl")
-MAPE_median = joblib.load(f"data/{dataset_loc}_{dataset_date}/APP_MAPE_median.pkl")
-zipcodes = joblib.load(f"data/{dataset_loc}_{dataset_date}/APP_zipcode.pkl")
-
-# Import data for Amsterdam 2020-03-14
-dataset_loc2 = 'amsterdam'
-dataset_date2 = '2020-03-14'
-data2 = joblib.load(f"data/{dataset_loc2}_{dataset_date2}/APP_data_engineered.pkl")
-model2 = joblib.load(f"data/{dataset_loc2}_{dataset_date2}/APP_best_model.pkl")
-preprocessor2 = joblib.load(f"data/{dataset_loc2}_{dataset_date2}/APP_preprocessor.pkl")
-X_test2 = joblib.load(f"data/{dataset_loc2}_{dataset_date2}/APP_X_test.pkl")
-MAPE_median2 = joblib.load(f"data/{dataset_loc2}_{dataset_date2}/APP_MAPE_median.pkl")
-zipcodes2 = joblib.load(f"data/{dataset_loc2}_{dataset_date2}/APP_zipcode.pkl")
-
-# Import data for Paris 2020-03-16
-dataset_loc3 = 'paris'
-dataset_date3 = '2020-03-16'
-data3 = joblib.load(f"data/{dataset_loc3}_{dataset_date3}/APP_data_engineered.pkl")
-model3 = joblib.load(f"data/{dataset_loc3}_{dataset_date3}/APP_best_model.pkl")
-preprocessor3 = joblib.load(f"data/{dataset_loc3}_{dataset_date3}/APP_preprocessor.pkl")
-X_test3 = joblib.load(f"data/{dataset_loc3}_{dataset_date3}/APP_X_test.pkl")
-MAPE_median3 = joblib.load(f"data/{dataset_loc3}_{dataset_date3}/APP_MAPE_median.pkl")
-zipcodes3 = joblib.load(f"data/{dataset_loc3}_{dataset_date3}/APP_zipcode.pkl")
-
-# Import data for Barcelona 2020-03-16
-dataset_loc4 = 'barcelona'
-dataset_date4 = '2020-03-16'
-data4 = joblib.load(f"data/{dataset_loc4}_{dataset_date4}/APP_data_engineered.pkl")
-model4 = joblib.load(f"data/{dataset_loc4}_{dataset_date4}/APP_best_model.pkl")
-preprocessor4 = joblib.load(f"data/{dataset_loc4}_{dataset_date4}/APP_preprocessor.pkl")
-X_test4 = joblib.load(f"data/{dataset_loc4}_{dataset_date4}/APP_X_test.pkl")
-MAPE_median4 = joblib.load(f"data/{dataset_loc4}_{dataset_date4}/APP_MAPE_median.pkl")
-zipcodes4 = joblib.load(f"data/{dataset_loc4}_{dataset_date4}/APP_zipcode.pkl")
-
-zipcode_options = {
-    'berlin': zipcodes,
-    'amsterdam': zipcodes2,
-    'paris': zipcodes3,
-    'barcelona': zipcodes4
+# Number of most similar listings shown with a pricing indication (0 hides them and skips
+# indexing the listings when a city is loaded; the API's ?comparables is then disabled too)
+comparable_listings = int(os.environ.get('COMPARABLE_LISTINGS', 5))
+
+# City datasets/models are loaded lazily on first use (see pricing/registry.py); at most
+# CITY_CACHE_SIZE city bundles are kept in memory per worker. Models of the cities listed in
+# NUMPY_TREE_CITIES (comma-separated or "all") are evaluated in numpy instead of through xgboost
+registry = CityRegistry(data_options, max_resident=int(os.environ.get('CITY_CACHE_SIZE', 2)),
+                        numpy_tree_cities=[city for city in os.environ.get('NUMPY_TREE_CITIES', '').split(',') if city],
+                        comparables=comparable_listings > 0)
+
+# Prices per input configuration are cached on disk and shared by all workers on this host
+prediction_cache = PredictionCache(
+    path=os.environ.get('PREDICTION_CACHE_PATH'),
+    max_entries=int(os.environ.get('PREDICTION_CACHE_SIZE', 100000)),
+    ttl=float(os.environ.get('PREDICTION_CACHE_TTL', 24 * 3600)))
+
+# Concurrent predictions for the same city are batched into one model call: the first request
+# waits up to PREDICT_BATCH_WINDOW_MS for others (0 disables batching), at most
+# PREDICT_BATCH_SIZE listings per batch. Only useful with threaded workers (gunicorn --threads).
+# A request waits at most PREDICT_BATCH_TIMEOUT_MS for its batch before predicting on its own
+batcher = MicroBatcher(max_batch=int(os.environ.get('PREDICT_BATCH_SIZE', 64)),
+                       window=float(os.environ.get('PREDICT_BATCH_WINDOW_MS', 0)) / 1000,
+                       timeout=float(os.environ.get('PREDICT_BATCH_TIMEOUT_MS', 2000)) / 1000)
+
+# Initial zoom level of the map per city
+map_zoom = {
+    'amsterdam': 10,
+    'barcelona': 11,
+    'berlin': 9,
+    'paris': 11
 }
 
+# JSON batch pricing API (POST /api/v1/price)
+server.register_blueprint(create_api(registry, batcher))
+
+# New bundle versions and snapshot dates in data/ are swapped in without a restart: every worker
+# checks for changed files every BUNDLE_WATCH_INTERVAL seconds (0 disables it) and, with
+# ADMIN_TOKEN set, POST /admin/reload triggers the check right away (see pricing/admin.py)
+registry.watch(float(os.environ.get('BUNDLE_WATCH_INTERVAL', 30)))
+
+# cProfile captures of a PROFILE_RATE fraction (default: 0) of the predict, generate_map and set_date_options
+# callbacks, of requests with an X-Profile header (and the admin token) or while enabled through POST /admin/profile;
+# the latest PROFILE_RETENTION captures per callback and city are kept in PROFILE_DIR (see pricing/profiling.py)
+profiler = Profiler(directory=os.environ.get('PROFILE_DIR'), rate=float(os.environ.get('PROFILE_RATE', 0)),
+                    retention=int(os.environ.get('PROFILE_RETENTION', 50)), token=os.environ.get('ADMIN_TOKEN'))
+if os.environ.get('ADMIN_TOKEN'):
+    server.register_blueprint(create_admin(registry, os.environ['ADMIN_TOKEN'], profiler))
+
 app.layout = html.Div([
     html.Div(className='background', children=[
         html.Img(className='background-img', id='background_img', src=app.get_asset_url('amsterdam_background.png')
@@ -152,6 +169,11 @@ app.layout = html.Div([
                                 options=[{'label': city.capitalize(), 'value': city} for city in data_options.keys()],
                                 value='amsterdam'
                             ),
+                            dcc.Markdown('#### Snapshot date:'),
+                            dcc.Dropdown(
+                                id='dataset_date',
+                                clearable=False
+                            ),
                         ]),
 
                         dcc.Markdown('### Use the controls below to enter the specifics of your listing:'),
@@ -437,11 +459,24 @@ app.layout = html.Div([
                             ),
                         ]),
 
+                    # What-if analysis:
+                        html.Div([
+                            dcc.Markdown('### What if? Vary up to two inputs over their range:'),
+                            dcc.Dropdown(
+                                id='sweep_inputs',
+                                options=[{'label': label, 'value': col} for col, label in SWEEP_LABELS.items()],
+                                value=[],
+                                multi=True
+                            ),
+                            dcc.Graph(id='sensitivity', style={'display': 'none'}),
+                        ]),
+
                         html.Div(className = 'os-footer', children=[
                             dcc.Markdown('### PRICING INDICATION:'),
                             html.Div(id='listing_price'),
                             html.Div(id='price_range'),
-                            html.Div(id='yearly_earnings')]),
+                            html.Div(id='yearly_earnings'),
+                            html.Div(id='comparables')]),
                     ])
                 ]),
                 dcc.Tab(id='tab-map', label='Map of all Listings', className = 'os-tab', children=[
@@ -450,6 +485,29 @@ app.layout = html.Div([
                             html.Div(id='total_listings')
                         ]),
 
+                        html.Div([
+                            dcc.Markdown('#### Snapshot date:'),
+                            dcc.Dropdown(
+                                id='map_date',
+                                clearable=False
+                            ),
+                        ]),
+
+                        html.Div([
+                            dcc.Markdown('#### Show:'),
+                            dcc.Dropdown(
+                                id='map_mode',
+                                options=[
+                                    {'label': "Listings", 'value': "listings"},
+                                    {'label': "Density (listings when zoomed in)", 'value': "density"},
+                                    {'label': "Zipcodes", 'value': "zipcode"},
+                                    {'label': "Neighbourhoods", 'value': "neighbourhood_cleansed"}
+                                ],
+                                value="listings",
+                                clearable=False
+                            ),
+                        ]),
+
                         html.Div([
                             dcc.Graph(className='graph', id='map_fig')
                         ]),
@@ -473,13 +531,38 @@ app.layout = html.Div([
 ])
 
 
+def city_bundle(city, dataset_date):
+    # The date of the previous city can still be selected while the new city's dates are set
+    if dataset_date not in registry.data_options[city]:
+        dataset_date = None
+    return registry.get(city, dataset_date)
+
+
+@app.callback(
+    [Output('dataset_date', 'options'),
+     Output('dataset_date', 'value'),
+     Output('map_date', 'options'),
+     Output('map_date', 'value')],
+    [Input('city', 'value')])
+@timed('set_dataset_dates')
+def set_dataset_dates(selected_city):
+    # Bundles of other dates are only loaded once selected
+    options = [{'label': dataset_date, 'value': dataset_date} for dataset_date in registry.data_options[selected_city]]
+    default_date = registry.default_date(selected_city)
+    return options, default_date, options, default_date
+
+
 @app.callback(
     [Output('zipcode', 'options'),
      Output('background_img', 'src'),
      Output('zipcode', 'value')],
-    [Input('city', 'value')])
-def set_date_options(selected_city):
-    return [{'label': zipcode[4:], 'value': zipcode} for zipcode in zipcode_options[selected_city]],\
+    [Input('city', 'value'),
+     Input('dataset_date', 'value')])
+@timed('set_date_options')
+@profiler.profiled('set_date_options', city_arg='selected_city')
+def set_date_options(selected_city, dataset_date):
+    zipcodes = city_bundle(selected_city, dataset_date).zipcodes
+    return [{'label': zipcode[4:], 'value': zipcode} for zipcode in zipcodes],\
            app.get_asset_url(f'{selected_city.lower()}_background.png'),\
            'zip_other'
 
@@ -488,7 +571,8 @@ def set_date_options(selected_city):
 #    Output('prediction-content', 'children'),
     [Output('listing_price', 'children'),
     Output('price_range', 'children'),
-    Output('yearly_earnings', 'children')],
+    Output('yearly_earnings', 'children'),
+    Output('comparables', 'children')],
     [Input('accommodates', 'value'),
      Input('am_balcony', 'on'),
      Input('am_breakfast', 'on'),
@@ -514,107 +598,122 @@ def set_date_options(selected_city):
      Input('wk_mth_discount', 'value'),
      Input('zipcode', 'value'),
      Input('occupancy_rate', 'value'),
-     Input('city', 'value')])
+     Input('city', 'value'),
+     Input('dataset_date', 'value')])
 
+@timed('predict')
+@profiler.profiled('predict')
 def predict(accommodates, am_balcony, am_breakfast, am_child_friendly, am_elevator, am_essentials, am_pets_allowed,
             am_private_entrance, am_smoking_allowed, am_tv, bathrooms_log, bedrooms, beds, calc_host_lst_count_sqrt_log,
             cancellation_policy, guests_included_calc, host_is_superhost, instant_bookable, maximum_nights,
-            minimum_nights_sqrt, property_type, room_type, wk_mth_discount, zipcode, occupancy_rate, city):
+            minimum_nights_sqrt, property_type, room_type, wk_mth_discount, zipcode, occupancy_rate, city,
+            dataset_date):
+
+    bundle = city_bundle(city, dataset_date)
+    # occupancy_rate only affects the earnings, not the model, so it is not part of the cache key
+    model_inputs = (accommodates, am_balcony, am_breakfast, am_child_friendly, am_elevator, am_essentials,
+                    am_pets_allowed, am_private_entrance, am_smoking_allowed, am_tv, bathrooms_log, bedrooms, beds,
+                    calc_host_lst_count_sqrt_log, cancellation_policy, guests_included_calc, host_is_superhost,
+                    instant_bookable, maximum_nights, minimum_nights_sqrt, property_type, room_type, wk_mth_discount,
+                    zipcode)
+    with PREDICT_STAGE_SECONDS.time('cache'):
+        cached = prediction_cache.get(city, bundle.pricing_version, model_inputs)
+    if cached is not None:
+        price, price_low, price_high = cached
+    else:
+        with PREDICT_STAGE_SECONDS.time('features'):
+            listing = {col: [value] for col, value in zip(LISTING_INPUTS, model_inputs + (occupancy_rate,))}
+            error = validate_listings(listing, bundle.encoder.categories)[0]
+        if error:
+            return f'Please check your input: {error}', '', '', ''
+        # The transform and model stages are timed by the bundle
+        y_pred = batcher.predict(bundle, listing)
+        with PREDICT_STAGE_SECONDS.time('convert'):
+            (price,), (price_low,), (price_high,) = bundle.price_indication(listing, y_pred)
+        prediction_cache.put(city, bundle.pricing_version, model_inputs, [price, price_low, price_high])
+
+    listing_price = f'Recommended listing price: €{price}'
+    price_range = f'Sensible range: €{price_low}-€{price_high}'
+    if bundle.segments is not None:
+        # Precomputed per segment, so this is an array lookup also when the price comes from the cache
+        (market,) = bundle.segments.context({'zipcode': [zipcode], 'room_type': [room_type],
+                                             'property_type': [property_type]})
+        price_range = [price_range, html.Br(),
+                       f"Similar listings ({market['segment']}): median €{market['median_price']} at "
+                       f"{int(market['median_occupancy_rate'] * 100)}% occupancy, {market['listings']} listings"]
+    yearly_earnings = f'Potential yearly earnings: €{calc_yearly_earnings(price, occupancy_rate)} (at occupancy of {int(occupancy_rate * 100)}%, not considering fees and taxes)'
+
+    comparables = ''
+    if comparable_listings:
+        listing = {col: [value] for col, value in zip(LISTING_INPUTS, model_inputs + (occupancy_rate,))}
+        with PREDICT_STAGE_SECONDS.time('comparables'):
+            (rows,), (distances,) = bundle.comparables.query(listing, k=comparable_listings)
+        comparables = dcc.Markdown('#### Most similar listings:\n' + '\n'.join(
+            f"- [Listing {el['listing_no']}]({el['url']}): €{el['price']}, {el['accommodates']} guests, "
+            f"{el['bedrooms']:g} bedrooms" for el in describe_comparables(bundle.data, rows, distances)))
+
+    return listing_price, price_range, yearly_earnings, comparables
 
-    df = pd.DataFrame(
-        columns=X_test.columns,
-        data=[[accommodates, am_balcony, am_breakfast, am_child_friendly, am_elevator, am_essentials, am_pets_allowed,
-            am_private_entrance, am_smoking_allowed, am_tv, bathrooms_log, bedrooms, calc_host_lst_count_sqrt_log,
-            cancellation_policy, guests_included_calc, host_is_superhost, instant_bookable, maximum_nights,
-            minimum_nights_sqrt, property_type, room_type, wk_mth_discount, zipcode]]
-    )
-    df.accommodates_per_bed = accommodates/beds
-    df.bathrooms_log = math.log(int(bathrooms_log))
-    df.calc_host_lst_count_sqrt_log = math.log(math.sqrt(calc_host_lst_count_sqrt_log+1))
-    df.minimum_nights_sqrt = math.sqrt(minimum_nights_sqrt)
-    for col in ["am_balcony", "am_breakfast", "am_child_friendly", "am_elevator", "am_essentials",
-                "am_pets_allowed", "am_private_entrance", "am_smoking_allowed", "am_tv",
-                "host_is_superhost", "instant_bookable"]:
-        df[col].replace([True, False], [1, 0], inplace=True)
-#        df[col] = df[col][0]
-
-    if city == 'berlin':
-        x_test_prep = preprocessor.transform(df)
-        y_pred = model.predict(x_test_prep)
-        y_pred_interval = tuple(
-            [(round(curr.convert(math.exp(el - el * MAPE_median), 'USD', 'EUR', date=date(2020, 3, 17))),
-              round(curr.convert(math.exp(el + el * MAPE_median), 'USD', 'EUR', date=date(2020, 3, 17)))) for el in
-             y_pred])
-        y_pred_exp = [round(curr.convert(math.exp(el), 'USD', 'EUR', date=date(2020, 3, 17))) for el in y_pred]
-
-    elif city == 'amsterdam':
-        x_test_prep = preprocessor2.transform(df)
-        y_pred = model2.predict(x_test_prep)
-        y_pred_interval = tuple(
-            [(round(curr.convert(math.exp(el - el * MAPE_median2), 'USD', 'EUR', date=date(2020, 3, 13))),
-              round(curr.convert(math.exp(el + el * MAPE_median2), 'USD', 'EUR', date=date(2020, 3, 13)))) for el in
-             y_pred])
-        y_pred_exp = [round(curr.convert(math.exp(el), 'USD', 'EUR', date=date(2020, 3, 13))) for el in y_pred]
-
-    elif city == 'paris':
-        x_test_prep = preprocessor3.transform(df)
-        y_pred = model3.predict(x_test_prep)
-        y_pred_interval = tuple(
-            [(round(curr.convert(math.exp(el - el * MAPE_median3), 'USD', 'EUR', date=date(2020, 3, 16))),
-              round(curr.convert(math.exp(el + el * MAPE_median3), 'USD', 'EUR', date=date(2020, 3, 16)))) for el in
-             y_pred])
-        y_pred_exp = [round(curr.convert(math.exp(el), 'USD', 'EUR', date=date(2020, 3, 16))) for el in y_pred]
-
-    elif city == 'barcelona':
-        x_test_prep = preprocessor4.transform(df)
-        y_pred = model4.predict(x_test_prep)
-        y_pred_interval = tuple(
-            [(round(curr.convert(math.exp(el - el * MAPE_median4), 'USD', 'EUR', date=date(2020, 3, 16))),
-              round(curr.convert(math.exp(el + el * MAPE_median4), 'USD', 'EUR', date=date(2020, 3, 16)))) for el in
-             y_pred])
-        y_pred_exp = [round(curr.convert(math.exp(el), 'USD', 'EUR', date=date(2020, 3, 16))) for el in y_pred]
-
-    listing_price = f'Recommended listing price: €{y_pred_exp[0]}'
-    price_range = f'Sensible range: €{y_pred_interval[0][0]}-€{y_pred_interval[0][1]}'
-    yearly_earnings = f'Potential yearly earnings: €{round(y_pred_exp[0] * 365 * occupancy_rate)} (at occupancy of {int(occupancy_rate * 100)}%, not considering fees and taxes)'
-
-    return listing_price, price_range, yearly_earnings
+
+@app.callback(
+    [Output('sensitivity', 'figure'),
+     Output('sensitivity', 'style')],
+    [Input('sweep_inputs', 'value')]
+    + [Input(col, 'on' if col in BINARY_FEATURES else 'value') for col in LISTING_INPUTS]
+    + [Input('city', 'value'),
+       Input('dataset_date', 'value')])
+
+@timed('generate_sensitivity')
+def generate_sensitivity(sweep_inputs, *args):
+    """Price and earnings curves over the range of the chosen inputs, priced in one batch."""
+    if not sweep_inputs:
+        return {}, {'display': 'none'}
+    *listing_inputs, city, dataset_date = args
+    bundle = city_bundle(city, dataset_date)
+    sweep_inputs = sweep_inputs[:MAX_SWEEP_INPUTS]
+    try:
+        result = sensitivity(bundle, dict(zip(LISTING_INPUTS, listing_inputs)), sweep_inputs)
+    except ValueError:
+        # The pricing indication shows what is wrong with the inputs
+        return {}, {'display': 'none'}
+
+    x, color = sweep_inputs[0], (sweep_inputs[1:] or [None])[0]
+    curves = result.melt(id_vars=sweep_inputs, value_vars=['price', 'yearly_earnings'], var_name='metric',
+                         value_name='EUR')
+    curves['metric'] = curves.metric.map({'price': 'Price per night', 'yearly_earnings': 'Yearly earnings'})
+    if color is not None:
+        curves[color] = curves[color].astype(str)
+    figure = px.line(curves, x=x, y='EUR', color=color, facet_row='metric', height=500,
+                     labels={col: SWEEP_LABELS[col] for col in sweep_inputs})
+    figure.update_yaxes(matches=None)
+    figure.for_each_annotation(lambda annotation: annotation.update(text=annotation.text.split('=')[-1]))
+    return figure, {'display': 'block'}
 
 
 @app.callback(
     Output('listing_url', 'href'),
     [Input('listing_no', 'value')])
 
+@timed('generate_url')
 def generate_url(listing_no):
-    url = f'https://www.airbnb.com/rooms/{listing_no}'
+    url = listing_url(listing_no)
     return url
 
 
-@app.callback(
-    [Output('map_fig', 'figure'),
-     Output('total_listings', 'children')],
-    [Input('city', 'value')])
+# Columns shown on the map, rounded to what is displayed (~1 m for coordinates)
+map_columns = {'latitude': 5, 'longitude': 5, 'price': 0, 'accommodates': 0, 'listing_no': 0, 'bedrooms': 1,
+               'room_type': None, 'occupancy_rate': 2}
 
-def generate_map(city):
-# Define map content and layout
-    if city == "berlin":
-        map_input=data
-        city_date=dataset_date
-        zoom=9
-    elif city == "amsterdam":
-        map_input=data2
-        city_date=dataset_date2
-        zoom=10
-    elif city == "paris":
-        map_input=data3
-        city_date=dataset_date3
-        zoom=11
-    elif city == "barcelona":
-        map_input=data4
-        city_date=dataset_date4
-        zoom=11
-    data.price = [round(curr.convert(math.exp(el), 'USD', 'EUR', date=date(2020, 3, 17))) for el in data.price_log]
-    map_fig = px.scatter_mapbox(
+
+def build_map(bundle):
+    """Listings map of a city bundle (cached per snapshot by map_figures)."""
+    map_input = bundle.data[list(map_columns)].copy()
+    for col, decimals in map_columns.items():
+        if decimals is not None:
+            # Compacted float32 columns are rounded in double precision, as before compaction
+            values = map_input[col].astype(float) if map_input[col].dtype.kind == 'f' else map_input[col]
+            map_input[col] = values.round(decimals)
+    return px.scatter_mapbox(
         map_input,
         lat="latitude",
         lon="longitude",
@@ -629,16 +728,105 @@ def generate_map(city):
             "bedrooms": True,
             "price": True,
             "room_type": True,
-            "neighbourhood_cleansed": False,
             "occupancy_rate": True,
             "occupancy_rate": ":.2f"
         },
         range_color=[10,200],
-        zoom=zoom,
+        zoom=map_zoom[bundle.city],
         opacity=0.8,
-        mapbox_style="carto-positron")
-    total_listings = len(map_input.price_log)
-    return map_fig, dcc.Markdown(f'### {total_listings} listings in {city.capitalize()} on {city_date}:')
+        mapbox_style="carto-positron").update_layout(uirevision=bundle.city)
+
+
+# Map figures are built once per city snapshot and served from memory afterwards, split into
+# one trace per room type so that its name is not repeated for every listing
+map_figures = FigureCache(build_map, max_entries=int(os.environ.get('MAP_CACHE_SIZE', 4)), split_by='room_type')
+# The map only receives the listings in view: a sample of at most MAP_INITIAL_POINTS for the
+# whole city and at most MAP_MAX_POINTS once the user pans or zooms
+map_initial_points = int(os.environ.get('MAP_INITIAL_POINTS', 2000))
+map_max_points = int(os.environ.get('MAP_MAX_POINTS', 5000))
+# "Density" shows grid bins below zoom level MAP_LISTINGS_ZOOM and listings from there on
+map_listings_zoom = int(os.environ.get('MAP_LISTINGS_ZOOM', 13))
+map_aggregates = AggregateStore(max_zoom=map_listings_zoom, max_entries=int(os.environ.get('MAP_CACHE_SIZE', 4)))
+area_labels = {'zipcode': 'Zipcode', 'neighbourhood_cleansed': 'Neighbourhood'}
+
+
+def cache_lookups():
+    """(hits, misses) of this worker's caches."""
+    return {
+        'bundles': (registry.hits, registry.loads),
+        'predictions': (prediction_cache.hits, prediction_cache.misses),
+        'maps': (map_figures.hits, map_figures.builds),
+        'aggregates': (map_aggregates.hits, map_aggregates.builds + map_aggregates.refreshes),
+    }
+
+
+def cache_hit_ratios():
+    return {(cache,): hits / (hits + misses) for cache, (hits, misses) in cache_lookups().items() if hits + misses}
+
+
+# Prometheus metrics on GET /metrics (see pricing/metrics.py): callback and prediction stage latencies, bundle
+# loads, micro-batch sizes, queueing delays and timeouts, cache hit ratios and RSS. With METRICS_DIR set, every worker exports its metrics there every
+# METRICS_EXPORT_INTERVAL seconds and a scrape returns those of all workers of the host
+METRICS.collector('pricing_cache_hits_total', "Lookups served from a cache of the worker",
+                  lambda: {(cache,): hits for cache, (hits, _) in cache_lookups().items()}, 'counter', ['cache'])
+METRICS.collector('pricing_cache_misses_total', "Lookups not served from a cache of the worker",
+                  lambda: {(cache,): misses for cache, (_, misses) in cache_lookups().items()}, 'counter', ['cache'])
+METRICS.collector('pricing_cache_hit_ratio', "Share of the lookups served from a cache of the worker",
+                  cache_hit_ratios, 'gauge', ['cache'])
+METRICS.collector('pricing_bundles_resident', "City bundles in memory", lambda: len(registry.resident()))
+METRICS.collector('pricing_bundle_swaps_total', "Bundles hot-swapped for a new version", lambda: registry.swaps,
+                  'counter')
+METRICS.collector('pricing_batch_timeouts_total', "Requests that stopped waiting for their micro-batch",
+                  lambda: batcher.timeouts, 'counter')
+if os.environ.get('METRICS_DIR'):
+    METRICS.export(os.environ['METRICS_DIR'], float(os.environ.get('METRICS_EXPORT_INTERVAL', 5)))
+server.register_blueprint(create_metrics(METRICS, os.environ.get('METRICS_DIR')))
+
+
+@app.callback(
+    [Output('map_fig', 'figure'),
+     Output('total_listings', 'children')],
+    [Input('city', 'value'),
+     Input('map_fig', 'relayoutData'),
+     Input('map_mode', 'value'),
+     Input('map_date', 'value')])
+
+@timed('generate_map')
+@profiler.profiled('generate_map')
+def generate_map(city, relayout_data, map_mode, map_date):
+# Define map content and layout
+    bundle = city_bundle(city, map_date)
+    map_entry = map_figures.entry(bundle)
+    points = bundle.points
+    triggered = [el['prop_id'] for el in dash.callback_context.triggered]
+    panned = 'map_fig.relayoutData' in triggered and 'city.value' not in triggered
+    # Keep the current viewport when switching modes, unless it is still the previous city's
+    bounds = None
+    if 'city.value' not in triggered:
+        bounds = viewport_bounds(relayout_data, px.defaults.width, px.defaults.height)
+    if bounds is not None and not (bounds[0] <= points.lat_max and bounds[1] >= points.lat_min
+                                   and bounds[2] <= points.lon_max and bounds[3] >= points.lon_min):
+        bounds = None
+    if panned and bounds is None:
+        raise PreventUpdate
+    zoom = (relayout_data or {}).get('mapbox.zoom', map_zoom[city]) if bounds else map_zoom[city]
+
+    if map_mode in area_labels:
+        if panned:
+            raise PreventUpdate
+        map_fig = aggregate_figure(map_entry['figure'], map_aggregates.get(bundle).areas(map_mode),
+                                   area_labels[map_mode])
+    elif map_mode == 'density' and zoom < map_listings_zoom:
+        map_fig = aggregate_figure(map_entry['figure'], map_aggregates.get(bundle).grid(zoom), None)
+    elif bounds:
+        map_fig = subset_points(map_entry, points.query(*bounds, limit=map_max_points))
+    else:
+        map_fig = subset_points(map_entry, points.query(*points.bounds, limit=map_initial_points))
+
+    if panned:
+        return map_fig, dash.no_update
+    total_listings = len(bundle.data)
+    return map_fig, dcc.Markdown(f'### {total_listings} listings in {city.capitalize()} on {bundle.dataset_date}:')
 
 
 if __name__ == '__main__':
@@ -646,6 +834,5 @@ if __name__ == '__main__':
 
 
 # OPEN TOPICS:
-# - Make for-loop for importing data/models to make it scalable
 # - Potentially keep only one date per city (a) makes more sense, b) causes less potential issues)
 # - Remove edge/margin in web app (left and top)
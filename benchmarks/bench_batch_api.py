@@ -0,0 +1,60 @@
+"""Throughput of the batch pricing API vs. calling the predict callback once per listing.
+
+    python benchmarks/bench_batch_api.py --city berlin --rows 1000 10000 100000
+
+The callback is driven through real _dash-update-component requests (Flask test client) with the
+prediction cache disabled, so both sides do the full transform/predict work.
+"""
+import argparse
+import json
+import os
+import time
+
+os.environ.setdefault('PREDICTION_CACHE_SIZE', '0')
+
+from common import load_app, predict_payload, random_listings  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--city", default="berlin")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--callback-rows", type=int, default=200,
+                        help="listings priced through the callback (the rate is extrapolated)")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    app_module = load_app()
+    client = app_module.server.test_client()
+    zipcodes = app_module.registry.get(args.city).zipcodes
+    input_names = app_module.LISTING_INPUTS
+
+    # Warm up (bundle load, first transform)
+    client.post('/api/v1/price', json=[dict(random_listings(1, zipcodes)[0], city=args.city)])
+
+    listings = random_listings(args.callback_rows, zipcodes)
+    start = time.perf_counter()
+    for listing in listings:
+        response = client.post('/_dash-update-component', json=predict_payload(listing, args.city, input_names))
+        assert response.status_code == 200, response.data
+    callback_rate = len(listings) / (time.perf_counter() - start)
+    print(f"callback loop: {callback_rate:10.0f} listings/s")
+
+    results = {'city': args.city, 'callback_rows_per_s': callback_rate, 'api': []}
+    for rows in args.rows:
+        payload = [dict(listing, city=args.city) for listing in random_listings(rows, zipcodes, seed=rows)]
+        start = time.perf_counter()
+        response = client.post('/api/v1/price', json=payload)
+        elapsed = time.perf_counter() - start
+        assert response.status_code == 200, response.data
+        rate = rows / elapsed
+        results['api'].append({'rows': rows, 'seconds': elapsed, 'rows_per_s': rate})
+        print(f"api {rows:>7} rows: {rate:10.0f} listings/s ({rate / callback_rate:.0f}x, {elapsed:.2f}s)")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Throughput and latency of concurrent single-listing predictions with and without micro-batching.
+
+    python benchmarks/bench_batching.py --threads 16 --windows 0 1 2 5 --requests 2000
+"""
+import argparse
+import json
+import threading
+import time
+
+from common import percentiles, random_listings
+from pricing.batching import MicroBatcher
+from pricing.bundle import load_bundle
+from pricing.compile_bundles import find_snapshots
+from pricing.features import LISTING_INPUTS
+
+
+def run(batcher, bundle, listings, threads):
+    latencies = [[] for _ in range(threads)]
+
+    def worker(k):
+        for listing in listings[k::threads]:
+            start = time.perf_counter()
+            batcher.predict(bundle, listing)
+            latencies[k].append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=worker, args=(k,)) for k in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return len(listings) / elapsed, percentiles([s for samples in latencies for s in samples], points=(50, 99))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--city", help="only this city (default: first snapshot found)")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 1, 2, 5], help="batch windows in ms")
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    city, dataset_date = find_snapshots(city=args.city)[0]
+    bundle = load_bundle(city, dataset_date)
+    listings = [{col: [el.get(col, 0.3)] for col in LISTING_INPUTS}
+                for el in random_listings(args.requests, bundle.zipcodes)]
+
+    results = []
+    for window in args.windows:
+        batcher = MicroBatcher(max_batch=args.max_batch, window=window / 1000)
+        throughput, latency = run(batcher, bundle, listings, args.threads)
+        stats = batcher.stats()
+        results.append({'city': city, 'threads': args.threads, 'window_ms': window,
+                        'throughput': throughput, 'latency': latency, 'batching': stats})
+        print(f"{city} window {window:4.1f}ms: {throughput:8.0f} predictions/s, "
+              f"p50 {latency['p50'] * 1e3:6.2f}ms p99 {latency['p99'] * 1e3:6.2f}ms, "
+              f"batches {stats['batches']} {stats['batch_size_histogram']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Start-up benchmark: loading a city from APP_*.pkl files vs. the compiled APP_bundle.bin.
+
+Every measurement runs in a fresh interpreter so that nothing is cached in-process, e.g.
+
+    python -m pricing.compile_bundles
+    python benchmarks/bench_bundle_load.py --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pricing.compile_bundles import find_snapshots  # noqa: E402
+
+# Runs in the child process; prints load time (s) and peak RSS (MB) as JSON
+CHILD = """
+import json, resource, sys, time
+import numpy, pandas, joblib, xgboost, sklearn  # import cost is not part of the measurement
+from pricing import bundle
+start = time.perf_counter()
+city_bundle = bundle.{loader}({args})
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps({{'seconds': elapsed, 'max_rss_mb': rss, 'version': city_bundle.version}}))
+"""
+
+
+def run_child(loader, args):
+    code = CHILD.format(loader=loader, args=args)
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    for city, dataset_date in find_snapshots():
+        bundle_path = f"data/{city}_{dataset_date}/APP_bundle.bin"
+        variants = [('pickle', 'load_pickles', f"{city!r}, {dataset_date!r}")]
+        if os.path.exists(os.path.join(ROOT, bundle_path)):
+            variants.append(('bundle', 'read_bundle', repr(bundle_path)))
+        for name, loader, loader_args in variants:
+            runs = [run_child(loader, loader_args) for _ in range(args.repeat)]
+            result = {
+                'city': city, 'date': dataset_date, 'format': name,
+                'median_seconds': statistics.median(r['seconds'] for r in runs),
+                'max_rss_mb': max(r['max_rss_mb'] for r in runs),
+            }
+            results.append(result)
+            print(f"{city:<10} {dataset_date} {name:<7} {result['median_seconds'] * 1000:8.1f} ms "
+                  f"{result['max_rss_mb']:8.1f} MB peak RSS")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Comparable listings: index build time and query latency (k nearest) vs. a brute-force scan.
+
+Runs on the city snapshot with the most listings unless --city is given:
+
+    python benchmarks/bench_comparables.py --k 10 --repeat 1000
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from common import percentiles, random_listings
+from pricing.bundle import load_bundle
+from pricing.comparables import ComparablesIndex
+from pricing.compile_bundles import find_snapshots
+from pricing.features import LISTING_INPUTS
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--city", help="city to benchmark (default: the one with the most listings)")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=1000)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    # The full listings table: compaction drops the model features the index is built from
+    bundles = [load_bundle(city, dataset_date, compact=False) for city, dataset_date in find_snapshots()
+               if args.city is None or city == args.city]
+    bundle = max(bundles, key=lambda el: len(el.data))
+    start = time.perf_counter()
+    index = ComparablesIndex(bundle.encoder, bundle.data)
+    build = time.perf_counter() - start
+    print(f"{bundle.city} {bundle.dataset_date}: {len(bundle.data)} listings, {len(index.trees)} room types, "
+          f"index built in {build * 1e3:.1f}ms")
+
+    listings = random_listings(args.repeat, bundle.zipcodes)
+    listings = [{col: [el.get(col, 0.3)] for col in LISTING_INPUTS} for el in listings]
+    # Brute force: distances to every listing of the same room type in the same feature space
+    features = {col: np.asarray(bundle.data[col], dtype=object) for col in bundle.encoder.cat_columns}
+    features.update({col: bundle.data[col].to_numpy(dtype=float) for col in bundle.encoder.num_columns})
+    X_all = bundle.encoder.transform(features, sparse=False, unknown='ignore')[:, index.keep]
+    room_types = np.asarray(bundle.data.room_type, dtype=object)
+
+    def brute_force(listing):
+        x = bundle.encoder.encode(listing, sparse=False)[:, index.keep]
+        rows = np.flatnonzero(room_types == listing['room_type'][0])
+        dist = np.sqrt(((X_all[rows] - x) ** 2).sum(axis=1))
+        nearest = np.argpartition(dist, min(args.k, len(rows) - 1))[:args.k]
+        return rows[nearest[np.argsort(dist[nearest])]]
+
+    tree_samples, brute_samples, mismatches = [], [], 0
+    for listing in listings:
+        start = time.perf_counter()
+        (rows,), _ = index.query(listing, k=args.k)
+        tree_samples.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        expected = brute_force(listing)
+        brute_samples.append(time.perf_counter() - start)
+        mismatches += set(rows) != set(expected)
+
+    tree, brute = percentiles(tree_samples), percentiles(brute_samples)
+    print(f"  k={args.k} KD-tree:     p50 {tree['p50'] * 1e3:.3f}ms p95 {tree['p95'] * 1e3:.3f}ms "
+          f"p99 {tree['p99'] * 1e3:.3f}ms")
+    print(f"  k={args.k} brute force: p50 {brute['p50'] * 1e3:.3f}ms p95 {brute['p95'] * 1e3:.3f}ms "
+          f"p99 {brute['p99'] * 1e3:.3f}ms")
+    print(f"  {mismatches} of {len(listings)} queries returned different neighbours (ties)")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'city': bundle.city, 'dataset_date': bundle.dataset_date, 'listings': len(bundle.data),
+                       'k': args.k, 'build': build, 'kd_tree': tree, 'brute_force': brute,
+                       'mismatches': mismatches}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Single-row feature encoding latency: DataFrame + preprocessor.transform vs. FeatureEncoder.
+
+    python benchmarks/bench_encoder.py --rows 2000
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from common import percentiles, random_listings
+from pricing.bundle import load_bundle
+from pricing.compile_bundles import find_snapshots
+from pricing.features import LISTING_INPUTS, model_frame
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    for city, dataset_date in find_snapshots():
+        bundle = load_bundle(city, dataset_date)
+        listings = [dict(listing, occupancy_rate=0.3) for listing in random_listings(args.rows, bundle.zipcodes)]
+        timings = {'pandas': [], 'encoder': []}
+        for listing in listings:
+            start = time.perf_counter()
+            frame = model_frame(pd.DataFrame([listing], columns=LISTING_INPUTS), bundle.X_test.columns)
+            bundle.preprocessor.transform(frame)
+            timings['pandas'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            bundle.encoder.encode({col: [listing[col]] for col in LISTING_INPUTS})
+            timings['encoder'].append(time.perf_counter() - start)
+
+        for name, samples in timings.items():
+            stats = percentiles(samples)
+            print(f"{city:<10} {name:<8} " + " ".join(f"{k}={v * 1e6:8.1f}us" for k, v in stats.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Currency conversion: start-up cost of CurrencyConverter() vs. pinned rate files, and per-element vs. vectorized conversion.
+
+Start-up is measured in fresh interpreters, e.g.
+
+    python -m pricing.fx
+    python benchmarks/bench_fx.py --repeat 5 --rows 20000
+"""
+import argparse
+import json
+import math
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date
+
+import numpy as np
+
+from common import ROOT
+from pricing.bundle import bundle_dir
+from pricing.compile_bundles import find_snapshots
+from pricing.features import eur_prices
+from pricing.fx import load_rate, resolve_rate
+
+# Runs in the child process; prints the time to get every snapshot's rate (s) and peak RSS (MB) as JSON
+CHILD = """
+import json, resource, time
+start = time.perf_counter()
+{setup}
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps({{'seconds': elapsed, 'max_rss_mb': rss}}))
+"""
+SETUPS = {
+    'converter': "from currency_converter import CurrencyConverter\ncurr = CurrencyConverter()",
+    'rate_files': "from pricing.bundle import bundle_dir\nfrom pricing.compile_bundles import find_snapshots\n"
+                  "from pricing.fx import load_rate\n"
+                  "rates = [load_rate(bundle_dir(c, d), d) for c, d in find_snapshots()]",
+}
+
+
+def run_child(setup):
+    out = subprocess.run([sys.executable, "-c", CHILD.format(setup=setup)], cwd=ROOT, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    from currency_converter import CurrencyConverter
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=20000, help="prices per conversion (about a city's listings)")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    results = {'startup': {}, 'conversion': []}
+    for name, setup in SETUPS.items():
+        runs = [run_child(setup) for _ in range(args.repeat)]
+        results['startup'][name] = {'median_seconds': statistics.median(r['seconds'] for r in runs),
+                                    'max_rss_mb': max(r['max_rss_mb'] for r in runs)}
+        print(f"start-up {name:<10} {results['startup'][name]['median_seconds'] * 1000:8.1f} ms "
+              f"{results['startup'][name]['max_rss_mb']:8.1f} MB peak RSS")
+
+    curr = CurrencyConverter()
+    price_log = np.random.RandomState(0).normal(4.3, 0.6, args.rows)
+    for city, dataset_date in find_snapshots():
+        usd_eur = load_rate(bundle_dir(city, dataset_date), dataset_date)
+        rate_date = date.fromisoformat(resolve_rate(dataset_date, curr)['rate_date'])
+
+        start = time.perf_counter()
+        loop = [round(curr.convert(math.exp(el), 'USD', 'EUR', date=rate_date)) for el in price_log]
+        loop_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        vectorized = eur_prices(price_log, usd_eur)
+        vectorized_seconds = time.perf_counter() - start
+
+        mismatches = int(np.count_nonzero(np.asarray(loop) != vectorized))
+        results['conversion'].append({'city': city, 'date': dataset_date, 'rows': args.rows, 'mismatches': mismatches,
+                                      'loop_seconds': loop_seconds, 'vectorized_seconds': vectorized_seconds})
+        print(f"{city:<10} {dataset_date}: loop {loop_seconds * 1000:8.1f} ms, vectorized "
+              f"{vectorized_seconds * 1000:6.2f} ms, {mismatches} of {args.rows} prices differ")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
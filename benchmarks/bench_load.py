@@ -0,0 +1,270 @@
+"""Load test of the gunicorn-served app: concurrent simulated users or replayed sessions over HTTP.
+
+Starts `gunicorn 4_App:server` locally (or targets --url) and drives real _dash-update-component
+POSTs from --users concurrent users until --duration seconds have passed. A simulated session
+picks a city by --city-mix, loads its date options (zipcodes, as the browser does) and map, then
+moves one slider or switch at a time, --predicts times, with --think seconds between requests:
+
+    python benchmarks/bench_load.py --workers 4 --threads 8 --users 32 --city-mix berlin=3 paris=1 \\
+        --env CITY_CACHE_SIZE=2 PREDICT_BATCH_WINDOW_MS=2 --record sessions.jsonl --json load.json
+
+--record writes every request as a JSON line ({"session", "offset", "payload"}) and --replay plays
+such a file back: each session from its own user, at the recorded pace scaled by --speed (0 sends
+requests back to back). Reported are throughput and latency percentiles per callback, errors and,
+for a local server, the RSS of every worker sampled every --sample-interval seconds.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import queue
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from common import INPUT_CHOICES, ROOT, SWITCHES, date_options_payload, map_payload, percentiles, predict_payload
+from pricing.features import LISTING_DEFAULTS, LISTING_INPUTS
+
+ENDPOINT = '/_dash-update-component'
+# Callback of a request by its first output
+CALLBACKS = {'listing_price': 'predict', 'map_fig': 'generate_map', 'zipcode': 'set_date_options'}
+
+
+def callback_name(payload):
+    return CALLBACKS.get(payload['outputs'][0]['id'] if payload.get('outputs') else None, 'other')
+
+
+def start_server(port, workers, threads, env):
+    command = [sys.executable, "-m", "gunicorn", "--workers", str(workers), "--threads", str(threads),
+               "--bind", f"127.0.0.1:{port}", "--timeout", "120", "4_App:server"]
+    server = subprocess.Popen(command, cwd=ROOT, env=dict(os.environ, **env))
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {server.returncode}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/")
+            if conn.getresponse().status == 200:
+                return server
+        except OSError:
+            time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start within 120 seconds")
+
+
+def worker_pids(master):
+    pids = []
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # The command may contain spaces; the parent pid follows the closing parenthesis
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == master:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    return sorted(pids)
+
+
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class Recorder:
+    """Latency samples per callback and, with a path, the requests as replayable JSON lines."""
+
+    def __init__(self, path=None):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+        self._file = open(path, 'w') if path else None
+
+    def add(self, callback, seconds, ok, session=None, offset=None, payload=None):
+        with self._lock:
+            if ok:
+                self.samples[callback].append(seconds)
+            else:
+                self.errors[callback] += 1
+            if self._file is not None and payload is not None:
+                self._file.write(json.dumps({'session': session, 'offset': round(offset, 3), 'payload': payload}))
+                self._file.write("\n")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class User:
+    """One simulated browser: a keep-alive connection posting callback requests."""
+
+    def __init__(self, url, recorder):
+        parts = urlsplit(url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=120)
+        self.recorder = recorder
+
+    def post(self, payload, session=None, offset=None, record=True):
+        body = json.dumps(payload)
+        start = time.perf_counter()
+        try:
+            self.conn.request("POST", ENDPOINT, body, {'Content-Type': 'application/json'})
+            response = self.conn.getresponse()
+            data = response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            data, ok = b"", False
+        self.recorder.add(callback_name(payload), time.perf_counter() - start, ok,
+                          session, offset, payload if record else None)
+        return json.loads(data) if ok and data else None
+
+    def simulate(self, session, rng, city, predicts, think):
+        start = time.perf_counter()
+        options = self.post(date_options_payload(city), session, 0.0)
+        zipcodes = [el['value'] for el in options['response']['zipcode']['options']] if options else ['zip_other']
+        time.sleep(think)
+        self.post(map_payload(city), session, time.perf_counter() - start)
+        listing = dict(LISTING_DEFAULTS, zipcode=rng.choice(zipcodes))
+        for _ in range(predicts):
+            time.sleep(think)
+            # One slider, dropdown or switch moved at a time
+            name = rng.choice(list(INPUT_CHOICES) + SWITCHES + ['zipcode'])
+            if name in SWITCHES:
+                listing[name] = not listing[name]
+            else:
+                listing[name] = rng.choice(zipcodes if name == 'zipcode' else INPUT_CHOICES[name])
+            self.post(predict_payload(listing, city, LISTING_INPUTS), session, time.perf_counter() - start)
+
+    def replay(self, requests, speed):
+        start = time.perf_counter()
+        for request in requests:
+            if speed:
+                time.sleep(max(0.0, start + request['offset'] / speed - time.perf_counter()))
+            self.post(request['payload'], record=False)
+
+
+def parse_mix(pairs):
+    mix = {}
+    for pair in pairs:
+        city, _, weight = pair.partition('=')
+        mix[city] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="running server to target instead of starting gunicorn")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--env", nargs="*", default=[], help="KEY=VALUE settings of the started server")
+    parser.add_argument("--users", type=int, default=8, help="concurrent users")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of simulated sessions")
+    parser.add_argument("--city-mix", nargs="+", default=["amsterdam", "barcelona", "berlin", "paris"],
+                        help="cities with optional weights, e.g. berlin=3 paris=1")
+    parser.add_argument("--predicts", type=int, default=20, help="slider moves per simulated session")
+    parser.add_argument("--think", type=float, default=0.0, help="seconds between the requests of a user")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--record", help="write the simulated requests to this JSON lines file")
+    parser.add_argument("--replay", help="replay the sessions of a recorded JSON lines file instead")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay pace (0: back to back)")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="seconds between RSS samples")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.url is None:
+        env = dict(pair.split('=', 1) for pair in args.env)
+        server = start_server(args.port, args.workers, args.threads, env)
+    url = args.url or f"http://127.0.0.1:{args.port}"
+    recorder = Recorder(None if args.replay else args.record)
+    memory, stop = [], threading.Event()
+
+    def sample_memory():
+        start = time.perf_counter()
+        while not stop.wait(args.sample_interval):
+            memory.append({'t': round(time.perf_counter() - start, 2),
+                           'rss_mb': {pid: rss_mb(pid) for pid in worker_pids(server.pid)}})
+
+    if server is not None:
+        threading.Thread(target=sample_memory, name="rss-sampler", daemon=True).start()
+
+    sessions = queue.Queue()
+    if args.replay:
+        recorded = defaultdict(list)
+        with open(args.replay) as f:
+            for line in f:
+                request = json.loads(line)
+                recorded[request['session']].append(request)
+        for requests in recorded.values():
+            sessions.put(sorted(requests, key=lambda el: el['offset']))
+    session_ids = itertools.count()
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.city_mix)
+    deadline = time.perf_counter() + args.duration
+
+    def run_user(user_rng):
+        user = User(url, recorder)
+        if args.replay:
+            while True:
+                try:
+                    requests = sessions.get_nowait()
+                except queue.Empty:
+                    return
+                user.replay(requests, args.speed)
+        while time.perf_counter() < deadline:
+            city = user_rng.choices(list(mix), weights=list(mix.values()))[0]
+            user.simulate(next(session_ids), user_rng, city, args.predicts, args.think)
+
+    threads = [threading.Thread(target=run_user, args=(random.Random(rng.random()),)) for _ in range(args.users)]
+    start = time.perf_counter()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        elapsed = time.perf_counter() - start
+        stop.set()
+        recorder.close()
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=30)
+
+    results = {'config': vars(args), 'seconds': elapsed, 'callbacks': {}, 'memory': memory}
+    total = sum(len(samples) for samples in recorder.samples.values())
+    print(f"{total} requests in {elapsed:.1f}s: {total / elapsed:.1f} req/s with {args.users} users")
+    for callback in sorted(set(recorder.samples) | set(recorder.errors)):
+        samples = recorder.samples[callback]
+        stats = {'requests': len(samples), 'errors': recorder.errors[callback], 'throughput': len(samples) / elapsed}
+        if samples:
+            stats['latency'] = percentiles(samples)
+        results['callbacks'][callback] = stats
+        latency = ' '.join(f"{p} {value * 1000:7.1f}ms" for p, value in stats.get('latency', {}).items())
+        print(f"  {callback:<17} {stats['requests']:>7} ok {stats['errors']:>5} errors "
+              f"{stats['throughput']:7.1f} req/s  {latency}")
+    if memory:
+        peaks = defaultdict(float)
+        for sample in memory:
+            for pid, value in sample['rss_mb'].items():
+                peaks[pid] = max(peaks[pid], value or 0)
+        results['peak_rss_mb'] = dict(peaks)
+        print("  peak RSS per worker: " + ", ".join(f"{pid} {value:.0f} MB" for pid, value in sorted(peaks.items())))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Latency and payload size of the map callback per city: full figure vs. viewport streaming.
+
+    python benchmarks/bench_map.py --repeat 20
+
+Requests go through the Flask test client as real _dash-update-component POSTs; the city
+bundle and its cached figure are built before timing. For each city this reports the full
+figure the map used to send, the initial (city change) response and a pan/zoom response at
+city-wide zoom. The browser's render time grows with the number of points, so points and
+bytes are reported as its proxy; bytes on the wire are the gzip (Accept-Encoding) responses.
+"""
+import argparse
+import json
+import time
+
+from plotly.utils import PlotlyJSONEncoder
+
+from common import load_app, map_payload, percentiles
+
+
+def time_requests(client, payload, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.post('/_dash-update-component', json=payload)
+        samples.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.data
+    figure = response.get_json()['response']['map_fig']['figure']
+    compressed = client.post('/_dash-update-component', json=payload, headers={'Accept-Encoding': 'gzip'})
+    return {'latency': percentiles(samples, points=(50, 99)), 'bytes': len(response.data),
+            'wire_bytes': len(compressed.data), 'encoding': compressed.headers.get('Content-Encoding'),
+            'points': sum(len(trace.get('lat', ())) for trace in figure['data'])}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--city", nargs="+", help="cities (default: all)")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    app_module = load_app()
+    client = app_module.server.test_client()
+
+    results = []
+    for city in args.city or list(app_module.data_options):
+        bundle = app_module.registry.get(city)
+        start = time.perf_counter()
+        full_figure = app_module.map_figures.get(bundle)
+        build_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        full_bytes = len(json.dumps(full_figure, cls=PlotlyJSONEncoder))
+        encode_seconds = time.perf_counter() - start
+
+        mapbox = full_figure['layout']['mapbox']
+        relayout = {'mapbox.center': mapbox['center'], 'mapbox.zoom': mapbox['zoom']}
+        initial = time_requests(client, map_payload(city), args.repeat)
+        viewport = time_requests(client, map_payload(city, relayout), args.repeat)
+        result = {'city': city, 'full': {'build_seconds': build_seconds, 'encode_seconds': encode_seconds,
+                                         'bytes': full_bytes, 'points': len(bundle.points)},
+                  'initial': initial, 'viewport': viewport}
+        results.append(result)
+        print(f"{city:<10} full {len(bundle.points):>6} points {full_bytes / 1e6:6.2f} MB "
+              f"(build {build_seconds * 1000:.0f} ms, encode {encode_seconds * 1000:.0f} ms)")
+        for name, res in [('initial', initial), ('viewport', viewport)]:
+            print(f"{'':<10} {name:<8} {res['points']:>6} points {res['bytes'] / 1e6:6.2f} MB "
+                  f"({res['wire_bytes'] / 1e6:6.2f} MB {res['encoding'] or 'uncompressed'}), p50 {res['latency']['p50'] * 1000:6.1f} ms p99 {res['latency']['p99'] * 1000:6.1f} ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
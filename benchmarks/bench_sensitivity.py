@@ -0,0 +1,57 @@
+"""What-if sweeps: one batched sweep vs. a single prediction and vs. one prediction per grid point.
+
+    python benchmarks/bench_sensitivity.py --repeat 50
+"""
+import argparse
+import json
+import time
+
+from common import percentiles, random_listings
+from pricing.bundle import load_bundle
+from pricing.compile_bundles import find_snapshots
+from pricing.features import LISTING_DEFAULTS, LISTING_INPUTS
+from pricing.sensitivity import sensitivity, sweep_variants
+
+SWEEPS = [["accommodates"], ["wk_mth_discount"], ["accommodates", "bedrooms"], ["bedrooms", "occupancy_rate"]]
+
+
+def time_calls(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples, points=(50, 99))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    for city, dataset_date in find_snapshots():
+        bundle = load_bundle(city, dataset_date)
+        listing = dict(LISTING_DEFAULTS, **random_listings(1, bundle.zipcodes)[0])
+        single = {col: [listing[col]] for col in LISTING_INPUTS}
+        one = time_calls(lambda: bundle.predict(single), args.repeat)
+        print(f"{city}: single prediction p50 {one['p50'] * 1e3:.2f}ms")
+        for inputs in SWEEPS:
+            variants = sweep_variants(listing, inputs)
+            points = len(variants[LISTING_INPUTS[0]])
+            rows = [{col: [values[i]] for col, values in variants.items()} for i in range(points)]
+            batched = time_calls(lambda: sensitivity(bundle, listing, inputs), args.repeat)
+            looped = time_calls(lambda: [bundle.predict(row) for row in rows], max(1, args.repeat // 10))
+            results.append({'city': city, 'inputs': inputs, 'points': points, 'single': one,
+                            'sweep': batched, 'per_point': looped})
+            print(f"  {' x '.join(inputs):<30} {points:>4} points: sweep p50 {batched['p50'] * 1e3:7.2f}ms "
+                  f"({batched['p50'] / one['p50']:.1f}x one prediction) | per point p50 {looped['p50'] * 1e3:8.2f}ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
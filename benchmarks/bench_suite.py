@@ -0,0 +1,184 @@
+"""Benchmark suite of the app's hot paths, with results as JSON and regressions flagged against a baseline.
+
+Runs offline against the shipped data/<city>_<date> snapshots and measures
+
+- cold import of 4_App.py (fresh interpreter): seconds and peak RSS
+- bundle load per city (fresh interpreter): seconds and peak RSS
+- the predict callback (real _dash-update-component POSTs, prediction cache off): p50/p95/p99
+- batched bundle.predict (--batch listings per call): p50/p95/p99
+- generate_map: figure build time, initial response latency and bytes
+- set_date_options: p50/p95/p99
+
+Inputs are slider configurations sampled with --seed, or recorded ones from --inputs (a JSON list
+of listings as taken by the batch API). Every metric is a "lower is better" number under a flat
+name, e.g. "berlin.predict.p95", so two runs compare key by key:
+
+    python benchmarks/bench_suite.py --json baseline.json
+    python benchmarks/bench_suite.py --json run.json --baseline baseline.json --tolerance 0.2
+
+With --baseline, metrics more than --tolerance (relative) worse than the baseline are listed as
+regressions, and the exit status is 1 if there are any.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+os.environ.setdefault('PREDICTION_CACHE_SIZE', '0')
+
+from common import (ROOT, date_options_payload, load_app, map_payload, percentiles,  # noqa: E402
+                    predict_payload, random_listings)
+from pricing.features import LISTING_DEFAULTS  # noqa: E402
+
+# Run in the child process; print seconds and peak RSS (MB) as JSON
+IMPORT_CHILD = """
+import importlib, json, resource, sys, time
+sys.path.insert(0, '.')
+start = time.perf_counter()
+importlib.import_module('4_App')
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+"""
+LOAD_CHILD = """
+import json, resource, time
+import numpy, pandas, joblib, xgboost, sklearn  # import cost is not part of the measurement
+from pricing.bundle import load_bundle
+start = time.perf_counter()
+load_bundle({city!r}, {dataset_date!r})
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+"""
+
+
+def run_child(code, repeat):
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    return {'seconds': statistics.median(r['seconds'] for r in runs), 'max_rss_mb': max(r['max_rss_mb'] for r in runs)}
+
+
+def time_posts(client, payloads):
+    samples = []
+    for payload in payloads:
+        start = time.perf_counter()
+        response = client.post('/_dash-update-component', json=payload)
+        samples.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.data
+    return percentiles(samples), response
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'commit': commit or None}
+
+
+def compare(metrics, baseline, tolerance):
+    """Metrics worse than the baseline by more than `tolerance` (relative), worst first."""
+    regressions = []
+    for name, value in metrics.items():
+        before = baseline.get(name)
+        if before and value > before * (1 + tolerance):
+            regressions.append({'metric': name, 'baseline': before, 'value': value, 'change': value / before - 1})
+    return sorted(regressions, key=lambda el: el['change'], reverse=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--city", nargs="+", help="cities (default: all)")
+    parser.add_argument("--repeat", type=int, default=200, help="requests per latency measurement")
+    parser.add_argument("--cold-repeat", type=int, default=3, help="fresh interpreters per start-up measurement")
+    parser.add_argument("--batch", type=int, default=64, help="listings per batched prediction")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--inputs", help="JSON file with recorded listing configurations")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    metrics = {}
+    cold = run_child(IMPORT_CHILD, args.cold_repeat)
+    metrics['startup.import_seconds'] = cold['seconds']
+    metrics['startup.max_rss_mb'] = cold['max_rss_mb']
+    print(f"cold import: {cold['seconds'] * 1000:.0f} ms, {cold['max_rss_mb']:.0f} MB peak RSS")
+
+    app_module = load_app()
+    client = app_module.server.test_client()
+    input_names = app_module.LISTING_INPUTS
+    recorded = None
+    if args.inputs:
+        with open(args.inputs) as f:
+            recorded = json.load(f)
+
+    for city in args.city or list(app_module.data_options):
+        dataset_date = app_module.registry.default_date(city)
+        load = run_child(LOAD_CHILD.format(city=city, dataset_date=dataset_date), args.cold_repeat)
+        metrics[f"{city}.load_seconds"] = load['seconds']
+        metrics[f"{city}.load_max_rss_mb"] = load['max_rss_mb']
+
+        bundle = app_module.registry.get(city)
+        if recorded is not None:
+            listings = [dict(LISTING_DEFAULTS, **el) for el in recorded if el.get('city', city) == city]
+        else:
+            listings = random_listings(args.repeat, bundle.zipcodes, seed=args.seed)
+            for el in listings:
+                el.setdefault('occupancy_rate', 0.3)
+        listings = (listings * (args.repeat // max(len(listings), 1) + 1))[:args.repeat]
+
+        predict, _ = time_posts(client, [predict_payload(el, city, input_names) for el in listings])
+        batches = [{col: [el[col] for el in listings[i:i + args.batch]] for col in input_names}
+                   for i in range(0, len(listings), args.batch)]
+        samples = []
+        for _ in range(max(1, args.repeat // len(batches))):
+            for batch in batches:
+                start = time.perf_counter()
+                bundle.predict(batch)
+                samples.append(time.perf_counter() - start)
+        batched = percentiles(samples)
+
+        start = time.perf_counter()
+        app_module.map_figures.get(bundle)
+        map_build = time.perf_counter() - start
+        map_latency, response = time_posts(client, [map_payload(city)] * max(1, args.repeat // 10))
+        date_options, _ = time_posts(client, [date_options_payload(city)] * args.repeat)
+
+        for name, latency in [('predict', predict), (f'predict_batch{args.batch}', batched),
+                              ('map', map_latency), ('set_date_options', date_options)]:
+            metrics.update({f"{city}.{name}.{p}": value for p, value in latency.items()})
+        metrics[f"{city}.map.build_seconds"] = map_build
+        metrics[f"{city}.map.bytes"] = len(response.data)
+        print(f"{city:<10} load {load['seconds'] * 1000:6.0f} ms {load['max_rss_mb']:5.0f} MB | "
+              f"predict p50 {predict['p50'] * 1000:.2f} p99 {predict['p99'] * 1000:.2f} ms | "
+              f"batch of {args.batch} p50 {batched['p50'] * 1000:.2f} ms | map build {map_build * 1000:.0f} ms, "
+              f"p50 {map_latency['p50'] * 1000:.1f} ms, {len(response.data) / 1e3:.0f} kB | "
+              f"set_date_options p50 {date_options['p50'] * 1000:.2f} ms")
+
+    results = {'environment': environment(), 'config': vars(args), 'metrics': metrics}
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['metrics']
+        results['regressions'] = compare(metrics, baseline, args.tolerance)
+        for el in results['regressions']:
+            print(f"REGRESSION {el['metric']}: {el['baseline']:.6g} -> {el['value']:.6g} ({el['change']:+.0%})")
+        status = 1 if results['regressions'] else 0
+        print(f"{len(results['regressions'])} of {len(metrics)} metrics regressed by more than {args.tolerance:.0%}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
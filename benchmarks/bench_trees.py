@@ -0,0 +1,59 @@
+"""Inference latency of model.predict vs. the numpy TreeEnsemble (p50/p99 per batch size).
+
+    python benchmarks/bench_trees.py --batches 1 8 64 --repeat 1000
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from common import percentiles, random_listings
+from pricing.bundle import load_bundle
+from pricing.compile_bundles import find_snapshots
+from pricing.features import LISTING_INPUTS
+
+
+def time_calls(func, inputs):
+    samples = []
+    for X in inputs:
+        start = time.perf_counter()
+        func(X)
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples, points=(50, 99))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--repeat", type=int, default=1000)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    for city, dataset_date in find_snapshots():
+        bundle = load_bundle(city, dataset_date).use_numpy_trees()
+        listings = random_listings(max(args.batches) * 4, bundle.zipcodes)
+        X_all = bundle.encoder.encode({col: [el.get(col, 0.3) for el in listings] for col in LISTING_INPUTS})
+        X_dense = X_all.toarray() if hasattr(X_all, 'toarray') else X_all
+        if bundle.encoder.sparse_output:
+            X_dense[X_dense == 0] = np.nan
+        diff = float(np.abs(bundle.model.predict(X_all) - bundle.trees.predict(X_dense)).max())
+        print(f"{city} ({bundle.trees.n_trees} trees, depth {bundle.trees.depth}), max abs diff {diff:.3g}")
+
+        rng = np.random.RandomState(0)
+        for batch in args.batches:
+            picks = [rng.choice(X_dense.shape[0], batch, replace=False) for _ in range(args.repeat)]
+            xgb = time_calls(bundle.model.predict, [X_all[idx] for idx in picks])
+            numpy = time_calls(bundle.trees.predict, [X_dense[idx] for idx in picks])
+            results.append({'city': city, 'batch': batch, 'xgboost': xgb, 'numpy': numpy})
+            print(f"  batch {batch:>4}: xgboost p50 {xgb['p50'] * 1e6:8.1f}us p99 {xgb['p99'] * 1e6:8.1f}us | "
+                  f"numpy p50 {numpy['p50'] * 1e6:8.1f}us p99 {numpy['p99'] * 1e6:8.1f}us")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Helpers shared by the benchmark scripts: importing the app and sampling slider configurations."""
+import importlib
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Values the input components of the "Pricing Indicator" tab can take
+INPUT_CHOICES = {
+    "accommodates": list(range(1, 11)),
+    "bedrooms": [n / 2 for n in range(1, 15)],
+    "beds": [n / 2 for n in range(1, 15)],
+    "bathrooms_log": [n / 2 for n in range(2, 15)],
+    "calc_host_lst_count_sqrt_log": list(range(0, 8)),
+    "cancellation_policy": ["flexible", "moderate", "strict", "super_strict"],
+    "guests_included_calc": list(range(1, 10)),
+    "maximum_nights": [30, 90, 365, 1125],
+    "minimum_nights_sqrt": [1, 2, 3, 5, 7, 14, 30],
+    "property_type": ["Apartment", "House", "Boutique hotel", "Secondary unit", "Bed and breakfast", "Unique space"],
+    "room_type": ["Entire home/apt", "Private room", "Shared room", "Hotel room"],
+    "wk_mth_discount": [round(n * 0.05, 2) for n in range(0, 11)],
+    "occupancy_rate": [round(n * 0.05, 2) for n in range(0, 21)],
+}
+SWITCHES = ["am_balcony", "am_breakfast", "am_child_friendly", "am_elevator", "am_essentials", "am_pets_allowed",
+            "am_private_entrance", "am_smoking_allowed", "am_tv", "host_is_superhost", "instant_bookable"]
+
+
+def load_app():
+    """Import 4_App.py (not importable by name since it starts with a digit)."""
+    os.chdir(ROOT)
+    return importlib.import_module("4_App")
+
+
+def random_listing(rng, zipcodes):
+    listing = {name: rng.choice(choices) for name, choices in INPUT_CHOICES.items()}
+    listing.update({name: rng.random() < 0.5 for name in SWITCHES})
+    listing["zipcode"] = rng.choice(list(zipcodes))
+    return listing
+
+
+def random_listings(n, zipcodes, seed=42):
+    rng = random.Random(seed)
+    return [random_listing(rng, zipcodes) for _ in range(n)]
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    ordered = sorted(samples)
+    return {f"p{p}": ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+
+
+def predict_payload(listing, city, input_names, dataset_date=None):
+    """Body of the _dash-update-component POST that triggers the predict callback.
+
+    Without dataset_date the city's default snapshot is priced.
+    """
+    switches = set(SWITCHES)
+    inputs = [{'id': name, 'property': 'on' if name in switches else 'value', 'value': listing[name]}
+              for name in input_names]
+    inputs.append({'id': 'city', 'property': 'value', 'value': city})
+    inputs.append({'id': 'dataset_date', 'property': 'value', 'value': dataset_date})
+    return {
+        'output': '..listing_price.children...price_range.children...yearly_earnings.children...comparables.children..',
+        'outputs': [{'id': 'listing_price', 'property': 'children'},
+                    {'id': 'price_range', 'property': 'children'},
+                    {'id': 'yearly_earnings', 'property': 'children'},
+                    {'id': 'comparables', 'property': 'children'}],
+        'inputs': inputs,
+        'changedPropIds': [f"{inputs[0]['id']}.{inputs[0]['property']}"],
+        'state': [],
+    }
+
+
+def map_payload(city, relayout_data=None, map_mode="listings", dataset_date=None):
+    """Body of the _dash-update-component POST that triggers the generate_map callback.
+
+    Without relayout_data it is a city change, otherwise a pan/zoom of the map.
+    """
+    return {
+        'output': '..map_fig.figure...total_listings.children..',
+        'outputs': [{'id': 'map_fig', 'property': 'figure'},
+                    {'id': 'total_listings', 'property': 'children'}],
+        'inputs': [{'id': 'city', 'property': 'value', 'value': city},
+                   {'id': 'map_fig', 'property': 'relayoutData', 'value': relayout_data},
+                   {'id': 'map_mode', 'property': 'value', 'value': map_mode},
+                   {'id': 'map_date', 'property': 'value', 'value': dataset_date}],
+        'changedPropIds': ['map_fig.relayoutData' if relayout_data else 'city.value'],
+        'state': [],
+    }
+
+
+def date_options_payload(city, dataset_date=None):
+    """Body of the _dash-update-component POST that triggers the set_date_options callback."""
+    return {
+        'output': '..zipcode.options...background_img.src...zipcode.value..',
+        'outputs': [{'id': 'zipcode', 'property': 'options'},
+                    {'id': 'background_img', 'property': 'src'},
+                    {'id': 'zipcode', 'property': 'value'}],
+        'inputs': [{'id': 'city', 'property': 'value', 'value': city},
+                   {'id': 'dataset_date', 'property': 'value', 'value': dataset_date}],
+        'changedPropIds': ['city.value'],
+        'state': [],
+    }
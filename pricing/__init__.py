@@ -0,0 +1,5 @@
+"""Shared building blocks of the Airbnb pricing indicator web app (4_App.py).
+
+The modules in here are imported by the Dash app as well as by the command line
+tools that prepare the per-city artifacts in data/<city>_<date>/.
+"""
@@ -0,0 +1,79 @@
+"""Admin routes of the web app, only registered when an admin token is configured.
+
+Every request needs the token in the X-Admin-Token header:
+
+    POST /admin/reload          {"city": "berlin"} (optional) hot-swaps changed bundles, see
+                                CityRegistry.refresh; loading happens in the background
+    GET  /admin/bundles         resident bundle versions, registry counters and data_options
+    POST /admin/profile         {"rate": 0.1, "seconds": 600} profiles a fraction of the callbacks
+                                of all workers for a while, see pricing.profiling
+    GET  /admin/profiles        ?callback=predict&city=berlin&top=20&sort=tottime hottest functions
+                                of the captured profiles
+
+With several gunicorn workers a request only reaches one of them; the others pick up the same
+changes through their registry watcher (BUNDLE_WATCH_INTERVAL).
+"""
+import hmac
+import logging
+import threading
+
+from flask import Blueprint, abort, jsonify, request
+
+from pricing.profiling import SORT_KEYS, captures, summarize
+
+logger = logging.getLogger(__name__)
+
+
+def create_admin(registry, token, profiler=None):
+    """Blueprint with the admin routes for `registry` (and `profiler`), protected by `token`."""
+    admin = Blueprint('admin', __name__, url_prefix='/admin')
+
+    @admin.before_request
+    def check_token():
+        if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token):
+            abort(403)
+
+    @admin.route('/reload', methods=['POST'])
+    def reload():
+        city = (request.get_json(silent=True) or {}).get('city')
+        if city is not None and city not in registry.data_options:
+            return jsonify(error=f"unknown city: {city!r}"), 404
+
+        def run():
+            try:
+                loaded = registry.refresh(city=city)
+                logger.info("Admin reload loaded %s", loaded or "nothing")
+            except Exception:
+                logger.exception("Admin reload failed")
+
+        threading.Thread(target=run, name="admin-reload", daemon=True).start()
+        return jsonify(started=True, city=city), 202
+
+    @admin.route('/bundles')
+    def bundles():
+        return jsonify(versions=registry.versions(), stats=registry.stats(), data_options=registry.data_options)
+
+    if profiler is None:
+        return admin
+
+    @admin.route('/profile', methods=['POST'])
+    def profile():
+        payload = request.get_json(silent=True) or {}
+        try:
+            rate = float(payload.get('rate', 0))
+            seconds = float(payload.get('seconds', 600))
+            profiler.configure(rate, seconds)
+        except (TypeError, ValueError) as e:
+            return jsonify(error=str(e)), 400
+        return jsonify(rate=rate, seconds=seconds, directory=profiler.directory)
+
+    @admin.route('/profiles')
+    def profiles():
+        top = request.args.get('top', 20, type=int)
+        sort = request.args.get('sort', 'tottime')
+        if sort not in SORT_KEYS:
+            return jsonify(error=f"sort must be one of {', '.join(SORT_KEYS)}"), 400
+        paths = captures(profiler.directory, request.args.get('callback'), request.args.get('city'))
+        return jsonify(captures=len(paths), rate=profiler.current_rate(), functions=summarize(paths, top, sort))
+
+    return admin
@@ -0,0 +1,168 @@
+"""Aggregated listings for the map at low zoom: grid bins per zoom level and areas.
+
+MapAggregates groups the listings of a city snapshot into square grid bins of several sizes
+(about GRID_PIXELS wide on screen at each whole zoom level below the listings threshold) and
+into its zipcodes and neighbourhoods. Every group has its listing count, mean position and
+median price and occupancy_rate.
+
+When a new snapshot of a city arrives, refresh() only recomputes the groups that contain a
+listing which was added, removed or changed (by listing_no) and copies all other groups from
+the previous snapshot's aggregates. AggregateStore keeps the aggregates per city snapshot and
+refreshes from the most recent snapshot of the same city.
+"""
+import logging
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from pricing.spatial import TILE_SIZE
+
+# Listing columns the aggregates depend on
+TRACKED_COLUMNS = ["listing_no", "latitude", "longitude", "price", "occupancy_rate", "zipcode",
+                   "neighbourhood_cleansed"]
+AREA_COLUMNS = ["zipcode", "neighbourhood_cleansed"]
+# Approximate on-screen width of a grid bin
+GRID_PIXELS = 30
+MIN_ZOOM = 8
+
+logger = logging.getLogger(__name__)
+
+
+def grid_size(zoom):
+    """Bin size (degrees) for a whole zoom level."""
+    return GRID_PIXELS * 360 / (TILE_SIZE * 2 ** zoom)
+
+
+def _grid_keys(frame, zoom):
+    size = grid_size(zoom)
+    rows = np.floor(frame.latitude.to_numpy(dtype=float) / size)
+    cols = np.floor(frame.longitude.to_numpy(dtype=float) / size)
+    # One int64 key per bin; longitudes can be negative, so shift the column number
+    return pd.Series((rows * 2 ** 24 + cols + 2 ** 23).astype(np.int64), index=frame.index)
+
+
+def _summarize(frame, keys):
+    groups = frame.groupby(keys)
+    return pd.DataFrame({
+        'count': groups.size(),
+        'latitude': groups.latitude.mean(),
+        'longitude': groups.longitude.mean(),
+        'price': groups.price.median(),
+        'occupancy_rate': groups.occupancy_rate.median(),
+    })
+
+
+class MapAggregates:
+
+    def __init__(self, bundle, max_zoom=13, previous=None):
+        self.city = bundle.city
+        self.dataset_date = bundle.dataset_date
+        self.version = bundle.version
+        self.zooms = list(range(MIN_ZOOM, max_zoom))
+        frame = bundle.data[[col for col in TRACKED_COLUMNS if col in bundle.data]].copy()
+        for col in AREA_COLUMNS:
+            if col in frame:
+                frame[col] = frame[col].astype(object)
+        self.frame = frame
+
+        groupings = {zoom: _grid_keys(frame, zoom) for zoom in self.zooms}
+        groupings.update({col: frame[col] for col in AREA_COLUMNS if col in frame})
+        if previous is None:
+            self.tables = {name: _summarize(frame, keys) for name, keys in groupings.items()}
+            self.recomputed = len(frame)
+            return
+
+        changed = self._changed(previous.frame, frame)
+        changed_old = previous.frame.listing_no.isin(changed)
+        changed_new = frame.listing_no.isin(changed)
+        self.tables = {}
+        for name, keys in groupings.items():
+            if name not in previous.tables:
+                self.tables[name] = _summarize(frame, keys)
+                continue
+            old_keys = _grid_keys(previous.frame, name) if name in self.zooms else previous.frame[name]
+            affected = pd.unique(np.concatenate([old_keys[changed_old].to_numpy(), keys[changed_new].to_numpy()]))
+            stale = previous.tables[name].index.isin(affected)
+            rows = keys.isin(affected)
+            self.tables[name] = pd.concat([previous.tables[name][~stale],
+                                           _summarize(frame[rows], keys[rows])]).sort_index()
+        self.recomputed = int(changed_new.sum())
+
+    @staticmethod
+    def _changed(old, new):
+        """listing_no of listings added, removed or changed between two snapshots."""
+        merged = old.merge(new, how='outer', indicator=True)
+        return merged.listing_no[merged['_merge'] != 'both'].unique()
+
+    def refresh(self, bundle):
+        """Aggregates of a new snapshot of the same city, recomputing only groups that changed."""
+        return MapAggregates(bundle, max_zoom=self.zooms[-1] + 1 if self.zooms else MIN_ZOOM, previous=self)
+
+    def grid(self, zoom):
+        """Grid bins for a (fractional) zoom level."""
+        zoom = min(max(int(math.floor(zoom)), self.zooms[0]), self.zooms[-1])
+        return self.tables[zoom]
+
+    def areas(self, col):
+        return self.tables[col]
+
+
+class AggregateStore:
+    """MapAggregates per city snapshot (at most `max_entries`), rebuilt when a bundle version changes."""
+
+    def __init__(self, max_zoom=13, max_entries=4):
+        self.max_zoom = max_zoom
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.builds = 0
+        self.refreshes = 0
+        self.hits = 0
+
+    def get(self, bundle):
+        key = (bundle.city, bundle.dataset_date)
+        with self._lock:
+            aggregates = self._current(key, bundle)
+            if aggregates is not None:
+                return aggregates
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Build outside of the store lock so other snapshots stay available meanwhile; the
+        # per-key lock keeps concurrent callbacks from building the same aggregates twice
+        with key_lock:
+            with self._lock:
+                aggregates = self._current(key, bundle)
+                if aggregates is not None:
+                    return aggregates
+                # Start from this snapshot's outdated aggregates or the latest ones of the city
+                previous = self._entries.get(key) or next((el for (city, _), el in reversed(self._entries.items())
+                                                           if city == bundle.city), None)
+
+            if previous is None:
+                aggregates = MapAggregates(bundle, max_zoom=self.max_zoom)
+            else:
+                aggregates = previous.refresh(bundle)
+            logger.info("Aggregated %s_%s for the map (%d listings recomputed)", *key, aggregates.recomputed)
+            with self._lock:
+                if previous is None:
+                    self.builds += 1
+                else:
+                    self.refreshes += 1
+                self._entries[key] = aggregates
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return aggregates
+
+    def _current(self, key, bundle):
+        # Aggregates of the bundle's version, if stored (the caller holds the store lock)
+        aggregates = self._entries.get(key)
+        if aggregates is None or aggregates.version != bundle.version:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return aggregates
@@ -0,0 +1,90 @@
+"""JSON batch pricing API served next to the Dash app.
+
+POST /api/v1/price with a list of listings (or {"listings": [...]}); every listing has a "city"
+and the inputs of the "Pricing Indicator" tab (see pricing.features.LISTING_INPUTS, absent
+ones take the app's defaults, null ones are an error). Listings are grouped by city and each
+group is priced with one call of the city bundle's predict: the numpy FeatureEncoder plus the
+xgboost model or, for NUMPY_TREE_CITIES, the numpy TreeEnsemble. Results come back in request
+order, e.g.
+
+    {"results": [{"price": 74, "price_range": [52, 105], "yearly_earnings": 8103},
+                 {"error": "unknown value for 'zipcode'"}]}
+
+With ?comparables=k every result also lists the k most similar listings of the city (see
+pricing.comparables), each with listing_no, price, url and a few of its features. For cities with
+segment lookup arrays (see pricing.segments) the range is the listing's segment band and every
+result has a "market" with the segment's number of listings, median price and occupancy rate.
+"""
+import pandas as pd
+
+from pricing.comparables import describe_comparables
+from pricing.features import LISTING_DEFAULTS, LISTING_INPUTS, is_hashable, validate_listings, yearly_earnings
+
+MAX_LISTINGS = 100000
+MAX_COMPARABLES = 50
+
+
+def price_listings(registry, listings, batcher=None, comparables=0):
+    """Price a DataFrame of listings (with a "city" column); returns one result dict per row.
+
+    With a pricing.batching.MicroBatcher, each city group is priced together with concurrent
+    requests for the same city. comparables=k adds the k most similar listings to each result.
+    """
+    listings = listings.reset_index(drop=True)
+    results = [None] * len(listings)
+    known_city = listings.city.map(lambda city: is_hashable(city) and city in registry.data_options).astype(bool)
+    for idx in listings.index[~known_city]:
+        results[idx] = {'error': f"unknown city: {listings.city[idx]!r}"}
+
+    for city, group in listings[known_city].groupby('city', sort=False):
+        bundle = registry.get(city)
+        errors = validate_listings(group, bundle.encoder.categories)
+        for idx, error in zip(group.index, errors):
+            if error:
+                results[idx] = {'error': error}
+        valid = group[[error is None for error in errors]]
+        if valid.empty:
+            continue
+        y_pred = batcher.predict(bundle, valid) if batcher else bundle.predict(valid)
+        price, low, high = bundle.price_indication(valid, y_pred)
+        for idx, p, lo, hi, occupancy in zip(valid.index, price, low, high, valid.occupancy_rate):
+            results[idx] = {'price': p, 'price_range': [lo, hi],
+                            'yearly_earnings': yearly_earnings(p, float(occupancy))}
+        if bundle.segments is not None:
+            for idx, market in zip(valid.index, bundle.segments.context(valid)):
+                results[idx]['market'] = market
+        if comparables:
+            rows, distances = bundle.comparables.query(valid, k=comparables)
+            for idx, idx_rows, idx_distances in zip(valid.index, rows, distances):
+                results[idx]['comparables'] = describe_comparables(bundle.data, idx_rows, idx_distances)
+    return results
+
+
+def create_api(registry, batcher=None):
+    """Blueprint with the pricing API, pricing with the city bundles of `registry`."""
+    # Imported here: price_listings is also used offline (pricing.score) without the web stack
+    from flask import Blueprint, jsonify, request
+
+    api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+    @api.route('/price', methods=['POST'])
+    def price():
+        payload = request.get_json(silent=True)
+        if isinstance(payload, dict):
+            payload = payload.get('listings')
+        if not isinstance(payload, list) or not all(isinstance(el, dict) for el in payload):
+            return jsonify(error="expected a JSON list of listings or {\"listings\": [...]}"), 400
+        if len(payload) > MAX_LISTINGS:
+            return jsonify(error=f"at most {MAX_LISTINGS} listings per request"), 413
+
+        comparables = request.args.get('comparables', 0, type=int)
+        if not 0 <= comparables <= MAX_COMPARABLES:
+            return jsonify(error=f"comparables must be between 0 and {MAX_COMPARABLES}"), 400
+        if comparables and not registry.comparables:
+            return jsonify(error="comparables are disabled on this server (COMPARABLE_LISTINGS=0)"), 400
+
+        # Only absent inputs take the defaults; an explicit null is reported as a missing value
+        listings = pd.DataFrame([dict(LISTING_DEFAULTS, **el) for el in payload], columns=['city'] + LISTING_INPUTS)
+        return jsonify(results=price_listings(registry, listings, batcher, comparables), count=len(listings))
+
+    return api
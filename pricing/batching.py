@@ -0,0 +1,154 @@
+"""Micro-batching of concurrent pricing requests per city.
+
+Each prediction call pays a fixed overhead (DMatrix construction, sklearn wrapper, ...), so
+with many concurrent predict callbacks it is cheaper to run them as one batch. MicroBatcher
+keeps a queue and a worker thread per city: the first request waits at most `window` seconds
+for others to join (or until `max_batch` rows are collected), then all of them are priced with
+one bundle.predict call and every caller gets its own rows back.
+
+Batching only helps when a worker serves requests concurrently (e.g. gunicorn --threads);
+with window=0 predictions are made directly in the calling thread. A caller waits at most
+`timeout` seconds for its batch and then predicts directly, so a stalled or dead worker thread
+cannot hang the gunicorn worker; a dead thread is restarted by the next request for its city.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from pricing.features import LISTING_INPUTS
+from pricing.metrics import BATCH_QUEUE_SECONDS, BATCH_ROWS
+
+logger = logging.getLogger(__name__)
+
+
+def _rows(listings):
+    return len(listings[LISTING_INPUTS[0]])
+
+
+class MicroBatcher:
+
+    def __init__(self, max_batch=64, window=0.002, timeout=2.0):
+        self.max_batch = max_batch
+        self.window = window
+        self.timeout = timeout
+        self._queues = {}
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.batches = 0
+        self.requests = 0
+        self.timeouts = 0
+        # Rows per executed batch and recent waits between enqueueing and execution (seconds)
+        self.batch_sizes = Counter()
+        self.queue_delays = deque(maxlen=10000)
+
+    def predict(self, bundle, listings):
+        """Predicted log prices for listings (DataFrame or dict of sequences) of one city bundle."""
+        if self.window <= 0:
+            return bundle.predict(listings)
+        future = Future()
+        self._queue(bundle.city).put((bundle, listings, time.perf_counter(), future))
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # Withdrawn unless the worker thread already took it; either way, price it here
+            future.cancel()
+            with self._lock:
+                self.timeouts += 1
+            logger.warning("Batched prediction for %s timed out after %ss, predicting directly",
+                           bundle.city, self.timeout)
+            return bundle.predict(listings)
+
+    def _queue(self, city):
+        with self._lock:
+            # Worker threads do not survive a fork (gunicorn --preload), start new ones
+            if self._pid != os.getpid():
+                self._queues = {}
+                self._threads = {}
+                self._pid = os.getpid()
+            city_queue = self._queues.get(city)
+            if city_queue is None:
+                city_queue = self._queues[city] = queue.Queue()
+            thread = self._threads.get(city)
+            if thread is None or not thread.is_alive():
+                if thread is not None:
+                    logger.warning("Batching thread of %s died, restarting it", city)
+                thread = self._threads[city] = threading.Thread(target=self._run, args=(city_queue,),
+                                                                name=f"batcher-{city}", daemon=True)
+                thread.start()
+            return city_queue
+
+    def _run(self, city_queue):
+        while True:
+            items = [city_queue.get()]
+            rows = _rows(items[0][1])
+            deadline = items[0][2] + self.window
+            while rows < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = city_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                items.append(item)
+                rows += _rows(item[1])
+            # Requests whose callers gave up waiting are dropped
+            items = [item for item in items if item[3].set_running_or_notify_cancel()]
+            if items:
+                self._execute(items, sum(_rows(item[1]) for item in items))
+
+    def _execute(self, items, rows):
+        start = time.perf_counter()
+        # A bundle may have been replaced while requests were queued; price per bundle
+        groups = {}
+        for item in items:
+            groups.setdefault(id(item[0]), []).append(item)
+        for group in groups.values():
+            try:
+                merged = {col: [value for item in group for value in item[1][col]] for col in LISTING_INPUTS}
+                y_pred = group[0][0].predict(merged)
+            except Exception as exc:
+                for item in group:
+                    item[3].set_exception(exc)
+                continue
+            offset = 0
+            for item in group:
+                n = _rows(item[1])
+                item[3].set_result(y_pred[offset:offset + n])
+                offset += n
+
+        with self._lock:
+            self.batches += 1
+            self.requests += len(items)
+            self.batch_sizes[rows] += 1
+            self.queue_delays.extend(start - item[2] for item in items)
+        BATCH_ROWS.observe(rows)
+        for item in items:
+            BATCH_QUEUE_SECONDS.observe(start - item[2])
+
+    def stats(self):
+        with self._lock:
+            delays = sorted(self.queue_delays)
+            sizes = dict(self.batch_sizes)
+            stats = {'batches': self.batches, 'requests': self.requests, 'timeouts': self.timeouts,
+                     'window': self.window, 'max_batch': self.max_batch}
+        # Batch sizes in power-of-two buckets: "1", "2", "3-4", "5-8", ...
+        histogram = Counter()
+        for size, count in sizes.items():
+            upper = 1
+            while upper < size:
+                upper *= 2
+            lower = upper // 2 + 1 if upper > 2 else upper
+            histogram[f"{lower}-{upper}" if lower != upper else str(upper)] += count
+        stats['batch_size_histogram'] = dict(histogram)
+        if delays:
+            stats['queue_delay'] = {f"p{p}": delays[min(len(delays) - 1, len(delays) * p // 100)]
+                                    for p in (50, 95, 99)}
+            stats['queue_delay']['max'] = delays[-1]
+        return stats
@@ -0,0 +1,368 @@
+"""City bundles: everything the web app needs for one city snapshot.
+
+A bundle can be read from the six APP_*.pkl files written by 3_App_Preparation.ipynb or from a
+single compiled APP_bundle.bin file (see compile_bundle / pricing.compile_bundles). The compiled
+file is laid out as
+
+    magic | format version | manifest length | manifest (JSON) | aligned sections
+
+Tables (APP_data_engineered, APP_X_test) are stored column by column as raw numpy buffers and
+string columns as integer codes plus their categories, so they can be memory-mapped and shared
+between gunicorn workers by the page cache instead of being unpickled into every worker's heap.
+The model is stored in xgboost's native binary booster format. The pinned USD -> EUR rate of
+the snapshot (see pricing.fx) is part of the manifest.
+"""
+import glob
+import hashlib
+import json
+import logging
+import mmap
+import os
+import pickle
+import struct
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from pricing.compact import compact_bundle
+from pricing.comparables import ComparablesIndex
+from pricing.encoder import FeatureEncoder
+from pricing.features import eur_prices, price_indication
+from pricing.fx import FX_FILE, load_rate
+from pricing.metrics import PREDICT_STAGE_SECONDS
+from pricing.segments import SEGMENTS_FILE, load_segments
+from pricing.spatial import GridIndex
+from pricing.trees import TreeEnsemble
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = "data"
+BUNDLE_FILE = "APP_bundle.bin"
+PICKLE_FILES = ["APP_data_engineered.pkl", "APP_best_model.pkl", "APP_preprocessor.pkl",
+                "APP_X_test.pkl", "APP_MAPE_median.pkl", "APP_zipcode.pkl"]
+
+MAGIC = b"APPBNDL\0"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sIQ")
+ALIGNMENT = 64
+
+
+class CityBundle:
+    """All artifacts of one city snapshot."""
+
+    def __init__(self, city, dataset_date, data, model, preprocessor, X_test, MAPE_median, zipcodes,
+                 usd_eur, version, source):
+        self.city = city
+        self.dataset_date = dataset_date
+        self.data = data
+        self.model = model
+        self.preprocessor = preprocessor
+        # Compiled numpy version of the preprocessor, used on the request path
+        self.encoder = FeatureEncoder(preprocessor)
+        self.X_test = X_test
+        self.MAPE_median = MAPE_median
+        self.zipcodes = zipcodes
+        self.usd_eur = usd_eur
+        # EUR price per listing for the map, computed once per load instead of per callback
+        self.data['price'] = eur_prices(data.price_log, usd_eur)
+        # Grid over the listings' coordinates for serving the map viewport by viewport
+        self.points = GridIndex(data.latitude, data.longitude)
+        # Optional KD-trees over the listings in model feature space, per room type (see index_comparables)
+        self.comparables = None
+        self.version = version
+        self.source = source
+        # Optional numpy tree evaluator replacing model.predict (see use_numpy_trees)
+        self.trees = None
+        # Optional per-segment price bands and market context (see pricing.segments)
+        self.segments = None
+
+    def use_numpy_trees(self):
+        self.trees = TreeEnsemble(self.model)
+        return self
+
+    def index_comparables(self):
+        # Needs the model's input columns of the listings, which compaction drops
+        self.comparables = ComparablesIndex(self.encoder, self.data)
+        return self
+
+    def predict(self, listings):
+        """Predicted log prices (USD) for listing inputs (DataFrame or dict of sequences)."""
+        if self.trees is None:
+            with PREDICT_STAGE_SECONDS.time('transform'):
+                X = self.encoder.encode(listings)
+            with PREDICT_STAGE_SECONDS.time('model'):
+                return self.model.predict(X)
+        with PREDICT_STAGE_SECONDS.time('transform'):
+            X = self.encoder.encode(listings, sparse=False)
+            if self.encoder.sparse_output:
+                # Values left out of the preprocessor's sparse output are missing values for xgboost
+                X[X == 0] = np.nan
+        with PREDICT_STAGE_SECONDS.time('model'):
+            return self.trees.predict(X)
+
+    def price_indication(self, listings, y_pred):
+        """EUR prices and sensible ranges: per segment with APP_segments.npz, from MAPE_median otherwise."""
+        if self.segments is None:
+            return price_indication(y_pred, self.MAPE_median, self.usd_eur)
+        return self.segments.price_indication(listings, y_pred, self.usd_eur)
+
+    @property
+    def pricing_version(self):
+        """Version of the prices and ranges: the bundle's, plus its segment bands' if it has any."""
+        if self.segments is None:
+            return self.version
+        return f"{self.version}-{self.segments.version}"
+
+    def __repr__(self):
+        return f"CityBundle({self.city!r}, {self.dataset_date!r}, version={self.version!r})"
+
+
+def bundle_dir(city, dataset_date, data_dir=DATA_DIR):
+    return f"{data_dir}/{city}_{dataset_date}"
+
+
+def artifact_stamp(city, dataset_date, data_dir=DATA_DIR):
+    """(name, size, mtime_ns) of the files load_bundle would read, to notice when they are replaced."""
+    path = bundle_dir(city, dataset_date, data_dir)
+    names = [BUNDLE_FILE] if os.path.exists(f"{path}/{BUNDLE_FILE}") else PICKLE_FILES + [FX_FILE]
+    names.append(SEGMENTS_FILE)
+    stamp = []
+    for name in names:
+        try:
+            stat = os.stat(f"{path}/{name}")
+        except FileNotFoundError:
+            continue
+        stamp.append((name, stat.st_size, stat.st_mtime_ns))
+    return tuple(stamp)
+
+
+def find_bundle_snapshots(data_dir=DATA_DIR):
+    """(city, date) of all folders in data_dir with a compiled bundle or the app's pickles."""
+    folders = set()
+    for name in [BUNDLE_FILE, "APP_best_model.pkl"]:
+        folders.update(os.path.basename(os.path.dirname(path)) for path in glob.glob(f"{data_dir}/*_*/{name}"))
+    return sorted(tuple(folder.rsplit("_", 1)) for folder in folders)
+
+
+def load_bundle(city, dataset_date, data_dir=DATA_DIR, numpy_trees=False, data=None, compact=True,
+                comparables=False):
+    """Load a city bundle, preferring the compiled APP_bundle.bin over the individual pickles.
+
+    `data` replaces the snapshot's own listings table (e.g. taken from a pricing.snapshots store).
+    With `compact`, only the columns the app reads are kept, in compact dtypes (see pricing.compact).
+    With `comparables`, the listings are indexed for comparables queries (see pricing.comparables).
+    """
+    path = bundle_dir(city, dataset_date, data_dir)
+    if os.path.exists(f"{path}/{BUNDLE_FILE}"):
+        bundle = read_bundle(f"{path}/{BUNDLE_FILE}", data=data)
+    else:
+        bundle = load_pickles(city, dataset_date, data_dir, data=data)
+    if numpy_trees:
+        bundle.use_numpy_trees()
+    if comparables:
+        bundle.index_comparables()
+    if compact:
+        compact_bundle(bundle)
+    bundle.segments = load_segments(path)
+    return bundle
+
+
+def load_pickles(city, dataset_date, data_dir=DATA_DIR, data=None):
+    path = bundle_dir(city, dataset_date, data_dir)
+    usd_eur = load_rate(path, dataset_date)
+    # Without a compiled bundle the version is derived from the pickles' size and mtime
+    stamp = hashlib.sha256()
+    for name in PICKLE_FILES:
+        stat = os.stat(f"{path}/{name}")
+        stamp.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    stamp.update(f"{FX_FILE}:{usd_eur!r}".encode())
+    return CityBundle(
+        city, dataset_date,
+        data=joblib.load(f"{path}/APP_data_engineered.pkl") if data is None else data,
+        model=joblib.load(f"{path}/APP_best_model.pkl"),
+        preprocessor=joblib.load(f"{path}/APP_preprocessor.pkl"),
+        X_test=joblib.load(f"{path}/APP_X_test.pkl"),
+        MAPE_median=joblib.load(f"{path}/APP_MAPE_median.pkl"),
+        zipcodes=joblib.load(f"{path}/APP_zipcode.pkl"),
+        usd_eur=usd_eur,
+        version=f"pkl-{stamp.hexdigest()[:12]}",
+        source=path)
+
+
+# Writing compiled bundles
+
+def _table_sections(name, df):
+    """Split a DataFrame into raw column buffers; returns (table manifest, [(section name, bytes)])."""
+    columns, sections = [], []
+    index = df.index.to_series()
+    for pos, (col, series) in enumerate([("__index__", index)] + list(df.items())):
+        section = f"{name}/{pos}"
+        entry = {'name': col, 'section': section}
+        if series.dtype == object or str(series.dtype) == 'category':
+            codes, categories = pd.factorize(series, sort=True)
+            entry.update(kind='categorical', dtype='<i4', categories=[str(c) for c in categories])
+            values = codes.astype('<i4')
+        else:
+            values = np.ascontiguousarray(series.to_numpy())
+            entry.update(kind='numeric', dtype=values.dtype.str)
+        columns.append(entry)
+        sections.append((section, values.tobytes()))
+    table = {'nrows': len(df), 'index_name': df.index.name, 'columns': columns}
+    return table, sections
+
+
+def _model_section(model):
+    booster = model.get_booster()
+    params = {k: v for k, v in model.get_params().items() if isinstance(v, (int, float, str, bool, type(None)))}
+    return {'class': type(model).__name__, 'params': params}, bytes(booster.save_raw())
+
+
+def compile_bundle(city, dataset_date, data_dir=DATA_DIR, out=None):
+    """Compile the APP_*.pkl files of one city snapshot into a single APP_bundle.bin."""
+    source = load_pickles(city, dataset_date, data_dir)
+    out = out or f"{bundle_dir(city, dataset_date, data_dir)}/{BUNDLE_FILE}"
+
+    sections = []
+    tables = {}
+    for name, df in [('data', source.data), ('X_test', source.X_test)]:
+        tables[name], table_sections = _table_sections(name, df)
+        sections += table_sections
+    model_meta, booster_raw = _model_section(source.model)
+    sections.append(('model', booster_raw))
+    # There is no native format for the fitted sklearn preprocessor, so it stays a (small) pickle
+    sections.append(('preprocessor', pickle.dumps(source.preprocessor, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    digest = hashlib.sha256()
+    for section, payload in sections:
+        digest.update(section.encode())
+        digest.update(payload)
+    digest.update(f"usd_eur:{source.usd_eur!r}".encode())
+    manifest = {
+        'city': city,
+        'dataset_date': dataset_date,
+        'bundle_version': f"v{FORMAT_VERSION}-{digest.hexdigest()[:12]}",
+        'MAPE_median': float(source.MAPE_median),
+        'zipcodes': list(source.zipcodes),
+        'usd_eur': source.usd_eur,
+        'tables': tables,
+        'model': model_meta,
+    }
+
+    write_sections(out, manifest, sections)
+    return out, manifest['bundle_version']
+
+
+def write_sections(out, manifest, sections, magic=MAGIC):
+    """Write header, manifest and aligned (name, bytes) sections to `out`, replacing it atomically."""
+    # Section offsets are relative to the (aligned) end of the manifest, so they are known
+    # before the manifest's own length is
+    manifest['sections'] = {}
+    offset = 0
+    for section, payload in sections:
+        manifest['sections'][section] = {'offset': offset, 'nbytes': len(payload)}
+        offset += len(payload) + (-len(payload)) % ALIGNMENT
+    manifest_raw = json.dumps(manifest).encode()
+    data_start = HEADER.size + len(manifest_raw)
+    data_start += (-data_start) % ALIGNMENT
+
+    tmp = f"{out}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(magic, FORMAT_VERSION, len(manifest_raw)))
+        f.write(manifest_raw)
+        f.write(b"\0" * (data_start - f.tell()))
+        for section, payload in sections:
+            f.write(payload)
+            f.write(b"\0" * ((-len(payload)) % ALIGNMENT))
+    # Atomic replace: workers that still map the previous file keep reading its old inode
+    os.replace(tmp, out)
+
+
+# Reading compiled bundles
+
+def read_manifest(path, magic=MAGIC, kind="city bundle"):
+    with open(path, 'rb') as f:
+        file_magic, version, manifest_len = HEADER.unpack(f.read(HEADER.size))
+        if file_magic != magic:
+            raise ValueError(f"{path} is not a {kind}")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"{path} has {kind} format {version}, expected {FORMAT_VERSION}")
+        manifest = json.loads(f.read(manifest_len))
+    data_start = HEADER.size + manifest_len
+    data_start += (-data_start) % ALIGNMENT
+    return manifest, data_start
+
+
+def _section_buffer(buffer, manifest, data_start, section):
+    meta = manifest['sections'][section]
+    start = data_start + meta['offset']
+    return buffer[start:start + meta['nbytes']]
+
+
+def _read_table(buffer, manifest, data_start, name):
+    table = manifest['tables'][name]
+    columns = {}
+    for entry in table['columns']:
+        values = np.frombuffer(_section_buffer(buffer, manifest, data_start, entry['section']),
+                               dtype=np.dtype(entry['dtype']), count=table['nrows'])
+        if entry['kind'] == 'categorical':
+            values = pd.Categorical.from_codes(values, categories=entry['categories'])
+        columns[entry['name']] = values
+    index = pd.Index(columns.pop("__index__"), name=table['index_name'])
+    # Every column becomes its own block over the mapped file; a pandas that consolidates
+    # same-dtype columns into new 2-D blocks would copy them into each worker's heap
+    frame = pd.DataFrame(columns, index=index, copy=False)
+    copied = [col for col in frame.columns if not is_mapped_view(frame[col], buffer)]
+    if copied:
+        logger.warning("%s columns of %s were copied instead of mapped (pandas %s): %s",
+                       len(copied), name, pd.__version__, ", ".join(map(str, copied)))
+    return frame
+
+
+def is_mapped_view(series, buffer):
+    """Whether the values of a column (codes of a categorical) are a view into the mapped buffer."""
+    values = series.array.codes if isinstance(series.dtype, pd.CategoricalDtype) else series.to_numpy()
+    return np.shares_memory(values, np.frombuffer(buffer, dtype=np.uint8))
+
+
+def _read_model(buffer, manifest, data_start):
+    import xgboost as xgb
+
+    model_meta = manifest['model']
+    booster = xgb.Booster()
+    booster.load_model(bytearray(_section_buffer(buffer, manifest, data_start, 'model')))
+    model = getattr(xgb, model_meta['class'])(**model_meta['params'])
+    model._Booster = booster
+    return model
+
+
+def map_file(path):
+    with open(path, 'rb') as f:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def read_data_table(city, dataset_date, data_dir=DATA_DIR):
+    """Listings table (APP_data_engineered) of a snapshot, without loading the rest of its bundle."""
+    path = bundle_dir(city, dataset_date, data_dir)
+    if os.path.exists(f"{path}/{BUNDLE_FILE}"):
+        manifest, data_start = read_manifest(f"{path}/{BUNDLE_FILE}")
+        return _read_table(map_file(f"{path}/{BUNDLE_FILE}"), manifest, data_start, 'data')
+    return joblib.load(f"{path}/APP_data_engineered.pkl")
+
+
+def read_bundle(path, data=None):
+    """Memory-map a compiled bundle; table columns are read-only views onto the mapped file."""
+    manifest, data_start = read_manifest(path)
+    buffer = map_file(path)
+    return CityBundle(
+        manifest['city'], manifest['dataset_date'],
+        data=_read_table(buffer, manifest, data_start, 'data') if data is None else data,
+        model=_read_model(buffer, manifest, data_start),
+        preprocessor=pickle.loads(_section_buffer(buffer, manifest, data_start, 'preprocessor')),
+        X_test=_read_table(buffer, manifest, data_start, 'X_test'),
+        MAPE_median=manifest['MAPE_median'],
+        zipcodes=manifest['zipcodes'],
+        # Bundles compiled before the rate was pinned fall back to the snapshot's rate file
+        usd_eur=manifest.get('usd_eur') or load_rate(os.path.dirname(path), manifest['dataset_date']),
+        version=manifest['bundle_version'],
+        source=path)
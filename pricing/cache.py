@@ -0,0 +1,124 @@
+"""Prediction cache shared by all gunicorn workers of a host.
+
+The pricing inputs are all discrete (sliders with fixed steps, dropdowns and switches), so the
+same configurations come back constantly. Results are stored in a small SQLite database (WAL
+mode, so readers do not block each other) keyed on the normalized inputs, the city and the
+pricing version of the city's bundle (its version plus that of its segment bands); a new bundle
+or APP_segments.npz therefore never serves stale prices.
+Entries expire after `ttl` seconds and the least recently used ones are dropped beyond
+`max_entries`. Lookups are pure reads, so workers do not queue on SQLite's write lock: an
+entry's access time is only refreshed once it is more than TOUCH_INTERVAL seconds old, and
+hits and misses are counted per process (and exported through pricing.metrics). Any SQLite
+error is logged and treated as a miss so the cache can never break a prediction.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), "airbnb_price_cache.sqlite")
+TRIM_EVERY = 100  # puts between two checks of the cache size
+# Seconds after which a hit refreshes the entry's access time; LRU eviction is only this precise
+TOUCH_INTERVAL = 60
+
+
+def normalize(value):
+    """Make equal slider/switch values produce identical keys (True vs 1, 2 vs 2.0, 0.1+0.2 vs 0.3)."""
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        value = round(float(value), 6)
+        return int(value) if value.is_integer() else value
+    return str(value)
+
+
+def make_key(city, version, inputs):
+    raw = json.dumps([city, version, [normalize(v) for v in inputs]], separators=(',', ':'))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+class PredictionCache:
+
+    def __init__(self, path=None, max_entries=100000, ttl=24 * 3600):
+        self.path = path or DEFAULT_PATH
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = max_entries > 0
+        self._local = threading.local()
+        self._puts = 0
+        # Counters of this process
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        # One connection per thread and process (connections must not cross a fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache "
+                         "(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, city, version, inputs):
+        """Return the cached value or None."""
+        if not self.enabled:
+            return None
+        key = make_key(city, version, inputs)
+        now = time.time()
+        try:
+            conn = self._connection()
+            row = conn.execute("SELECT value, created, accessed FROM cache WHERE key = ?", (key,)).fetchone()
+            # Expired entries are left to trim() and replaced by the next put()
+            if row is not None and now - row[1] <= self.ttl:
+                if now - row[2] > TOUCH_INTERVAL:
+                    conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return json.loads(row[0])
+        except sqlite3.Error:
+            logger.exception("Prediction cache lookup failed")
+        self.misses += 1
+        return None
+
+    def put(self, city, version, inputs, value):
+        if not self.enabled:
+            return
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                         (make_key(city, version, inputs), json.dumps(value), now, now))
+            self._puts += 1
+            if self._puts % TRIM_EVERY == 0:
+                self.trim()
+        except sqlite3.Error:
+            logger.exception("Prediction cache update failed")
+
+    def trim(self):
+        """Drop expired entries and the least recently used ones beyond max_entries."""
+        conn = self._connection()
+        conn.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,))
+        excess = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+        if excess > 0:
+            conn.execute("DELETE FROM cache WHERE key IN "
+                         "(SELECT key FROM cache ORDER BY accessed LIMIT ?)", (excess,))
+
+    def stats(self):
+        stats = {'hits': self.hits, 'misses': self.misses, 'enabled': self.enabled}
+        if self.enabled:
+            try:
+                conn = self._connection()
+                stats['entries'] = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            except sqlite3.Error:
+                logger.exception("Prediction cache stats failed")
+        return stats
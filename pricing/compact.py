@@ -0,0 +1,112 @@
+"""Compact in-memory tables of a loaded city bundle.
+
+APP_data_engineered holds every engineered feature as float64/object columns, but once a bundle
+is loaded (price, map grid and comparables index computed) the app only reads a few of them, and
+of APP_X_test only the column schema. compact_bundle, applied by load_bundle, replaces both:
+
+- listings: only LISTING_COLUMNS; strings become categoricals, integers the smallest integer
+  type and floats float32 where that is exact, or for APPROXIMATE columns where the values
+  still round to the same displayed digits (so maps, hovers and comparables do not change)
+- X_test: an empty frame with its columns and dtypes
+
+Columns that are read-only views onto a memory-mapped file (compiled bundle, snapshot store) are
+shared by all workers through the page cache and are kept as they are: a downcast would only
+turn them into private copies.
+
+    python -m pricing.compact    # memory of each city's tables before and after compaction
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from pricing.aggregates import TRACKED_COLUMNS
+from pricing.comparables import COMPARABLE_COLUMNS
+
+# Listing columns read after a bundle is loaded: map, aggregates and comparables
+LISTING_COLUMNS = list(dict.fromkeys(
+    ["listing_no", "latitude", "longitude", "price_log", "price", "accommodates", "bedrooms", "room_type",
+     "property_type", "occupancy_rate"] + TRACKED_COLUMNS + COMPARABLE_COLUMNS))
+# Float columns that may lose precision: digits shown in the app (None: not shown, e.g. price_log
+# only feeds the price computed at load)
+APPROXIMATE = {"latitude": 5, "longitude": 5, "occupancy_rate": 2, "price_log": None}
+
+
+def _same(a, b):
+    return bool(np.all((a == b) | (np.isnan(a) & np.isnan(b))))
+
+
+def _mapped(values):
+    # Arrays created by np.frombuffer over a mapped file end in a memoryview instead of an array owning its data
+    base = values
+    while isinstance(base, np.ndarray) and base.base is not None:
+        base = base.base
+    return not isinstance(base, np.ndarray)
+
+
+def compact_column(series, decimals=False):
+    """Smaller representation of a column with the same visible values (the column itself if none).
+
+    decimals: False if values must stay exact, otherwise the digits they are shown with (None: not shown).
+    """
+    if series.dtype == object:
+        return series.astype('category')
+    if series.dtype.kind not in 'iuf' or series.dtype == np.float32 or _mapped(series.to_numpy()):
+        return series
+    if series.dtype.kind in 'iu':
+        return pd.to_numeric(series, downcast='integer' if series.dtype.kind == 'i' else 'unsigned')
+    values = series.to_numpy()
+    single = values.astype(np.float32)
+    wide = single.astype(values.dtype)
+    if decimals is None or _same(wide, values):
+        return pd.Series(single, index=series.index, name=series.name)
+    if decimals is not False and _same(np.round(wide, decimals), np.round(values, decimals)):
+        return pd.Series(single, index=series.index, name=series.name)
+    return series
+
+
+def compact_frame(df, columns=None, approximate=None):
+    """`df` reduced to `columns` (default: all) with every column compacted (see compact_column)."""
+    approximate = approximate or {}
+    keep = [col for col in df.columns if columns is None or col in columns]
+    # copy=False keeps the columns left as they are (e.g. mapped ones) as views
+    return pd.DataFrame({col: compact_column(df[col], approximate.get(col, False)) for col in keep},
+                        index=df.index, copy=False)
+
+
+def table_bytes(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+def compact_bundle(bundle):
+    """Replace the bundle's tables by compact ones; returns their bytes before and after."""
+    before = {'data': table_bytes(bundle.data), 'X_test': table_bytes(bundle.X_test)}
+    bundle.data = compact_frame(bundle.data, LISTING_COLUMNS, APPROXIMATE)
+    bundle.X_test = bundle.X_test.iloc[:0].copy()
+    after = {'data': table_bytes(bundle.data), 'X_test': table_bytes(bundle.X_test)}
+    return {'before': before, 'after': after}
+
+
+def main(argv=None):
+    # pricing.bundle imports this module to compact the bundles it loads
+    from pricing.bundle import DATA_DIR, find_bundle_snapshots, load_bundle
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    args = parser.parse_args(argv)
+
+    total_before = total_after = 0
+    for city, dataset_date in find_bundle_snapshots(args.data_dir):
+        bundle = load_bundle(city, dataset_date, args.data_dir, compact=False)
+        stats = compact_bundle(bundle)
+        before, after = sum(stats['before'].values()), sum(stats['after'].values())
+        total_before, total_after = total_before + before, total_after + after
+        print(f"{city:<10} {dataset_date}: listings {stats['before']['data'] / 1e6:6.1f} -> "
+              f"{stats['after']['data'] / 1e6:5.1f} MB, X_test {stats['before']['X_test'] / 1e6:5.1f} -> "
+              f"{stats['after']['X_test'] / 1e6:4.1f} MB ({1 - after / before:.0%} less)")
+    if total_before:
+        print(f"total: {total_before / 1e6:.1f} -> {total_after / 1e6:.1f} MB per worker holding every city")
+
+
+if __name__ == '__main__':
+    main()
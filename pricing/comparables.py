@@ -0,0 +1,75 @@
+"""Most similar real listings of a priced configuration, from the listings of its city snapshot.
+
+ComparablesIndex places the listings of APP_data_engineered in the model's input space (the
+city's FeatureEncoder: scaled numeric features and one-hot categories, e.g. zipcode) and builds
+one KD-tree per room type when the bundle is loaded. A query encodes the listing inputs like a
+prediction does and only searches the tree of the listing's own room type, so its cost grows
+with log(listings) instead of scanning the whole table.
+"""
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+
+# URL scheme of a listing, as used by the "Map of all Listings" tab
+LISTING_URL = "https://www.airbnb.com/rooms/{}"
+# Columns returned for each comparable listing
+COMPARABLE_COLUMNS = ["listing_no", "price", "accommodates", "bedrooms", "zipcode", "room_type"]
+
+
+def listing_url(listing_no):
+    return LISTING_URL.format(listing_no)
+
+
+class ComparablesIndex:
+
+    def __init__(self, encoder, data, partition="room_type", leaf_size=40):
+        self.encoder = encoder
+        self.partition = partition
+        features = {col: np.asarray(data[col], dtype=object) for col in encoder.cat_columns}
+        features.update({col: data[col].to_numpy(dtype=float) for col in encoder.num_columns})
+        X = encoder.transform(features, sparse=False, unknown='ignore')
+        # The one-hot block of the partition column is constant within a tree
+        self.keep = np.ones(encoder.width, dtype=bool)
+        for col, lookup in encoder.lookups:
+            if col == partition:
+                self.keep[[pos for pos in lookup.values() if pos >= 0]] = False
+        X = X[:, self.keep]
+
+        values = np.asarray(data[partition], dtype=object)
+        self.trees = {}
+        for value in pd.unique(values):
+            rows = np.flatnonzero(values == value)
+            self.trees[value] = (rows, KDTree(X[rows], leaf_size=leaf_size))
+
+    def query(self, listings, k=10):
+        """Data rows of the k listings closest to each listing input (same room type, nearest first).
+
+        Returns a list of row arrays (empty for a room type without listings) and one of distances.
+        """
+        X = self.encoder.encode(listings, sparse=False)[:, self.keep]
+        values = np.asarray(listings[self.partition], dtype=object)
+        rows = [np.empty(0, dtype=np.intp)] * len(X)
+        distances = [np.empty(0)] * len(X)
+        for value in pd.unique(values):
+            if value not in self.trees:
+                continue
+            tree_rows, tree = self.trees[value]
+            positions = np.flatnonzero(values == value)
+            dist, idx = tree.query(X[positions], k=min(k, len(tree_rows)))
+            for pos, pos_dist, pos_idx in zip(positions, dist, idx):
+                rows[pos] = tree_rows[pos_idx]
+                distances[pos] = pos_dist
+        return rows, distances
+
+
+def describe_comparables(data, rows, distances):
+    """Comparable listings as dicts (COMPARABLE_COLUMNS, url and distance), nearest first."""
+    table = data.iloc[rows][[col for col in COMPARABLE_COLUMNS if col in data]]
+    results = []
+    for record, distance in zip(table.to_dict('records'), distances):
+        record = {key: value.item() if hasattr(value, 'item') else value for key, value in record.items()}
+        record['listing_no'] = int(record['listing_no'])
+        record['url'] = listing_url(record['listing_no'])
+        record['distance'] = round(float(distance), 3)
+        results.append(record)
+    return results
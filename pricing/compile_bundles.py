@@ -0,0 +1,49 @@
+"""Compile the APP_*.pkl files of each city snapshot into a single APP_bundle.bin.
+
+Takes over the role of the save_load(..., file_format="app") cells of 3_App_Preparation.ipynb
+for the web app: once the pickles of a city/date have been saved there, run e.g.
+
+    python -m pricing.compile_bundles                      # all data/<city>_<date> folders
+    python -m pricing.compile_bundles --city paris --date 2020-03-16
+"""
+import argparse
+import glob
+import os
+import time
+
+from pricing.bundle import DATA_DIR, compile_bundle
+
+
+def find_snapshots(data_dir=DATA_DIR, city=None, dataset_date=None):
+    """List (city, date) of all folders in data_dir that contain the app's pickles."""
+    snapshots = []
+    for path in sorted(glob.glob(f"{data_dir}/*_*/APP_best_model.pkl")):
+        folder = os.path.basename(os.path.dirname(path))
+        snap_city, snap_date = folder.rsplit("_", 1)
+        if city and snap_city != city:
+            continue
+        if dataset_date and snap_date != dataset_date:
+            continue
+        snapshots.append((snap_city, snap_date))
+    return snapshots
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--city", help="only compile this city")
+    parser.add_argument("--date", help="only compile this snapshot date (YYYY-MM-DD)")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    args = parser.parse_args(argv)
+
+    snapshots = find_snapshots(args.data_dir, args.city, args.date)
+    if not snapshots:
+        parser.error(f"no city snapshots with APP_*.pkl files found in {args.data_dir}")
+    for city, dataset_date in snapshots:
+        start = time.perf_counter()
+        out, version = compile_bundle(city, dataset_date, data_dir=args.data_dir)
+        print(f"{city} {dataset_date}: wrote {out} ({os.path.getsize(out) / 1e6:.1f} MB, "
+              f"version {version}) in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
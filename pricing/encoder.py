@@ -0,0 +1,136 @@
+"""Numpy replacement for the fitted preprocessor of a city, compiled when its bundle is loaded.
+
+The preprocessor built in 1_Predictive_Modeling.ipynb is a ColumnTransformer of
+    num: SimpleImputer(median) -> StandardScaler
+    cat: SimpleImputer(constant) -> OneHotEncoder(drop='first')
+FeatureEncoder keeps only the fitted numbers of these steps (medians, means, scales and a
+category -> output column lookup per categorical column) and produces the model input matrix
+directly, without building a pandas DataFrame for every pricing request. Like the
+preprocessor it returns a sparse matrix where the preprocessor does (sparse_output_), which
+matters to xgboost: entries missing from a sparse matrix are treated as missing values, not 0.
+
+Check it against preprocessor.transform on each city's APP_X_test with
+
+    python -m pricing.encoder
+"""
+import argparse
+
+import numpy as np
+from scipy import sparse as sp
+
+from pricing.features import numeric_feature
+
+
+class FeatureEncoder:
+
+    def __init__(self, preprocessor):
+        self.num_columns, self.cat_columns, self.lookups = [], [], []
+        categories, drop_idx = [], []
+        self.fill_value = None
+        self.sparse_output = bool(getattr(preprocessor, 'sparse_output_', False))
+        for name, transformer, columns in preprocessor.transformers_:
+            if name == 'remainder' and transformer == 'drop':
+                continue
+            if name == 'num':
+                imputer = transformer.named_steps['imputer_num']
+                scaler = transformer.named_steps['std_scaler']
+                self.num_columns = list(columns)
+                self.medians = np.asarray(imputer.statistics_, dtype=float)
+                self.mean = scaler.mean_ if scaler.with_mean else np.zeros(len(columns))
+                self.scale = scaler.scale_ if scaler.with_std else np.ones(len(columns))
+            elif name == 'cat':
+                self.cat_columns = list(columns)
+                self.fill_value = transformer.named_steps['imputer_cat'].fill_value
+                onehot = transformer.named_steps['1hot']
+                categories = onehot.categories_
+                drop_idx = getattr(onehot, 'drop_idx_', None)
+                drop_idx = [None] * len(columns) if drop_idx is None else list(drop_idx)
+            else:
+                raise ValueError(f"Unsupported preprocessor step {name!r}")
+
+        # Output columns: scaled numeric features, then the one-hot block of each categorical
+        # column without its dropped first category (lookup value -1)
+        offset = len(self.num_columns)
+        for col, col_categories, dropped in zip(self.cat_columns, categories, drop_idx):
+            lookup = {}
+            for k, category in enumerate(col_categories):
+                if dropped is not None and k == dropped:
+                    lookup[category] = -1
+                else:
+                    lookup[category] = offset
+                    offset += 1
+            self.lookups.append((col, lookup))
+        self.width = offset
+        self.categories = {col: set(lookup) for col, lookup in self.lookups}
+
+    def transform(self, features, sparse=None, unknown='error'):
+        """Equivalent of preprocessor.transform for model features (DataFrame or dict of sequences).
+
+        sparse=False returns a dense array even if the preprocessor's output is sparse.
+        unknown='ignore' leaves the one-hot block of an unknown category empty instead of raising.
+        """
+        n = len(features[self.num_columns[0] if self.num_columns else self.cat_columns[0]])
+        out = np.zeros((n, self.width))
+        if self.num_columns:
+            num = np.column_stack([np.asarray(features[col], dtype=float) for col in self.num_columns])
+            num = np.where(np.isnan(num), self.medians, num)
+            out[:, :len(self.num_columns)] = (num - self.mean) / self.scale
+        for col, lookup in self.lookups:
+            for i, value in enumerate(features[col]):
+                if value is None or value != value:
+                    value = self.fill_value
+                pos = lookup.get(value)
+                if pos is None:
+                    if unknown == 'ignore':
+                        continue
+                    raise ValueError(f"unknown value for '{col}': {value!r}")
+                if pos >= 0:
+                    out[i, pos] = 1.0
+        if self.sparse_output if sparse is None else sparse:
+            return sp.csr_matrix(out)
+        return out
+
+    def encode(self, listings, sparse=None):
+        """Model input matrix straight from listing inputs (see pricing.features.LISTING_INPUTS)."""
+        features = {col: numeric_feature(listings, col) for col in self.num_columns}
+        features.update({col: listings[col] for col in self.cat_columns})
+        return self.transform(features, sparse=sparse)
+
+
+def check_parity(preprocessor, X_test):
+    """Largest absolute difference between the encoder and preprocessor.transform on X_test."""
+    expected = preprocessor.transform(X_test)
+    actual = FeatureEncoder(preprocessor).transform(X_test)
+    if sp.issparse(expected) != sp.issparse(actual):
+        raise AssertionError("encoder and preprocessor disagree on sparse output")
+    if sp.issparse(expected):
+        expected, actual = expected.toarray(), actual.toarray()
+    if expected.shape != actual.shape:
+        raise AssertionError(f"shape {actual.shape} != {expected.shape}")
+    return float(np.abs(expected - actual).max())
+
+
+def main(argv=None):
+    import joblib
+
+    from pricing.bundle import DATA_DIR, bundle_dir
+    from pricing.compile_bundles import find_snapshots
+
+    parser = argparse.ArgumentParser(description="Check FeatureEncoder against preprocessor.transform on X_test")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--atol", type=float, default=1e-12)
+    args = parser.parse_args(argv)
+
+    failed = False
+    for city, dataset_date in find_snapshots(args.data_dir):
+        path = bundle_dir(city, dataset_date, args.data_dir)
+        diff = check_parity(joblib.load(f"{path}/APP_preprocessor.pkl"), joblib.load(f"{path}/APP_X_test.pkl"))
+        ok = diff <= args.atol
+        failed |= not ok
+        print(f"{city:<10} {dataset_date}: max abs diff {diff:.3g} {'OK' if ok else 'MISMATCH'}")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Feature math of the pricing indication, shared by the Dash callback and the batch API.
+
+Listing inputs are named like the input components of the "Pricing Indicator" tab. A few of
+them are transformed before they reach the preprocessor, mirroring the feature engineering of
+1_Predictive_Modeling.ipynb (e.g. "bathrooms_log" is entered as a number of bathrooms).
+"""
+import numpy as np
+import pandas as pd
+
+# Inputs of one listing (arguments of the predict callback apart from the city)
+LISTING_INPUTS = [
+    "accommodates", "am_balcony", "am_breakfast", "am_child_friendly", "am_elevator", "am_essentials",
+    "am_pets_allowed", "am_private_entrance", "am_smoking_allowed", "am_tv", "bathrooms_log", "bedrooms", "beds",
+    "calc_host_lst_count_sqrt_log", "cancellation_policy", "guests_included_calc", "host_is_superhost",
+    "instant_bookable", "maximum_nights", "minimum_nights_sqrt", "property_type", "room_type", "wk_mth_discount",
+    "zipcode", "occupancy_rate"
+]
+
+# Default value of each input in the web app
+LISTING_DEFAULTS = {
+    "accommodates": 2, "am_balcony": False, "am_breakfast": False, "am_child_friendly": False,
+    "am_elevator": False, "am_essentials": True, "am_pets_allowed": False, "am_private_entrance": False,
+    "am_smoking_allowed": False, "am_tv": False, "bathrooms_log": 1, "bedrooms": 1, "beds": 1,
+    "calc_host_lst_count_sqrt_log": 0, "cancellation_policy": "flexible", "guests_included_calc": 2,
+    "host_is_superhost": False, "instant_bookable": False, "maximum_nights": 1125, "minimum_nights_sqrt": 1,
+    "property_type": "Apartment", "room_type": "Entire home/apt", "wk_mth_discount": 0, "zipcode": "zip_other",
+    "occupancy_rate": 0.3
+}
+
+BINARY_FEATURES = ["am_balcony", "am_breakfast", "am_child_friendly", "am_elevator", "am_essentials",
+                   "am_pets_allowed", "am_private_entrance", "am_smoking_allowed", "am_tv",
+                   "host_is_superhost", "instant_bookable"]
+CATEGORICAL_FEATURES = ["cancellation_policy", "property_type", "room_type", "zipcode"]
+NUMERIC_INPUTS = [col for col in LISTING_INPUTS if col not in BINARY_FEATURES + CATEGORICAL_FEATURES]
+
+
+def _floats(values):
+    return np.asarray(values, dtype=float)
+
+
+def is_hashable(value):
+    """Whether value can be looked up in a set, e.g. not a JSON list or object."""
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def _is_binary(value):
+    # Switches send booleans; JSON clients may send 0/1 as well
+    if isinstance(value, (bool, np.bool_)):
+        return True
+    return isinstance(value, (int, float, np.integer, np.floating)) and value in (0, 1)
+
+
+# Model features computed from listing inputs (the others are taken as entered)
+DERIVED_FEATURES = {
+    'accommodates_per_bed': lambda raw: _floats(raw['accommodates']) / _floats(raw['beds']),
+    'bathrooms_log': lambda raw: np.log(np.trunc(_floats(raw['bathrooms_log']))),
+    'calc_host_lst_count_sqrt_log': lambda raw: np.log(np.sqrt(_floats(raw['calc_host_lst_count_sqrt_log']) + 1)),
+    'minimum_nights_sqrt': lambda raw: np.sqrt(_floats(raw['minimum_nights_sqrt'])),
+}
+
+
+def numeric_feature(listings, col):
+    """Values of numeric/binary model feature `col` for listings (DataFrame or dict of sequences)."""
+    if col in DERIVED_FEATURES:
+        return DERIVED_FEATURES[col](listings)
+    return _floats(listings[col])
+
+
+def known_categories(preprocessor):
+    """Categories the fitted one-hot encoder of the preprocessor accepts, per column."""
+    for name, transformer, columns in preprocessor.transformers_:
+        if name == 'cat':
+            encoder = transformer.named_steps['1hot']
+            return {col: set(cats) for col, cats in zip(columns, encoder.categories_)}
+    return {}
+
+
+def validate_listings(listings, categories):
+    """Return an error message per listing (None where it can be priced).
+
+    listings is a DataFrame or a dict of equally long sequences keyed by LISTING_INPUTS;
+    categories are the accepted values per categorical column (see known_categories).
+    """
+    n = len(listings[LISTING_INPUTS[0]])
+    errors = [None] * n
+
+    def flag(mask, message):
+        for i in np.flatnonzero(mask):
+            if errors[i] is None:
+                errors[i] = message
+
+    for col in LISTING_INPUTS:
+        flag(pd.isnull(np.asarray(listings[col], dtype=object)), f"missing value for '{col}'")
+    numeric = {col: pd.to_numeric(np.asarray(listings[col], dtype=object), errors='coerce')
+               for col in NUMERIC_INPUTS}
+    for col in NUMERIC_INPUTS:
+        flag(np.isnan(numeric[col]), f"'{col}' must be a number")
+    for col in BINARY_FEATURES:
+        flag([not _is_binary(value) for value in listings[col]], f"'{col}' must be true/false or 0/1")
+    with np.errstate(invalid='ignore'):
+        # The app takes the log of the whole number of bathrooms, so fewer than one is invalid
+        flag(numeric['bathrooms_log'] < 1, "'bathrooms_log' must be at least 1")
+        flag(numeric['beds'] <= 0, "'beds' must be positive")
+        flag(numeric['minimum_nights_sqrt'] < 0, "'minimum_nights_sqrt' must not be negative")
+        flag(numeric['calc_host_lst_count_sqrt_log'] < 0, "'calc_host_lst_count_sqrt_log' must not be negative")
+    for col, accepted in categories.items():
+        flag([not is_hashable(value) or value not in accepted for value in listings[col]],
+             f"unknown value for '{col}'")
+    return errors
+
+
+def model_frame(listings, columns):
+    """Build the preprocessor's input frame (with `columns`, i.e. X_test.columns) from listing inputs."""
+    frame = pd.DataFrame(index=listings.index)
+    for col in columns:
+        if col in CATEGORICAL_FEATURES:
+            frame[col] = listings[col]
+        else:
+            frame[col] = numeric_feature(listings, col)
+    return frame
+
+
+def eur_prices(y_log, usd_eur):
+    """Whole EUR prices for log prices in USD, converted with the snapshot's pinned rate."""
+    return np.rint(np.exp(np.asarray(y_log, dtype=float)) * usd_eur).astype(int)
+
+
+def price_indication(y_pred, MAPE_median, usd_eur):
+    """Turn predicted log prices (USD) into EUR price, lower and upper bound of the sensible range.
+
+    The range is the MAPE median of the city's model applied to the log price.
+    """
+    y_pred = np.asarray(y_pred, dtype=float)
+    price = eur_prices(y_pred, usd_eur)
+    low = eur_prices(y_pred - y_pred * MAPE_median, usd_eur)
+    high = eur_prices(y_pred + y_pred * MAPE_median, usd_eur)
+    return price.tolist(), low.tolist(), high.tolist()
+
+
+def yearly_earnings(price, occupancy_rate):
+    return round(price * 365 * occupancy_rate)
@@ -0,0 +1,175 @@
+"""Per-snapshot cache of serialized figures, e.g. the listings map of the "Map" tab.
+
+Building a figure with plotly express for every listing of a city takes much longer than
+sending it, and its content only depends on the city bundle. FigureCache builds it once per
+city snapshot, serializes it to JSON and keeps the decoded plain-Python figure, which Dash
+encodes far faster than a figure object holding numpy arrays. An entry is rebuilt when the
+bundle of its snapshot has a different version. subset_points cuts a cached figure down to
+the listings in the current map viewport (see pricing.spatial) and aggregate_figure shows
+grid bins or areas instead of listings (see pricing.aggregates).
+
+To keep payloads small, a per-listing trace can be split by a categorical hover field
+(split_by): each category gets its own trace with the category written once into the hover
+template instead of repeating the string for every listing.
+"""
+import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import plotly.io as pio
+
+logger = logging.getLogger(__name__)
+
+
+class FigureCache:
+
+    def __init__(self, build, max_entries=4, split_by=None):
+        # build(bundle) returns a plotly figure
+        self.build = build
+        self.split_by = split_by
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.builds = 0
+        self.hits = 0
+
+    def _lookup(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['version'] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            return None
+
+    def entry(self, bundle):
+        """Cached {'version', 'figure', 'trace_rows', 'nbytes'} of the bundle's figure, built if needed.
+
+        trace_rows holds the data rows of each point of a per-listing trace (None for other traces).
+        """
+        key = (bundle.city, bundle.dataset_date)
+        entry = self._lookup(key, bundle.version)
+        if entry is not None:
+            return entry
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            entry = self._lookup(key, bundle.version)
+            if entry is not None:
+                return entry
+            figure = json.loads(pio.to_json(self.build(bundle), validate=False))
+            n = len(bundle.data)
+            if self.split_by:
+                figure, trace_rows = split_by_category(figure, bundle.data[self.split_by], self.split_by)
+            else:
+                trace_rows = [np.arange(n) if len(trace.get('lat', ())) == n else None for trace in figure['data']]
+            nbytes = len(json.dumps(figure, separators=(',', ':')).encode())
+            entry = {'version': bundle.version, 'figure': figure, 'trace_rows': trace_rows, 'nbytes': nbytes}
+            with self._lock:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                self.builds += 1
+                logger.info("Built figure for %s_%s (%.1f MB)", *key, entry['nbytes'] / 1e6)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return entry
+
+    def get(self, bundle):
+        return self.entry(bundle)['figure']
+
+    def stats(self):
+        with self._lock:
+            return {
+                'builds': self.builds,
+                'hits': self.hits,
+                'entries': len(self._entries),
+                'nbytes': {f"{city}_{dataset_date}": entry['nbytes']
+                           for (city, dataset_date), entry in self._entries.items()},
+            }
+
+
+def _subset(value, rows, n):
+    if isinstance(value, list) and len(value) == n:
+        return [value[i] for i in rows]
+    if isinstance(value, dict):
+        return {key: _subset(item, rows, n) for key, item in value.items()}
+    return value
+
+
+def subset_points(entry, rows):
+    """Copy of a cached figure (FigureCache.entry) keeping only the points of data rows `rows`.
+
+    Every per-point array (lat, lon, marker.color, customdata, ...) of the per-listing traces
+    is subset, other traces are kept as they are.
+    """
+    data = []
+    for trace, trace_rows in zip(entry['figure']['data'], entry['trace_rows']):
+        if trace_rows is not None:
+            trace = _subset(trace, np.flatnonzero(np.isin(trace_rows, rows)), len(trace_rows))
+        data.append(trace)
+    return dict(entry['figure'], data=data)
+
+
+def split_by_category(figure, values, field):
+    """Split the per-listing trace of a plotly express figure into one trace per value of `field`.
+
+    `field` must be a hover_data column of the figure (shown through customdata) and values its
+    value per listing. Returns the figure and the data rows of each trace's points.
+    """
+    trace = figure['data'][0]
+    n = len(values)
+    template = trace['hovertemplate']
+    match = re.search(rf"{re.escape(field)}=%{{customdata\[(\d+)\]}}", template)
+    if match is None:
+        raise ValueError(f"{field!r} is not a hover field of the figure")
+    k = int(match.group(1))
+
+    def shift(ref):
+        # Later customdata columns move one position to the left
+        index = int(ref.group(1))
+        return f"%{{customdata[{index - 1 if index > k else index}]{ref.group(2)}}}"
+
+    codes, categories = pd.factorize(np.asarray(values, dtype=object), sort=True)
+    traces, trace_rows = [], []
+    for code in sorted(set(codes)):
+        rows = np.flatnonzero(codes == code)
+        label = categories[code] if code >= 0 else ""
+        part = _subset(trace, rows, n)
+        part['customdata'] = [row[:k] + row[k + 1:] for row in part['customdata']]
+        part['hovertemplate'] = re.sub(r"%\{customdata\[(\d+)\]([^}]*)\}", shift,
+                                       template.replace(match.group(0), f"{field}={label}"))
+        part['name'] = str(label)
+        part['showlegend'] = False
+        traces.append(part)
+        trace_rows.append(rows)
+    return dict(figure, data=traces + figure['data'][1:]), trace_rows + [None] * (len(figure['data']) - 1)
+
+
+def aggregate_figure(figure, table, label):
+    """Figure with one marker per group of an aggregate table (see pricing.aggregates).
+
+    Takes the layout (map, color axis, uirevision) of a cached listings figure; markers are
+    colored by median price and sized by the number of listings in the group.
+    """
+    counts = table['count'].to_numpy()
+    sizes = 6 + 24 * np.sqrt(counts / counts.max()) if len(counts) else counts
+    names = [str(name) for name in table.index] if label else [''] * len(table)
+    trace = {
+        'type': 'scattermapbox',
+        'mode': 'markers',
+        'lat': table.latitude.round(5).tolist(),
+        'lon': table.longitude.round(5).tolist(),
+        'text': names,
+        'customdata': np.column_stack([counts, table.price, table.occupancy_rate]).round(2).tolist(),
+        'marker': {'size': np.round(sizes, 1).tolist(), 'color': table.price.tolist(),
+                   'coloraxis': 'coloraxis', 'opacity': 0.8},
+        'hovertemplate': (f"<b>{label} %{{text}}</b><br>" if label else "")
+        + "listings=%{customdata[0]:.0f}<br>median price=%{customdata[1]:.0f}"
+          "<br>median occupancy_rate=%{customdata[2]:.2f}<extra></extra>",
+    }
+    return dict(figure, data=[trace])
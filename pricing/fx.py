@@ -0,0 +1,88 @@
+"""Pinned USD -> EUR exchange rate per city snapshot.
+
+The models predict USD prices and every snapshot is converted with a single rate: the ECB rate
+of the last business day on or before the snapshot date. It is resolved once with
+currency_converter and saved next to the city's other artifacts as APP_fx_rate.json (and in
+the compiled bundle), so the web app neither parses the ECB history at start-up nor converts
+prices one by one. Write the files of all snapshots with
+
+    python -m pricing.fx
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from datetime import date, timedelta
+
+FX_FILE = "APP_fx_rate.json"
+# Weekends and holidays have no ECB rate; look back at most this many days
+MAX_LOOKBACK = 7
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_rate(dataset_date, converter=None):
+    """USD -> EUR rate for a snapshot date (needs currency_converter); returns the rate file contents."""
+    from currency_converter import CurrencyConverter, RateNotFoundError
+
+    converter = converter or CurrencyConverter()
+    day = date.fromisoformat(dataset_date)
+    for _ in range(MAX_LOOKBACK):
+        try:
+            usd_eur = converter.convert(1, 'USD', 'EUR', date=day)
+        except RateNotFoundError:
+            day -= timedelta(days=1)
+            continue
+        return {'usd_eur': usd_eur, 'rate_date': day.isoformat(), 'dataset_date': dataset_date}
+    raise ValueError(f"No USD/EUR rate within {MAX_LOOKBACK} days before {dataset_date}")
+
+
+def write_rate(folder, dataset_date, converter=None):
+    rate = resolve_rate(dataset_date, converter)
+    path = f"{folder}/{FX_FILE}"
+    # Replace atomically so that a loading worker never reads a half-written file
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(rate, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+    return rate
+
+
+def load_rate(folder, dataset_date):
+    """Pinned USD -> EUR rate of the snapshot in folder, resolved in memory if it is not there.
+
+    Never writes the file: loading runs in the web workers, and a new file would change the
+    snapshot's artifact stamp and make the registry reload it. Pin missing rates with
+    `python -m pricing.fx` instead.
+    """
+    path = f"{folder}/{FX_FILE}"
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)['usd_eur']
+    logger.warning("%s missing, resolving the USD/EUR rate of %s (run python -m pricing.fx to pin it)",
+                   path, dataset_date)
+    return resolve_rate(dataset_date)['usd_eur']
+
+
+def main(argv=None):
+    from currency_converter import CurrencyConverter
+
+    from pricing.bundle import DATA_DIR, bundle_dir
+    from pricing.compile_bundles import find_snapshots
+
+    parser = argparse.ArgumentParser(description="Write the pinned USD/EUR rate of each city snapshot")
+    parser.add_argument("--city", help="only this city")
+    parser.add_argument("--date", help="only this snapshot date (YYYY-MM-DD)")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    converter = CurrencyConverter()
+    print(f"Loaded ECB history in {time.perf_counter() - start:.2f}s")
+    for city, dataset_date in find_snapshots(args.data_dir, args.city, args.date):
+        rate = write_rate(bundle_dir(city, dataset_date, args.data_dir), dataset_date, converter)
+        print(f"{city} {dataset_date}: 1 USD = {rate['usd_eur']:.6f} EUR ({rate['rate_date']})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+"""Ingest Inside Airbnb listings into the engineered feature table of a city snapshot.
+
+Scripted version of the data cleaning and feature engineering of 1_Predictive_Modeling.ipynb
+(cln_* and feat_* functions). listings.csv.gz is read in chunks with explicit dtypes; each
+chunk is cleaned as far as possible on its own (types, amenity flags, row filters) and its long
+text columns are reduced to the word counts/flags the features need, so only a compact table
+of the remaining listings is ever held in memory. Steps that need the whole city (median
+fills, rare zipcodes/neighbourhoods, maxima, occupancy from reviews) run on that table.
+
+Each city runs in its own process and the result is written as a columnar feature store,
+data/<city>_<date>/features.parquet (optionally also as APP_data_engineered.pkl for the app):
+
+    python -m pricing.ingest                            # all snapshots with a listings.csv.gz
+    python -m pricing.ingest --city berlin --date 2020-03-17 --app
+
+Prices are converted to EUR with the snapshot's pinned rate (see pricing.fx) instead of the
+notebook's fixed conversion date.
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import resource
+import time
+
+import numpy as np
+import pandas as pd
+
+from pricing.bundle import DATA_DIR, bundle_dir
+from pricing.fx import FX_FILE, load_rate, write_rate
+
+LISTINGS_FILE = "listings.csv.gz"
+REVIEWS_FILES = ["reviews.csv", "reviews.csv.gz"]
+FEATURE_FILE = "features.parquet"
+CHUNKSIZE = 10000
+
+# Assumed share of bookings that were followed up by a user review (see feat_occupancy)
+REVIEW_RATE = 0.5
+OCCUPANCY_DAYS = 90
+# Zipcodes/neighbourhoods with a smaller share of the listings become "zip_other"/"nb_other"
+RARE_SHARE = 0.0025
+
+# Columns kept from listings.csv.gz (select_columns of the notebook) and their dtypes
+LISTING_DTYPES = {
+    'id': 'int64', 'accommodates': 'int64', 'amenities': 'object', 'availability_365': 'int64',
+    'availability_90': 'int64', 'bathrooms': 'float64', 'bed_type': 'object', 'bedrooms': 'float64',
+    'beds': 'float64', 'calculated_host_listings_count': 'int64', 'cancellation_policy': 'object',
+    'cleaning_fee': 'object', 'description': 'object', 'experiences_offered': 'object', 'extra_people': 'object',
+    'first_review': 'object', 'guests_included': 'int64', 'has_availability': 'object',
+    'host_acceptance_rate': 'object', 'host_has_profile_pic': 'object', 'host_identity_verified': 'object',
+    'host_is_superhost': 'object', 'host_listings_count': 'float64', 'host_location': 'object',
+    'host_response_rate': 'object', 'host_response_time': 'object', 'house_rules': 'object',
+    'instant_bookable': 'object', 'interaction': 'object', 'is_business_travel_ready': 'object',
+    'is_location_exact': 'object', 'last_review': 'object', 'latitude': 'float64', 'listing_url': 'object',
+    'longitude': 'float64', 'maximum_nights': 'int64', 'minimum_nights': 'int64', 'monthly_price': 'object',
+    'name': 'object', 'neighborhood_overview': 'object', 'neighbourhood_cleansed': 'object', 'notes': 'object',
+    'number_of_reviews': 'int64', 'number_of_reviews_ltm': 'int64', 'price': 'object', 'property_type': 'object',
+    'require_guest_phone_verification': 'object', 'require_guest_profile_picture': 'object',
+    'requires_license': 'object', 'review_scores_accuracy': 'float64', 'review_scores_checkin': 'float64',
+    'review_scores_cleanliness': 'float64', 'review_scores_communication': 'float64',
+    'review_scores_location': 'float64', 'review_scores_rating': 'float64', 'review_scores_value': 'float64',
+    'reviews_per_month': 'float64', 'room_type': 'object', 'security_deposit': 'object', 'space': 'object',
+    'square_feet': 'float64', 'summary': 'object', 'transit': 'object', 'weekly_price': 'object',
+    'zipcode': 'object',
+}
+TEXT_COLUMNS = ["description", "house_rules", "interaction", "neighborhood_overview", "notes", "space", "summary",
+                "transit"]
+MONEY_COLUMNS = ["cleaning_fee", "extra_people", "monthly_price", "price", "security_deposit", "weekly_price"]
+REVIEW_SCORES = ["review_scores_rating", "review_scores_value", "review_scores_checkin", "review_scores_location",
+                 "review_scores_communication", "review_scores_accuracy", "review_scores_cleanliness"]
+AMENITIES = {
+    'am_balcony': 'Balcony|Patio',
+    'am_nature_and_views': 'Beach view|Beachfront|Lake access|Mountain view|Ski-in/Ski-out|Waterfront',
+    'am_breakfast': 'Breakfast',
+    'am_tv': 'TV',
+    'am_coffee_machine': 'Coffee maker|Espresso machine',
+    'am_cooking_basics': 'Cooking basics',
+    'am_white_goods': 'Dishwasher|Dryer|Washer',
+    'am_elevator': 'Elevator',
+    'am_essentials': 'Essentials',
+    'am_child_friendly': 'Family/kid friendly|Children|children',
+    'am_parking': 'parking',
+    'am_pets_allowed': 'Pets|pet|Cat(s)|Dog(s)',
+    'am_private_entrance': 'Private entrance',
+    'am_smoking_allowed': 'Smoking allowed',
+}
+CANCELLATION_POLICIES = {"strict_14_with_grace_period": "strict", "super_strict_60": "super_strict",
+                         "super_strict_30": "super_strict"}
+PROPERTY_TYPES = {
+    "Apartment": ["Condominium", "Loft", "Vacation home"],
+    "Boutique hotel": ["Aparthotel", "Hostel", "Hotel", "Resort", "Serviced apartment"],
+    "Bed and breakfast": ["Casa particular (Cuba)", "Farm stay", "Nature lodge", "Pension (South Korea)"],
+    "House": ["Bungalow", "Cabin", "Chalet", "Cottage", "Dome house", "Earth house", "Houseboat", "Hut",
+              "Lighthouse", "Tiny house", "Townhouse", "Villa"],
+    "Secondary unit": ["Guesthouse", "Guest suite"],
+    "Unique space": ["Barn", "Boat", "Bus", "Camper/RV", "Campsite", "Castle", "Cave", "Igloo", "Island", "Plane",
+                     "Tent", "Tipi", "Train", "Treehouse", "Windmill", "Yurt"],
+}
+# Columns dropped by cln_drop_cols and feat_drop_cols
+CLEAN_DROP = ["bed_type", "experiences_offered", "has_availability", "host_location", "requires_license",
+              "is_business_travel_ready", "host_has_profile_pic", "host_listings_count",
+              "require_guest_profile_picture", "require_guest_phone_verification", "reviews_per_month", "square_feet"]
+FEATURE_DROP = [
+    "active_months", "amenities", "am_coffee_machine", "am_cooking_basics", "am_parking", "availability_365",
+    "avg_nights", "bathrooms", "beds", "bookings_est", "calculated_host_listings_count", "cleaning_fee",
+    "descr_detail", "extra_people", "first_review", "first_review_days", "guests_included",
+    "host_identity_verified", "is_location_exact", "last_review", "last_review_days", "listing_url",
+    "minimum_nights", "monthly_price", "name", "number_of_reviews", "number_of_reviews_ltm", "price_calc",
+    "price_extra_fees", "review_scores_accuracy", "review_scores_checkin", "review_scores_cleanliness",
+    "review_scores_communication", "review_scores_rating", "review_scores_value", "reviews_3mth",
+    "security_deposit", "text_len", "weekly_price",
+] + [f"{col}_exist" for col in TEXT_COLUMNS] + [f"{col}_len" for col in TEXT_COLUMNS]
+
+
+def zipcode_labels(zipcodes, city):
+    """Zipcode categories as in cln_chg_datatypes (prefix length differs per city)."""
+    zipcodes = zipcodes.astype(str)
+    if city == "amsterdam":
+        return "zip_" + zipcodes.str[:4]
+    if city == "barcelona":
+        return "zip_0" + zipcodes.str[:4]
+    return "zip_" + zipcodes.str[:5]
+
+
+def _money(values):
+    return values.astype(str).str.strip("$").str.replace(",", "", regex=False).astype(float)
+
+
+def clean_chunk(chunk, city, dataset_date):
+    """Row-wise part of the data cleaning of one chunk of listings (indexed by id).
+
+    Returns the cleaned rows and the raw review scores of all rows of the chunk, which the
+    medians for filling missing scores are taken from.
+    """
+    raw_scores = chunk[REVIEW_SCORES].copy()
+    data = chunk
+
+    # cln_fill_missing_val (fills that do not depend on other listings)
+    for col in ["security_deposit", "cleaning_fee", "monthly_price", "weekly_price"]:
+        data[col] = data[col].fillna("0")
+    data['beds'] = data.beds.fillna(0)
+    data['beds'] = np.where((data.beds == 0) & (data.bed_type == "Real Bed"), 1, data.beds)
+    data['beds'] = np.where(data.beds == 0, 0.5, data.beds)
+    data['bathrooms'] = np.where(data.bathrooms == 0, 0.5, data.bathrooms)
+    data['bedrooms'] = np.where(data.bedrooms == 0, 0.5, data.bedrooms)
+    data['host_response_time'] = data.host_response_time.fillna("unknown")
+
+    # Text columns are only used through their existence and word count (feat_bin, feat_cat)
+    for col in TEXT_COLUMNS:
+        text = data.pop(col).fillna("")
+        data[f"{col}_exist"] = np.where(text != "", 1, 0)
+        data[f"{col}_len"] = [len(el.split()) for el in text]
+
+    # cln_chg_datatypes
+    for col in MONEY_COLUMNS:
+        data[col] = _money(data[col])
+    for col in ["host_acceptance_rate", "host_response_rate"]:
+        data[col] = pd.to_numeric(data[col].str.strip("%"), errors='coerce')
+    data['zipcode'] = zipcode_labels(data.zipcode, city)
+    data['last_review'] = data.last_review.where(~(data.last_review > dataset_date), dataset_date)
+    data = data[data.first_review <= dataset_date].copy()
+    data['first_review'] = pd.to_datetime(data.first_review)
+    data['last_review'] = pd.to_datetime(data.last_review)
+
+    # cln_sel_amenities
+    for col, pattern in AMENITIES.items():
+        data[col] = np.where(data.amenities.str.contains(pattern, na=False), 1.0, 0.0)
+
+    # cln_drop_rows
+    data = data.dropna(subset=["name", "host_is_superhost", "bedrooms", "bathrooms", "neighbourhood_cleansed",
+                               "zipcode"])
+    recent = pd.Timestamp(dataset_date) - pd.Timedelta(days=3 * 30)
+    keep = ((data.zipcode != "zip_nan") & (data.zipcode != "zip_0nan")
+            & (data.price < 500) & (data.price >= 10) & (data.minimum_nights <= 100)
+            & (data.accommodates - data.guests_included >= 0) & (data.accommodates <= 10)
+            & (data.accommodates - data.beds >= 0) & (data.bedrooms - data.beds <= 2)
+            & (data.beds - data.bedrooms <= 10)
+            & (data.monthly_price / data.price <= 30) & (data.weekly_price / data.price <= 7)
+            & (data.number_of_reviews_ltm != 0)
+            & ((data.availability_365 != 0) | (data.last_review > recent)))
+    return data[keep], raw_scores
+
+
+def _mask_rare(values, other):
+    counts = values.map(values.value_counts())
+    return values.mask(counts < RARE_SHARE * len(values), other)
+
+
+def _classes(values, bounds, default):
+    """Class 1, 2, ... for values up to each bound (class 0 for 0 where bounds start with 0)."""
+    conditions = [values <= bound if bound else values == 0 for bound in bounds]
+    labels = list(range(len(bounds))) if bounds[0] == 0 else list(range(1, len(bounds) + 1))
+    return np.select(conditions, labels, default)
+
+
+def count_recent_reviews(path, dataset_date, chunksize=10 * CHUNKSIZE):
+    """Reviews per listing in the OCCUPANCY_DAYS before dataset_date (streamed from a reviews file)."""
+    start = (pd.Timestamp(dataset_date) - pd.Timedelta(days=OCCUPANCY_DAYS)).strftime("%Y-%m-%d")
+    counts = pd.Series(dtype='int64')
+    for chunk in pd.read_csv(path, usecols=['listing_id', 'date'], dtype={'listing_id': 'int64', 'date': 'object'},
+                             chunksize=chunksize):
+        recent = chunk.listing_id[(chunk.date > start) & (chunk.date < dataset_date)]
+        counts = counts.add(recent.value_counts(), fill_value=0)
+    return counts
+
+
+def engineer(data, raw_scores, reviews_3mth, usd_eur, dataset_date):
+    """City-wide data cleaning and the feature engineering (feat_*) of the cleaned listings."""
+    snapshot = pd.Timestamp(dataset_date)
+
+    # cln_fill_missing_val (medians over all listings of the city)
+    for col in REVIEW_SCORES:
+        data[col] = data[col].fillna(raw_scores[col].median())
+    for col in ["host_acceptance_rate", "host_response_rate"]:
+        data[col] = data[col].fillna(raw_scores.review_scores_rating.median())
+
+    # cln_drop_cols
+    data['neighbourhood_cleansed'] = _mask_rare(data.neighbourhood_cleansed, 'nb_other')
+    data['zipcode'] = _mask_rare(data.zipcode, 'zip_other')
+    data = data.drop(columns=CLEAN_DROP)
+
+    # feat_adapt
+    data['cancellation_policy'] = data.cancellation_policy.replace(CANCELLATION_POLICIES)
+    for property_type, variants in PROPERTY_TYPES.items():
+        data['property_type'] = data.property_type.replace(variants, property_type)
+    data = data[data.property_type.isin(list(PROPERTY_TYPES))].copy()
+    data['monthly_price'] = np.where(data.monthly_price == 0, data.price * 30, data.monthly_price)
+    data['weekly_price'] = np.where(data.weekly_price == 0, data.price * 7, data.weekly_price)
+    data['guests_included_calc'] = np.where(data.extra_people == 0, data.accommodates, data.guests_included)
+    data['price'] = (data.price * usd_eur).round(2)
+
+    # feat_bin
+    for col in ["host_is_superhost", "host_identity_verified", "is_location_exact", "instant_bookable"]:
+        data[col] = data[col].replace(["t", "f"], [1, 0])
+    data['availability_365'] = np.where(data.availability_365 != 0, 1, 0)
+
+    # feat_num
+    data['listing_no'] = [int(el.split("/")[-1]) for el in data.listing_url]
+    data['price_calc'] = data.price - 0.5 * data.extra_people * (data.guests_included - 1)
+    data = data[data.price_calc > 5].copy()
+    data['price_extra_people'] = ((data.extra_people * (data.accommodates - data.guests_included)
+                                   + 0.5 * data.extra_people * (data.guests_included - 1))
+                                  / (data.accommodates - 1)).fillna(0)
+    data['price_extra_fees'] = 0 + data.security_deposit + data.cleaning_fee
+    data['descr_detail'] = sum(data[f"{col}_exist"] for col in TEXT_COLUMNS)
+    data['accommodates_per_bed'] = data.accommodates / data.beds
+    data['wk_mth_discount'] = ((data.price * 30 - data.monthly_price) / (data.price * 30)
+                               + (data.price * 7 - data.weekly_price) / (data.price * 7)) / 2
+    data['first_review_days'] = (snapshot - data.first_review).dt.days
+    data['last_review_days'] = (snapshot - data.last_review).dt.days
+    data['review_scores_calc'] = (data.review_scores_rating - np.sqrt(data.last_review_days / 50)
+                                  + np.where(data.number_of_reviews_ltm < 10,
+                                             -3 + np.sqrt(data.number_of_reviews_ltm), 0))
+
+    # feat_cat
+    text_len = sum(data[f"{col}_len"] / data[f"{col}_len"].max() for col in TEXT_COLUMNS) / len(TEXT_COLUMNS)
+    data['text_len'] = text_len / text_len.max()
+    data['review_scores_class'] = _classes(data.review_scores_rating, [0, 89, 93, 96, 99], 5)
+    data['review_scores_class_new'] = _classes(data.review_scores_calc, [0, 89, 92.5, 96, 98], 5)
+    data['price_class'] = _classes(data.price_calc, [20, 30, 40, 50, 60, 70, 80, 90, 100, 150], 11)
+
+    # feat_log_sqrt
+    data['bathrooms_log'] = np.log(data.bathrooms)
+    data['calc_host_lst_count_sqrt_log'] = np.log(np.sqrt(data.calculated_host_listings_count))
+    data['first_review_days_sqrt'] = np.sqrt(data.first_review_days)
+    data['last_review_days_sqrt'] = np.sqrt(data.last_review_days)
+    data['minimum_nights_sqrt'] = np.sqrt(data.minimum_nights)
+    data['number_of_reviews_ltm_log'] = np.sqrt(data.number_of_reviews_ltm)
+    data['price_extra_fees_sqrt'] = np.sqrt(data.price_extra_fees)
+    data['price_log'] = np.log(data.price)
+    data['price_calc_log'] = np.log(data.price_calc)
+    rating_sqrt = np.sqrt(data.review_scores_rating.max() - data.review_scores_rating)
+    data['review_scores_rating_sqrt'] = rating_sqrt.max() - rating_sqrt
+    data['text_len_sqrt'] = np.sqrt(data.text_len)
+
+    # feat_occupancy
+    data['avg_nights'] = np.where(data.maximum_nights <= 5, (data.maximum_nights + data.minimum_nights) / 2,
+                                  np.where(data.minimum_nights > 3, data.minimum_nights, 3))
+    data['reviews_3mth'] = reviews_3mth.reindex(data.index).fillna(0).to_numpy()
+    data['active_months'] = 1
+    relevant_mths = 1
+    data['bookings_est'] = (data.reviews_3mth / REVIEW_RATE).fillna(0)
+    occupancy = data.bookings_est * data.avg_nights / (data.active_months / relevant_mths * OCCUPANCY_DAYS)
+    data['occupancy_rate'] = np.where(occupancy < 1, occupancy, 1)
+    data['occupancy_class'] = np.where(data.occupancy_rate < 0.3, 0, 1)
+
+    data = data.drop(columns=FEATURE_DROP)
+    return data.reindex(sorted(data.columns), axis=1)
+
+
+def ingest(city, dataset_date, data_dir=DATA_DIR, chunksize=CHUNKSIZE, app=False):
+    """Build the feature store of one city snapshot; returns stats (rows, seconds, peak RSS)."""
+    start = time.perf_counter()
+    path = bundle_dir(city, dataset_date, data_dir)
+    rows_in = 0
+    parts, raw_scores = [], []
+    reader = pd.read_csv(f"{path}/{LISTINGS_FILE}", usecols=list(LISTING_DTYPES), dtype=LISTING_DTYPES,
+                         index_col='id', chunksize=chunksize)
+    for chunk in reader:
+        rows_in += len(chunk)
+        part, scores = clean_chunk(chunk, city, dataset_date)
+        parts.append(part)
+        raw_scores.append(scores)
+
+    if not os.path.exists(f"{path}/{FX_FILE}"):
+        # Pin the snapshot's rate here, offline, so the app never has to resolve it
+        write_rate(path, dataset_date)
+    reviews = next((f"{path}/{name}" for name in REVIEWS_FILES if os.path.exists(f"{path}/{name}")), None)
+    if reviews is None:
+        raise FileNotFoundError(f"no {' or '.join(REVIEWS_FILES)} in {path}")
+    data = engineer(pd.concat(parts), pd.concat(raw_scores), count_recent_reviews(reviews, dataset_date),
+                    load_rate(path, dataset_date), dataset_date)
+
+    data.to_parquet(f"{path}/{FEATURE_FILE}")
+    if app:
+        import joblib
+
+        joblib.dump(data, f"{path}/APP_data_engineered.pkl")
+    return {
+        'city': city, 'date': dataset_date, 'rows_in': rows_in, 'rows_out': len(data),
+        'seconds': time.perf_counter() - start,
+        # ru_maxrss is in KB on Linux; each city runs in a fresh process, so this is its own peak
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def _ingest_task(task):
+    return ingest(*task)
+
+
+def find_raw_snapshots(data_dir=DATA_DIR, city=None, dataset_date=None):
+    """(city, date) of all folders in data_dir with a listings.csv.gz."""
+    snapshots = []
+    for path in sorted(glob.glob(f"{data_dir}/*_*/{LISTINGS_FILE}")):
+        snap_city, snap_date = os.path.basename(os.path.dirname(path)).rsplit("_", 1)
+        if (city is None or snap_city == city) and (dataset_date is None or snap_date == dataset_date):
+            snapshots.append((snap_city, snap_date))
+    return snapshots
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--city", help="only this city")
+    parser.add_argument("--date", help="only this snapshot date (YYYY-MM-DD)")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--chunksize", type=int, default=CHUNKSIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--app", action="store_true", help="also write APP_data_engineered.pkl")
+    args = parser.parse_args(argv)
+
+    snapshots = find_raw_snapshots(args.data_dir, args.city, args.date)
+    if not snapshots:
+        parser.error(f"no {LISTINGS_FILE} found in {args.data_dir}/<city>_<date>/")
+    tasks = [(city, dataset_date, args.data_dir, args.chunksize, args.app) for city, dataset_date in snapshots]
+    start = time.perf_counter()
+    # A fresh process per city, so that the peak memory reported is that city's
+    with multiprocessing.Pool(min(args.workers, len(tasks)), maxtasksperchild=1) as pool:
+        for stats in pool.imap_unordered(_ingest_task, tasks):
+            print(f"{stats['city']:<10} {stats['date']}: {stats['rows_in']} -> {stats['rows_out']} listings in "
+                  f"{stats['seconds']:.1f}s, peak RSS {stats['max_rss_mb']:.0f} MB")
+    print(f"Ingested {len(tasks)} snapshots in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
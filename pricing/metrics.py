@@ -0,0 +1,243 @@
+"""Latency histograms and worker statistics of the web app in the Prometheus text format.
+
+Callbacks, the stages of a pricing indication and bundle loads are timed into fixed-bucket
+histograms (an observation is a bisect and a counter increment under a lock). Everything else,
+e.g. cache hit ratios and the worker's RSS, is only read from the existing counters when
+/metrics is scraped, through collectors registered with Metrics.collector.
+
+Every gunicorn worker has its own metrics. With METRICS_DIR set, each worker writes a snapshot
+of them to <METRICS_DIR>/<pid>.json every few seconds and a scrape of any worker returns those
+of all live workers, labelled with their pid; otherwise a scrape only sees the worker it hits.
+
+    curl http://localhost:8050/metrics
+"""
+import bisect
+import functools
+import glob
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager, suppress
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Upper bounds (seconds) of the latency buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOAD_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Upper bounds of the listings per micro-batch
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # Per label values: [count per bucket (the last one is +Inf), sum]
+        self._series = {}
+
+    def observe(self, value, *labelvalues):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][idx] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def samples(self):
+        with self._lock:
+            series = {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+        samples = []
+        for key, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                samples.append([f"{self.name}_bucket", list(key) + [str(bound)], cumulative])
+            samples.append([f"{self.name}_sum", list(key), total])
+            samples.append([f"{self.name}_count", list(key), cumulative])
+        return samples
+
+
+class Metrics:
+    """The metric families of one process: histograms and collectors read at scrape time."""
+
+    def __init__(self):
+        self._families = []
+        self._export = None
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        histogram = Histogram(name, documentation, labelnames, buckets)
+        self._families.append(histogram)
+        return histogram
+
+    def collector(self, name, documentation, collect, kind='gauge', labelnames=()):
+        """Add a family whose samples collect() returns: a number, or {label values tuple: number}."""
+        self._families.append((name, documentation, collect, kind, tuple(labelnames)))
+
+    def snapshot(self):
+        """JSON-serializable families of this process with their current samples."""
+        families = []
+        for family in self._families:
+            if isinstance(family, Histogram):
+                families.append({'name': family.name, 'help': family.documentation, 'type': 'histogram',
+                                 'labelnames': list(family.labelnames) + ['le'], 'samples': family.samples()})
+                continue
+            name, documentation, collect, kind, labelnames = family
+            try:
+                values = collect()
+            except Exception:
+                logger.exception("Collecting %s failed", name)
+                continue
+            if not isinstance(values, dict):
+                values = {(): values}
+            families.append({'name': name, 'help': documentation, 'type': kind, 'labelnames': list(labelnames),
+                             'samples': [[name, list(key), value] for key, value in sorted(values.items())]})
+        return {'pid': os.getpid(), 'time': time.time(), 'families': families}
+
+    def export(self, directory, interval=5.0):
+        """Write snapshot() to <directory>/<pid>.json every `interval` seconds from a daemon thread.
+
+        The thread is restarted in processes forked after the call (e.g. gunicorn --preload).
+        """
+        os.makedirs(directory, exist_ok=True)
+        first = self._export is None
+        self._export = (directory, interval)
+        self._start_exporter()
+        if first:
+            os.register_at_fork(after_in_child=self._start_exporter)
+
+    def _start_exporter(self):
+        threading.Thread(target=self._export_loop, name="metrics-exporter", daemon=True).start()
+
+    def _export_loop(self):
+        directory, interval = self._export
+        while True:
+            try:
+                self.write(directory)
+            except Exception:
+                logger.exception("Writing the metrics snapshot failed")
+            time.sleep(interval)
+
+    def write(self, directory):
+        path = f"{directory}/{os.getpid()}.json"
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f"{path}.tmp", path)
+
+    def collect(self, directory=None):
+        """Snapshots of this process and, with a directory, of all other live processes exporting there."""
+        if directory is None:
+            return [self.snapshot()]
+        self.write(directory)
+        snapshots = []
+        for path in glob.glob(f"{directory}/*.json"):
+            name = os.path.basename(path)[:-len(".json")]
+            if not name.isdigit():
+                # Not a worker snapshot (someone else's file in the directory)
+                continue
+            pid = int(name)
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                # A worker that exited (e.g. after max_requests): its metrics end with it
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self, directory=None):
+        """Prometheus text exposition of collect(), every sample labelled with its worker's pid."""
+        snapshots = self.collect(directory)
+        families = {}
+        for snapshot in sorted(snapshots, key=lambda el: el['pid']):
+            for family in snapshot['families']:
+                merged = families.setdefault(family['name'], dict(family, samples=[]))
+                merged['samples'] += [(name, labels, value, snapshot['pid'])
+                                      for name, labels, value in family['samples']]
+        lines = []
+        for family in families.values():
+            lines.append(f"# HELP {family['name']} {family['help']}")
+            lines.append(f"# TYPE {family['name']} {family['type']}")
+            for name, labels, value, pid in family['samples']:
+                lines.append(f"{name}{_labels(family['labelnames'], labels, [('worker', pid)])} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def rss_bytes():
+    """Current resident set size of this process (peak RSS where /proc is not available)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+METRICS = Metrics()
+CALLBACK_SECONDS = METRICS.histogram(
+    'pricing_callback_seconds', "Duration of Dash callbacks", ['callback'])
+PREDICT_STAGE_SECONDS = METRICS.histogram(
+    'pricing_predict_stage_seconds', "Duration of the stages of pricing indications", ['stage'])
+BUNDLE_LOAD_SECONDS = METRICS.histogram(
+    'pricing_bundle_load_seconds', "Time to load a city bundle", ['city'], buckets=LOAD_BUCKETS)
+BATCH_ROWS = METRICS.histogram(
+    'pricing_batch_rows', "Listings per micro-batched model call", buckets=BATCH_BUCKETS)
+BATCH_QUEUE_SECONDS = METRICS.histogram(
+    'pricing_batch_queue_seconds', "Wait of a request between joining a micro-batch and its execution")
+METRICS.collector('pricing_worker_rss_bytes', "Resident set size of the worker process", rss_bytes)
+
+
+def timed(callback):
+    """Decorator recording the duration of a Dash callback in CALLBACK_SECONDS."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with CALLBACK_SECONDS.time(callback):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def create_metrics(metrics=METRICS, directory=None):
+    """Blueprint serving GET /metrics."""
+    # Imported here: the bundle loader and offline tools import this module without the web stack
+    from flask import Blueprint, Response
+
+    blueprint = Blueprint('metrics', __name__)
+
+    @blueprint.route('/metrics')
+    def scrape():
+        return Response(metrics.render(directory), content_type=CONTENT_TYPE)
+
+    return blueprint
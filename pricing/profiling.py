@@ -0,0 +1,175 @@
+"""On-demand cProfile captures of Dash callbacks in running workers.
+
+Profiling is off by default. A callback wrapped with Profiler.profiled is captured when
+
+- the request has an `X-Profile: 1` header together with a valid `X-Admin-Token` (needs
+  ADMIN_TOKEN, so nobody else can make a worker slow down), or
+- a random draw falls below the current sampling rate: PROFILE_RATE (default 0), or the rate
+  set through POST /admin/profile for a limited time (see pricing.admin).
+
+The rate set at runtime is kept in <directory>/control.json, so it reaches every worker of the
+host. Each capture is written with pstats to <directory>/<callback>/<city>/<time>_<pid>.prof and
+only the latest `retention` files per callback and city are kept. summarize() merges captures
+into a list of the hottest functions (GET /admin/profiles, or from a shell):
+
+    python -m pricing.profiling --callback predict --city berlin --top 20
+"""
+import argparse
+import cProfile
+import functools
+import glob
+import hmac
+import inspect
+import json
+import logging
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+
+from flask import has_request_context, request
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = os.path.join(tempfile.gettempdir(), "airbnb_price_profiles")
+CONTROL_FILE = "control.json"
+# Seconds between two reads of the control file per worker
+CONTROL_CHECK_INTERVAL = 1.0
+SORT_KEYS = ("tottime", "cumtime", "ncalls")
+
+
+class Profiler:
+
+    def __init__(self, directory=None, rate=0.0, retention=50, token=None):
+        if retention < 1:
+            raise ValueError("retention must be at least 1")
+        self.directory = directory or DEFAULT_DIR
+        self.rate = rate
+        self.retention = retention
+        self.token = token
+        self._control = (0.0, None)
+        self._lock = threading.Lock()
+        self.captures = 0
+
+    def configure(self, rate, seconds=600):
+        """Profile a `rate` fraction of the callbacks of all workers for the next `seconds`."""
+        if not 0 <= rate <= 1:
+            raise ValueError("rate must be between 0 and 1")
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, CONTROL_FILE)
+        with open(f"{path}.{os.getpid()}.tmp", 'w') as f:
+            json.dump({'rate': rate, 'until': time.time() + seconds}, f)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+        with self._lock:
+            self._control = (0.0, None)
+
+    def current_rate(self):
+        """Sampling rate set through configure() while it lasts, PROFILE_RATE otherwise."""
+        now = time.time()
+        with self._lock:
+            checked, control = self._control
+        if now - checked >= CONTROL_CHECK_INTERVAL:
+            try:
+                with open(os.path.join(self.directory, CONTROL_FILE)) as f:
+                    control = json.load(f)
+            except (OSError, ValueError):
+                control = None
+            with self._lock:
+                self._control = (now, control)
+        if control is not None and control['until'] > now:
+            return control['rate']
+        return self.rate
+
+    def _requested(self):
+        # Only callbacks served within a Flask request can be profiled by header
+        if self.token is None or not has_request_context() or request.headers.get('X-Profile') != '1':
+            return False
+        return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), self.token)
+
+    def profiled(self, callback, city_arg='city'):
+        """Decorator capturing a profile of the callback when requested or sampled (see the module docstring)."""
+        def decorator(func):
+            position = list(inspect.signature(func).parameters).index(city_arg)
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                rate = self.current_rate()
+                if not (rate and random.random() < rate) and not self._requested():
+                    return func(*args, **kwargs)
+                city = kwargs.get(city_arg, args[position] if position < len(args) else None)
+                profile = cProfile.Profile()
+                try:
+                    return profile.runcall(func, *args, **kwargs)
+                finally:
+                    self._save(profile, callback, city)
+            return wrapper
+        return decorator
+
+    def _save(self, profile, callback, city):
+        directory = os.path.join(self.directory, callback, str(city or 'unknown'))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{time.time():.6f}_{os.getpid()}.prof")
+            # Written under another name first so summaries never read a partial file
+            profile.dump_stats(f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+            with self._lock:
+                self.captures += 1
+            # Keep the latest `retention` captures of this callback and city
+            paths = sorted(glob.glob(os.path.join(directory, "*.prof")), key=_capture_time)
+            for old in paths[:max(len(paths) - self.retention, 0)]:
+                try:
+                    os.remove(old)
+                except FileNotFoundError:
+                    pass
+        except OSError:
+            logger.exception("Saving the profile of %s (%s) failed", callback, city)
+
+
+def _capture_time(path):
+    return float(os.path.basename(path).split('_')[0])
+
+
+def captures(directory=None, callback=None, city=None):
+    """Paths of the captured profiles, optionally of one callback and/or city, oldest first."""
+    pattern = os.path.join(directory or DEFAULT_DIR, callback or '*', city or '*', "*.prof")
+    return sorted(glob.glob(pattern), key=_capture_time)
+
+
+def summarize(paths, top=20, sort='tottime'):
+    """The `top` functions of the merged profiles by `sort` (tottime, cumtime or ncalls)."""
+    if sort not in SORT_KEYS:
+        raise ValueError(f"sort must be one of {', '.join(SORT_KEYS)}")
+    if not paths:
+        return []
+    stats = pstats.Stats(*paths)
+    rows = []
+    for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({'function': f"{name} ({os.path.basename(filename)}:{line})" if line else name,
+                     'ncalls': ncalls, 'tottime': round(tottime, 6), 'cumtime': round(cumtime, 6)})
+    rows.sort(key=lambda el: el[sort], reverse=True)
+    return rows[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", default=os.environ.get('PROFILE_DIR', DEFAULT_DIR))
+    parser.add_argument("--callback", help="only captures of this callback")
+    parser.add_argument("--city", help="only captures of this city")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--sort", choices=SORT_KEYS, default="tottime")
+    args = parser.parse_args(argv)
+
+    paths = captures(args.dir, args.callback, args.city)
+    if not paths:
+        parser.error(f"no profiles captured in {args.dir}")
+    print(f"{len(paths)} captures")
+    print(f"{'ncalls':>10} {'tottime':>10} {'cumtime':>10}  function")
+    for row in summarize(paths, args.top, args.sort):
+        print(f"{row['ncalls']:>10} {row['tottime']:>10.4f} {row['cumtime']:>10.4f}  {row['function']}")
+
+
+if __name__ == '__main__':
+    main()
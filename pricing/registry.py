@@ -0,0 +1,244 @@
+"""Lazy, size-bounded registry of the per-city datasets and models used by 4_App.py."""
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from pricing.bundle import DATA_DIR, artifact_stamp, find_bundle_snapshots, load_bundle
+from pricing.metrics import BUNDLE_LOAD_SECONDS
+from pricing.snapshots import open_store, store_path
+
+logger = logging.getLogger(__name__)
+
+
+def _settled(stamp, settle):
+    # Files still being written (modified less than `settle` seconds ago) are left for the next check
+    return bool(stamp) and time.time() - max(mtime for _, _, mtime in stamp) / 1e9 >= settle
+
+
+class CityRegistry:
+    """Loads city bundles on first use and keeps at most `max_resident` of them in memory.
+
+    Bundles are keyed by (city, dataset_date); the least recently used one is evicted once
+    the limit is reached. Nothing is read from disk when the registry is created, so the
+    number of cities/dates in `data_options` does not affect start-up time.
+
+    refresh() (called by the watcher thread of watch() or an admin request) hot-swaps bundles
+    whose files changed on disk and adopts new snapshot dates of known cities, see there.
+    Listings tables are taken from the city's snapshot store (see pricing.snapshots) if it has
+    the date.
+    """
+
+    def __init__(self, data_options, max_resident=2, data_dir=DATA_DIR, numpy_tree_cities=(), comparables=False):
+        if max_resident < 1:
+            raise ValueError("max_resident must be at least 1")
+        self.data_options = data_options
+        # Cities whose model is evaluated by pricing.trees.TreeEnsemble instead of model.predict
+        self.numpy_tree_cities = set(data_options) if 'all' in numpy_tree_cities else set(numpy_tree_cities)
+        # Whether bundles are loaded with their comparables index
+        self.comparables = comparables
+        self.max_resident = max_resident
+        self.data_dir = data_dir
+        self._bundles = OrderedDict()
+        # Artifact stamp (see pricing.bundle.artifact_stamp) of each resident bundle when it was loaded
+        self._stamps = {}
+        # Open snapshot store per city: (file stamp, SnapshotStore or None)
+        self._stores = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        # (interval, settle) of watch(), the watcher thread and whether it is restarted after forks
+        self._watch = None
+        self._watcher = None
+        self._fork_hook = False
+        self.loads = 0
+        self.evictions = 0
+        self.hits = 0
+        self.swaps = 0
+        self.retired = 0
+
+    def default_date(self, city):
+        return self.data_options[city][0]
+
+    def get(self, city, dataset_date=None):
+        if city not in self.data_options:
+            raise KeyError(f"Unknown city: {city}")
+        dataset_date = dataset_date or self.default_date(city)
+        if dataset_date not in self.data_options[city]:
+            raise KeyError(f"No dataset for {city} on {dataset_date}")
+        key = (city, dataset_date)
+
+        with self._lock:
+            bundle = self._bundles.get(key)
+            if bundle is not None:
+                self._bundles.move_to_end(key)
+                self.hits += 1
+                return bundle
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Load outside of the registry lock so other cities stay available meanwhile;
+        # the per-key lock keeps concurrent callbacks from loading the same bundle twice
+        with key_lock:
+            with self._lock:
+                bundle = self._bundles.get(key)
+                if bundle is not None:
+                    self._bundles.move_to_end(key)
+                    self.hits += 1
+                    return bundle
+            return self._load(key)
+
+    def _stamp(self, key):
+        """Artifact stamp of a snapshot including its city's snapshot store."""
+        path = store_path(key[0], self.data_dir)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return artifact_stamp(*key, data_dir=self.data_dir)
+        return artifact_stamp(*key, data_dir=self.data_dir) + ((path, stat.st_size, stat.st_mtime_ns),)
+
+    def _store(self, city):
+        """The city's snapshot store, reopened when its file was replaced."""
+        path = store_path(city, self.data_dir)
+        stamp = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+        with self._lock:
+            cached = self._stores.get(city)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, open_store(city, self.data_dir) if stamp else None)
+            with self._lock:
+                self._stores[city] = cached
+        return cached[1]
+
+    def _load(self, key, stamp=None):
+        """Load the bundle of `key` and make it the resident one (the caller holds the key lock)."""
+        stamp = stamp or self._stamp(key)
+        store = self._store(key[0])
+        data = store.frame(key[1]) if store is not None and key[1] in store.dates else None
+        with BUNDLE_LOAD_SECONDS.time(key[0]):
+            bundle = load_bundle(*key, data_dir=self.data_dir, numpy_trees=key[0] in self.numpy_tree_cities,
+                                 data=data, comparables=self.comparables)
+        weakref.finalize(bundle, self._retire, key, bundle.version)
+        with self._lock:
+            previous = self._bundles.get(key)
+            # Swapping the pointer is all that happens under the lock: callbacks that already
+            # hold the previous bundle finish with it, later ones get the new one
+            self._bundles[key] = bundle
+            self._bundles.move_to_end(key)
+            self._stamps[key] = stamp
+            if previous is None:
+                self.loads += 1
+                logger.info("Loaded %s (%d resident)", bundle, len(self._bundles))
+            else:
+                self.swaps += 1
+                logger.info("Swapped %s for %s", previous.version, bundle)
+            while len(self._bundles) > self.max_resident:
+                evicted_key, _ = self._bundles.popitem(last=False)
+                self._stamps.pop(evicted_key, None)
+                self.evictions += 1
+                logger.info("Evicted %s_%s", *evicted_key)
+        return bundle
+
+    def _retire(self, key, version):
+        # Called once the last reference to a swapped out or evicted bundle is gone
+        self.retired += 1
+        logger.info("Retired %s_%s version %s", *key, version)
+
+    def refresh(self, city=None, settle=0):
+        """Reload resident bundles whose files changed and adopt new snapshot dates.
+
+        A snapshot folder of a known city that is not in data_options yet is added to it; if it
+        is more recent than the city's current default date, its bundle is loaded first and the
+        city then switches to it. Changed bundles are loaded in the calling thread, while
+        requests keep being served from the current ones, and then swapped in. Files modified
+        less than `settle` seconds ago are left for a later call. Returns the (city, date) keys
+        loaded.
+        """
+        loaded = []
+        for snap_city, snap_date in find_bundle_snapshots(self.data_dir):
+            if snap_city not in self.data_options or (city and snap_city != city):
+                continue
+            dates = self.data_options[snap_city]
+            if snap_date in dates:
+                continue
+            stamp = self._stamp((snap_city, snap_date))
+            if not _settled(stamp, settle):
+                continue
+            key = (snap_city, snap_date)
+            if snap_date > dates[0]:
+                with self._lock:
+                    key_lock = self._key_locks.setdefault(key, threading.Lock())
+                with key_lock:
+                    self._load(key, stamp)
+                loaded.append(key)
+                logger.info("Switched %s to %s", snap_city, snap_date)
+            # A new list rather than an in-place update, so readers never see a partial one
+            self.data_options[snap_city] = sorted(dates + [snap_date], reverse=True)
+
+        with self._lock:
+            keys = [key for key in self._bundles if city is None or key[0] == city]
+        for key in keys:
+            stamp = self._stamp(key)
+            with self._lock:
+                unchanged = stamp == self._stamps.get(key, stamp)
+                key_lock = self._key_locks.setdefault(key, threading.Lock())
+            if unchanged or not _settled(stamp, settle):
+                continue
+            with key_lock:
+                self._load(key, stamp)
+            loaded.append(key)
+        return loaded
+
+    def watch(self, interval, settle=2.0):
+        """Call refresh() every `interval` seconds from a daemon thread (0 stops it).
+
+        Calling it again only changes the interval of the running thread. The thread is
+        restarted in processes forked after the call (e.g. gunicorn --preload).
+        """
+        if interval <= 0:
+            self._watch = None
+            return
+        self._watch = (interval, settle)
+        self._start_watcher()
+        if not self._fork_hook:
+            self._fork_hook = True
+            os.register_at_fork(after_in_child=self._start_watcher)
+
+    def _start_watcher(self):
+        # A thread started before a fork is not alive in the child
+        if self._watch is None or (self._watcher is not None and self._watcher.is_alive()):
+            return
+        self._watcher = threading.Thread(target=self._watch_loop, name="registry-watcher", daemon=True)
+        self._watcher.start()
+
+    def _watch_loop(self):
+        while True:
+            watch = self._watch
+            if watch is None:
+                return
+            interval, settle = watch
+            time.sleep(interval)
+            try:
+                self.refresh(settle=settle)
+            except Exception:
+                logger.exception("Refreshing the city bundles failed")
+
+    def resident(self):
+        with self._lock:
+            return list(self._bundles)
+
+    def versions(self):
+        """{"<city>_<date>": version} of the resident bundles."""
+        with self._lock:
+            return {f"{city}_{dataset_date}": bundle.version for (city, dataset_date), bundle in self._bundles.items()}
+
+    def stats(self):
+        with self._lock:
+            return {
+                'loads': self.loads,
+                'evictions': self.evictions,
+                'hits': self.hits,
+                'swaps': self.swaps,
+                'retired': self.retired,
+                'resident': len(self._bundles),
+                'max_resident': self.max_resident,
+            }
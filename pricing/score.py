@@ -0,0 +1,152 @@
+"""Price a file of candidate listings offline, e.g. a portfolio across all cities.
+
+The input (CSV or Parquet) has a "city" column and the inputs of the "Pricing Indicator" tab
+(see pricing.features.LISTING_INPUTS, missing ones take the app's defaults). It is read in
+chunks, each chunk is priced in a worker process like the batch API does (rows routed by city,
+one transform/predict per city) and written to the output as soon as it and all chunks before
+it are done, so memory stays bounded by the chunks in flight:
+
+    python -m pricing.score portfolio.csv -o priced.csv --workers 4
+    python -m pricing.score portfolio.parquet -o priced.parquet --chunksize 50000
+
+Output rows are the input rows plus price, price_low, price_high, yearly_earnings (EUR) and
+error (why a row could not be priced).
+"""
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from pricing.api import price_listings
+from pricing.bundle import DATA_DIR
+from pricing.compile_bundles import find_snapshots
+from pricing.features import LISTING_DEFAULTS
+from pricing.registry import CityRegistry
+
+# Registry of the worker process (see _init_worker)
+_registry = None
+
+
+def snapshot_options(data_dir=DATA_DIR):
+    """data_options ({city: [dates]}) of all snapshots in data_dir, most recent date first."""
+    options = {}
+    for city, dataset_date in find_snapshots(data_dir):
+        options.setdefault(city, []).append(dataset_date)
+    return {city: sorted(dates, reverse=True) for city, dates in options.items()}
+
+
+def _init_worker(data_options, data_dir, numpy_tree_cities):
+    global _registry
+    # Offline scoring keeps every city resident instead of reloading them chunk by chunk
+    _registry = CityRegistry(data_options, max_resident=len(data_options), data_dir=data_dir,
+                             numpy_tree_cities=numpy_tree_cities)
+
+
+def score_chunk(chunk):
+    """Price one chunk of listings in a worker; returns the chunk with the output columns added."""
+    if 'city' not in chunk:
+        raise ValueError("the input has no 'city' column")
+    listings = chunk.fillna(value={col: value for col, value in LISTING_DEFAULTS.items() if col in chunk})
+    for col, value in LISTING_DEFAULTS.items():
+        if col not in listings:
+            listings[col] = value
+    results = price_listings(_registry, listings)
+    out = chunk.reset_index(drop=True)
+    # Nullable dtypes keep the column types of all chunks the same, whether or not rows failed
+    ranges = [result.get('price_range', (None, None)) for result in results]
+    out['price'] = pd.array([result.get('price') for result in results], dtype="Int64")
+    out['price_low'] = pd.array([low for low, _ in ranges], dtype="Int64")
+    out['price_high'] = pd.array([high for _, high in ranges], dtype="Int64")
+    out['yearly_earnings'] = pd.array([result.get('yearly_earnings') for result in results], dtype="Int64")
+    out['error'] = pd.array([result.get('error') for result in results], dtype="string")
+    return out
+
+
+def read_chunks(path, chunksize):
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize)
+
+
+class ChunkWriter:
+    """Appends priced chunks to a CSV or Parquet file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        self._writer = None
+        self._header = True
+
+    def write(self, chunk):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table.cast(self._writer.schema))
+        else:
+            chunk.to_csv(self.path, mode='w' if self._header else 'a', header=self._header, index=False)
+            self._header = False
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="CSV or Parquet file of listings with a 'city' column")
+    parser.add_argument("-o", "--output", required=True, help="CSV or Parquet file to write")
+    parser.add_argument("--chunksize", type=int, default=20000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--numpy-trees", action="store_true", help="evaluate the models with pricing.trees")
+    args = parser.parse_args(argv)
+
+    data_options = snapshot_options(args.data_dir)
+    if not data_options:
+        parser.error(f"no city snapshots found in {args.data_dir}")
+    numpy_tree_cities = ['all'] if args.numpy_trees else []
+
+    writer = ChunkWriter(args.output)
+    rows = errors = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.workers, initializer=_init_worker,
+                             initargs=(data_options, args.data_dir, numpy_tree_cities)) as pool:
+        pending = deque()
+
+        def write_next():
+            nonlocal rows, errors
+            chunk = pending.popleft().result()
+            writer.write(chunk)
+            rows += len(chunk)
+            errors += int(chunk.error.notna().sum())
+            elapsed = time.perf_counter() - start
+            print(f"\r{rows} rows, {rows / elapsed:.0f} rows/s", end="", file=sys.stderr)
+
+        for chunk in read_chunks(args.input, args.chunksize):
+            # At most two chunks per worker in flight; results are written in input order
+            if len(pending) >= 2 * args.workers:
+                write_next()
+            pending.append(pool.submit(score_chunk, chunk))
+        while pending:
+            write_next()
+    writer.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"\rPriced {rows} rows ({errors} errors) in {elapsed:.1f}s: {rows / max(elapsed, 1e-9):.0f} rows/s",
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
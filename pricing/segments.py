@@ -0,0 +1,214 @@
+"""Per-segment price bands and market context, precomputed per city snapshot.
+
+A listing's segment is its zipcode x room_type x property_type. `python -m pricing.segments`
+evaluates each snapshot's model on APP_X_test and stores, for every segment, quantiles of the
+log price residuals (actual - predicted) and the number, median price and median occupancy rate
+of the snapshot's listings, in data/<city>_<date>/APP_segments.npz. A segment with too few test
+listings (MIN_TEST_LISTINGS) or listings (MIN_LISTINGS) takes the values of the first coarser
+segment in LEVELS with enough, down to the whole city.
+
+The fallbacks are resolved offline into dense arrays indexed by the codes of the three columns,
+each with an extra last code for values the table does not know, so the app looks a listing up
+with one dict lookup per column and one array index. The band spans the QUANTILES of the
+residuals, which like the global APP_MAPE_median band covers half of the test listings, but is
+as wide (and as skewed) as the model's errors are in that segment. Without the file, the app
+keeps the global band.
+
+    python -m pricing.segments                   # all snapshots
+    python -m pricing.segments --city berlin
+"""
+import argparse
+import hashlib
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+from pricing.features import eur_prices
+
+SEGMENTS_FILE = "APP_segments.npz"
+SEGMENT_COLUMNS = ["zipcode", "room_type", "property_type"]
+# Residual quantiles spanning the price band
+QUANTILES = (0.25, 0.75)
+MIN_TEST_LISTINGS = 20
+MIN_LISTINGS = 10
+# Segments to fall back to (positions in SEGMENT_COLUMNS), finest first; () is the whole city
+LEVELS = [(0, 1, 2), (0, 1), (1, 2), (1,), ()]
+
+
+def _codes(values, categories):
+    """Codes of values in categories; unknown values get len(categories)."""
+    lookup = {value: i for i, value in enumerate(categories)}
+    return np.array([lookup.get(value, len(categories)) for value in values], dtype=np.intp)
+
+
+def _resolve(codes, values, sizes, min_count, reducers):
+    """Arrays of shape sizes + 1 with the reduced values of every segment, falling back along LEVELS.
+
+    codes: per segment column, the code of every row; values: {name: array}; reducers: {output name:
+    (value name, function)}. Also returns each cell's row count and the level its values come from.
+    """
+    frame = pd.DataFrame({f"c{i}": c for i, c in enumerate(codes)})
+    for name, array in values.items():
+        frame[name] = array
+    tables = []
+    for level in LEVELS:
+        keys = [f"c{i}" for i in level] or np.zeros(len(frame), dtype=int)
+        table = frame.groupby(keys).agg(count=(next(iter(values)), 'size'),
+                                        **{name: (col, func) for name, (col, func) in reducers.items()})
+        if level:
+            table = table[table['count'] >= min_count]
+        # Keys as tuples of codes, () for the whole city
+        tables.append({key if isinstance(key, tuple) else ((key,) if level else ()): row
+                       for key, row in table.to_dict('index').items()})
+
+    shape = tuple(size + 1 for size in sizes)
+    out = {name: np.full(shape, np.nan, dtype=np.float32) for name in reducers}
+    out['count'] = np.zeros(shape, dtype=np.int32)
+    out['level'] = np.full(shape, -1, dtype=np.int8)
+    for cell in np.ndindex(shape):
+        for pos, level in enumerate(LEVELS):
+            if any(cell[i] == sizes[i] for i in level):
+                continue
+            row = tables[pos].get(tuple(cell[i] for i in level))
+            if row is not None:
+                for name in reducers:
+                    out[name][cell] = row[name]
+                out['count'][cell] = row['count']
+                out['level'][cell] = pos
+                break
+    return out
+
+
+def segment_arrays(bundle):
+    """Lookup arrays of a city bundle loaded with its full tables (load_bundle(..., compact=False))."""
+    data, X_test = bundle.data, bundle.X_test
+    categories = [sorted(set(data[col].dropna().astype(str)) | set(X_test[col].dropna().astype(str)))
+                  for col in SEGMENT_COLUMNS]
+    sizes = [len(el) for el in categories]
+
+    y_test = data.price_log.reindex(X_test.index).to_numpy(dtype=float)
+    residuals = y_test - bundle.model.predict(bundle.encoder.transform(X_test))
+    known = ~np.isnan(residuals)
+    test_codes = [_codes(X_test[col].astype(str)[known], cats) for col, cats in zip(SEGMENT_COLUMNS, categories)]
+    band = _resolve(test_codes, {'residual': residuals[known]}, sizes, MIN_TEST_LISTINGS, {
+        'q_low': ('residual', lambda s: s.quantile(QUANTILES[0])),
+        'q_high': ('residual', lambda s: s.quantile(QUANTILES[1])),
+    })
+
+    codes = [_codes(data[col].astype(str), cats) for col, cats in zip(SEGMENT_COLUMNS, categories)]
+    market = _resolve(codes, {'price': data['price'].to_numpy(dtype=float),
+                              'occupancy_rate': data.occupancy_rate.to_numpy(dtype=float)},
+                      sizes, MIN_LISTINGS, {'median_price': ('price', 'median'),
+                                            'median_occupancy': ('occupancy_rate', 'median')})
+
+    arrays = {f"categories_{col}": np.array(cats, dtype=str) for col, cats in zip(SEGMENT_COLUMNS, categories)}
+    arrays.update({'q_low': band['q_low'], 'q_high': band['q_high'], 'band_level': band['level'],
+                   'test_listings': band['count'], 'median_price': market['median_price'],
+                   'median_occupancy': market['median_occupancy'], 'market_level': market['level'],
+                   'listings': market['count']})
+    return arrays
+
+
+def write_segments(arrays, path):
+    # Replace atomically so that a loading worker never reads a half-written file
+    with open(f"{path}.tmp", 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(f"{path}.tmp", path)
+
+
+def describe_segment(level, zipcode, room_type, property_type):
+    """Readable name of the segment a listing's values come from, e.g. "Private room, Apartment in 10115"."""
+    if level < 0 or not LEVELS[level]:
+        return "all listings"
+    values = dict(zip(SEGMENT_COLUMNS, [str(zipcode)[4:], room_type, property_type]))
+    dims = [SEGMENT_COLUMNS[i] for i in LEVELS[level]]
+    label = ", ".join(str(values[col]) for col in dims if col != "zipcode")
+    return f"{label} in {values['zipcode']}" if "zipcode" in dims else label
+
+
+class SegmentTable:
+    """Lookup arrays of APP_segments.npz."""
+
+    def __init__(self, arrays, version):
+        self.categories = [list(arrays[f"categories_{col}"]) for col in SEGMENT_COLUMNS]
+        self._lookups = [{value: i for i, value in enumerate(cats)} for cats in self.categories]
+        for name in ['q_low', 'q_high', 'band_level', 'median_price', 'median_occupancy', 'market_level',
+                     'listings']:
+            setattr(self, name, arrays[name])
+        self.version = version
+
+    def cells(self, listings):
+        """Index of each listing (DataFrame or dict of sequences) into the lookup arrays."""
+        return tuple(np.array([lookup.get(value, len(lookup)) for value in listings[col]], dtype=np.intp)
+                     for col, lookup in zip(SEGMENT_COLUMNS, self._lookups))
+
+    def price_indication(self, listings, y_pred, usd_eur):
+        """EUR price, lower and upper bound of the listings' segment band for predicted log prices."""
+        cells = self.cells(listings)
+        y_pred = np.asarray(y_pred, dtype=float)
+        price = eur_prices(y_pred, usd_eur)
+        low = eur_prices(y_pred + self.q_low[cells], usd_eur)
+        high = eur_prices(y_pred + self.q_high[cells], usd_eur)
+        return price.tolist(), low.tolist(), high.tolist()
+
+    def context(self, listings):
+        """Market of each listing's segment: its name, number of listings, median price and occupancy."""
+        cells = self.cells(listings)
+        results = []
+        for i, values in enumerate(zip(*[listings[col] for col in SEGMENT_COLUMNS])):
+            cell = tuple(el[i] for el in cells)
+            results.append({
+                'segment': describe_segment(int(self.market_level[cell]), *values),
+                'listings': int(self.listings[cell]),
+                'median_price': int(round(float(self.median_price[cell]))),
+                'median_occupancy_rate': round(float(self.median_occupancy[cell]), 2),
+            })
+        return results
+
+
+def load_segments(path):
+    """SegmentTable of a snapshot folder, or None if it has no APP_segments.npz."""
+    path = f"{path}/{SEGMENTS_FILE}"
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        raw = f.read()
+    with np.load(io.BytesIO(raw), allow_pickle=False) as arrays:
+        return SegmentTable({name: arrays[name] for name in arrays.files}, hashlib.sha256(raw).hexdigest()[:8])
+
+
+def build_segments(city, dataset_date, data_dir):
+    """Compute and write the lookup arrays of one snapshot; returns their bytes and the band widths."""
+    # pricing.bundle imports this module to load the lookup arrays of the bundles it loads
+    from pricing.bundle import bundle_dir, load_bundle
+
+    bundle = load_bundle(city, dataset_date, data_dir, compact=False)
+    arrays = segment_arrays(bundle)
+    path = f"{bundle_dir(city, dataset_date, data_dir)}/{SEGMENTS_FILE}"
+    write_segments(arrays, path)
+    return os.path.getsize(path), arrays['q_high'] - arrays['q_low']
+
+
+def main(argv=None):
+    from pricing.bundle import DATA_DIR, find_bundle_snapshots
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--city", help="only this city")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    args = parser.parse_args(argv)
+
+    snapshots = [(city, dataset_date) for city, dataset_date in find_bundle_snapshots(args.data_dir)
+                 if args.city is None or city == args.city]
+    if not snapshots:
+        parser.error(f"no city snapshots found in {args.data_dir}")
+    for city, dataset_date in snapshots:
+        nbytes, widths = build_segments(city, dataset_date, args.data_dir)
+        print(f"{city:<10} {dataset_date}: {widths.size} segments in {nbytes / 1e3:.0f} kB, log band width "
+              f"p10 {np.nanpercentile(widths, 10):.3f} median {np.nanmedian(widths):.3f} "
+              f"p90 {np.nanpercentile(widths, 90):.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""What-if sensitivity of a pricing indication to one or two of its inputs.
+
+For the current configuration of the "Pricing Indicator" tab, every combination of the values
+the chosen inputs can take on their sliders (SWEEP_RANGES) is priced with a single encode and
+predict call on the city bundle, so a whole sweep costs about as much as one prediction
+instead of one server round-trip per slider step.
+
+    python benchmarks/bench_sensitivity.py   # one sweep vs. one prediction per grid point
+"""
+import numpy as np
+import pandas as pd
+
+from pricing.features import LISTING_INPUTS, validate_listings
+
+# Values of the inputs that can be swept, as offered by their sliders in 4_App.py
+# (bathrooms start at 1: the model takes the log of the whole number of bathrooms)
+SWEEP_RANGES = {
+    "accommodates": np.arange(1, 11),
+    "bedrooms": np.arange(1, 15) / 2,
+    "beds": np.arange(1, 15) / 2,
+    "bathrooms_log": np.arange(2, 15) / 2,
+    "calc_host_lst_count_sqrt_log": np.arange(0, 8),
+    "wk_mth_discount": np.arange(0, 11) / 20,
+    "guests_included_calc": np.arange(1, 10),
+    "occupancy_rate": np.arange(0, 21) / 20,
+}
+SWEEP_LABELS = {
+    "accommodates": "Accommodates",
+    "bedrooms": "Bedrooms",
+    "beds": "Beds",
+    "bathrooms_log": "Bathrooms",
+    "calc_host_lst_count_sqrt_log": "Other active listings",
+    "wk_mth_discount": "Weekly/monthly discount",
+    "guests_included_calc": "Guests included",
+    "occupancy_rate": "Occupancy rate",
+}
+MAX_SWEEP_INPUTS = 2
+
+
+def sweep_variants(listing, inputs):
+    """Listing inputs (dict of lists) of every combination of the SWEEP_RANGES values of `inputs`.
+
+    `listing` holds one value per input of LISTING_INPUTS; the inputs that are not swept keep it.
+    The first input varies slowest.
+    """
+    grids = np.meshgrid(*[SWEEP_RANGES[col] for col in inputs], indexing='ij')
+    n = grids[0].size
+    variants = {col: [listing[col]] * n for col in LISTING_INPUTS}
+    for col, grid in zip(inputs, grids):
+        variants[col] = grid.ravel().tolist()
+    return variants
+
+
+def sensitivity(bundle, listing, inputs):
+    """Price and yearly earnings of the listing over the slider ranges of one or two inputs.
+
+    Returns a DataFrame with a column per swept input and price, price_low, price_high and
+    yearly_earnings (EUR) per combination. Raises ValueError for invalid inputs.
+    """
+    inputs = list(dict.fromkeys(inputs))
+    if not 1 <= len(inputs) <= MAX_SWEEP_INPUTS:
+        raise ValueError(f"choose between 1 and {MAX_SWEEP_INPUTS} inputs to vary")
+    unknown = [col for col in inputs if col not in SWEEP_RANGES]
+    if unknown:
+        raise ValueError(f"'{unknown[0]}' cannot be varied")
+
+    variants = sweep_variants(listing, inputs)
+    errors = [error for error in validate_listings(variants, bundle.encoder.categories) if error]
+    if errors:
+        raise ValueError(errors[0])
+    price, price_low, price_high = bundle.price_indication(variants, bundle.predict(variants))
+
+    result = pd.DataFrame({col: variants[col] for col in inputs})
+    result['price'] = price
+    result['price_low'] = price_low
+    result['price_high'] = price_high
+    # Same rounding as pricing.features.yearly_earnings
+    result['yearly_earnings'] = np.rint(result.price * 365 * np.asarray(variants['occupancy_rate'], dtype=float))
+    result['yearly_earnings'] = result.yearly_earnings.astype(int)
+    return result
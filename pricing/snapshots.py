@@ -0,0 +1,204 @@
+"""Store of a city's listings tables (APP_data_engineered) across many snapshot dates.
+
+Consecutive Inside Airbnb snapshots mostly repeat the same listings with the same values, so a
+city's tables are stored once, deduplicated, in data/<city>_snapshots.bin:
+
+- base: every listing (by id) that appears in any of the snapshots, with its values at the
+  first date it appears
+- per date: the base rows of its listings (in the snapshot's own order) and, only for the
+  columns that changed for some of them, the positions and new values of the changed cells
+
+String columns are stored as integer codes into one category list per column shared by all
+dates. The file has the layout of a compiled bundle (see pricing.bundle) and is memory-mapped,
+so its pages are shared between workers. CityRegistry takes a snapshot's listings from the
+store when it has the date; the bundle's own table is then not read.
+
+    python -m pricing.snapshots                  # (re)build the stores of all cities, report sizes
+    python -m pricing.snapshots --city berlin --report
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from pricing.bundle import (DATA_DIR, find_bundle_snapshots, map_file, read_data_table, read_manifest,
+                            write_sections)
+
+STORE_MAGIC = b"APPSNAP\0"
+STORE_KIND = "snapshot store"
+
+
+def store_path(city, data_dir=DATA_DIR):
+    return f"{data_dir}/{city}_snapshots.bin"
+
+
+def _differs(values, base):
+    if values.dtype.kind == 'f':
+        return ~((values == base) | (np.isnan(values) & np.isnan(base)))
+    return values != base
+
+
+def _encode_columns(frames):
+    """Column metadata and {date: {column: numpy values}} with strings encoded as shared codes."""
+    first = next(iter(frames.values()))
+    columns, encoded = [], {dataset_date: {} for dataset_date in frames}
+    for col in first.columns:
+        series = [frame[col] for frame in frames.values()]
+        if any(s.dtype == object or str(s.dtype) == 'category' for s in series):
+            categories = pd.Index(sorted(set().union(*(s.dropna().astype(str).unique() for s in series))))
+            columns.append({'name': col, 'kind': 'categorical', 'dtype': '<i4', 'categories': list(categories)})
+            for dataset_date, s in zip(frames, series):
+                # Missing values get code -1, as in pandas.Categorical
+                encoded[dataset_date][col] = categories.get_indexer(s.astype(str).where(s.notna())).astype('<i4')
+        else:
+            dtype = np.result_type(*[s.dtype for s in series])
+            columns.append({'name': col, 'kind': 'numeric', 'dtype': dtype.str})
+            for dataset_date, s in zip(frames, series):
+                encoded[dataset_date][col] = s.to_numpy().astype(dtype)
+    return columns, encoded
+
+
+def build_store(city, dates, data_dir=DATA_DIR, out=None):
+    """Write the store of a city's snapshot dates; returns its path."""
+    frames = {dataset_date: read_data_table(city, dataset_date, data_dir) for dataset_date in sorted(dates)}
+    schemas = {tuple(frame.columns) for frame in frames.values()}
+    if len(schemas) > 1:
+        raise ValueError(f"the listings tables of {city} have different columns in different snapshots")
+    for dataset_date, frame in frames.items():
+        if not frame.index.is_unique:
+            raise ValueError(f"{city} {dataset_date} has duplicate listing ids")
+    columns, encoded = _encode_columns(frames)
+
+    # Base rows: each listing with its values at its first date
+    ids = pd.concat([frame.index.to_series() for frame in frames.values()])
+    first_seen = ~ids.duplicated().to_numpy()
+    base_index = pd.Index(ids[first_seen].to_numpy(), name=next(iter(frames.values())).index.name)
+    sections = [('base/__index__', np.ascontiguousarray(base_index.to_numpy()).tobytes())]
+    base = {}
+    for i, meta in enumerate(columns):
+        values = np.concatenate([encoded[dataset_date][meta['name']] for dataset_date in frames])[first_seen]
+        base[meta['name']] = values
+        sections.append((f"base/{i}", np.ascontiguousarray(values).tobytes()))
+
+    manifest = {'city': city, 'base_rows': len(base_index), 'index_dtype': base_index.dtype.str,
+                'index_name': base_index.name, 'columns': columns, 'dates': {}}
+    for dataset_date, frame in frames.items():
+        rows = base_index.get_indexer(frame.index).astype('<i4')
+        sections.append((f"rows/{dataset_date}", rows.tobytes()))
+        changed = {}
+        for i, meta in enumerate(columns):
+            values = encoded[dataset_date][meta['name']]
+            positions = np.flatnonzero(_differs(values, base[meta['name']][rows])).astype('<i4')
+            if len(positions):
+                changed[str(i)] = len(positions)
+                sections.append((f"delta/{dataset_date}/{i}/positions", positions.tobytes()))
+                sections.append((f"delta/{dataset_date}/{i}/values",
+                                 np.ascontiguousarray(values[positions]).tobytes()))
+        manifest['dates'][dataset_date] = {'nrows': len(frame), 'changed': changed}
+
+    out = out or store_path(city, data_dir)
+    write_sections(out, manifest, sections, magic=STORE_MAGIC)
+    return out
+
+
+class SnapshotStore:
+    """Read access to a memory-mapped snapshot store."""
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest, self._data_start = read_manifest(path, magic=STORE_MAGIC, kind=STORE_KIND)
+        self._buffer = map_file(path)
+        self.city = self.manifest['city']
+        self.dates = sorted(self.manifest['dates'], reverse=True)
+
+    def _array(self, section, dtype):
+        meta = self.manifest['sections'][section]
+        start = self._data_start + meta['offset']
+        return np.frombuffer(self._buffer[start:start + meta['nbytes']], dtype=np.dtype(dtype))
+
+    def frame(self, dataset_date):
+        """Listings table of one date, equal to the snapshot's own APP_data_engineered."""
+        meta = self.manifest['dates'][dataset_date]
+        rows = self._array(f"rows/{dataset_date}", '<i4')
+        # All listings of the base in base order: unchanged columns are views onto the mapped file
+        whole_base = len(rows) == self.manifest['base_rows'] and bool(np.all(rows[1:] > rows[:-1]))
+        columns = {}
+        for i, col in enumerate(self.manifest['columns']):
+            values = self._array(f"base/{i}", col['dtype'])
+            if str(i) in meta['changed'] or not whole_base:
+                values = values[rows]
+            if str(i) in meta['changed']:
+                values[self._array(f"delta/{dataset_date}/{i}/positions", '<i4')] = \
+                    self._array(f"delta/{dataset_date}/{i}/values", col['dtype'])
+            if col['kind'] == 'categorical':
+                values = pd.Categorical.from_codes(values, categories=col['categories'])
+            columns[col['name']] = values
+        index = pd.Index(self._array("base/__index__", self.manifest['index_dtype'])[rows],
+                         name=self.manifest['index_name'])
+        return pd.DataFrame(columns, index=index, copy=False)
+
+    def stats(self):
+        """Bytes of the store (base and per-date deltas) and of full copies of every date."""
+        sections = self.manifest['sections']
+        row_bytes = (np.dtype(self.manifest['index_dtype']).itemsize
+                     + sum(np.dtype(col['dtype']).itemsize for col in self.manifest['columns']))
+        dates = {}
+        for dataset_date, meta in self.manifest['dates'].items():
+            prefix = (f"rows/{dataset_date}", f"delta/{dataset_date}/")
+            dates[dataset_date] = {
+                'rows': meta['nrows'],
+                'changed_columns': len(meta['changed']),
+                'bytes': sum(el['nbytes'] for name, el in sections.items() if name.startswith(prefix)),
+                'full_bytes': meta['nrows'] * row_bytes,
+            }
+        return {
+            'base_rows': self.manifest['base_rows'],
+            'base_bytes': sum(el['nbytes'] for name, el in sections.items() if name.startswith("base/")),
+            'store_bytes': os.path.getsize(self.path),
+            'full_bytes': sum(el['full_bytes'] for el in dates.values()),
+            'dates': dates,
+        }
+
+
+def open_store(city, data_dir=DATA_DIR):
+    """The city's SnapshotStore, or None if it has none."""
+    path = store_path(city, data_dir)
+    return SnapshotStore(path) if os.path.exists(path) else None
+
+
+def report(store):
+    stats = store.stats()
+    print(f"{store.city}: {len(stats['dates'])} dates, {stats['base_rows']} distinct listings, "
+          f"store {stats['store_bytes'] / 1e6:.1f} MB vs {stats['full_bytes'] / 1e6:.1f} MB as full copies")
+    for dataset_date, el in sorted(stats['dates'].items()):
+        print(f"  {dataset_date}: {el['rows']} listings, {el['changed_columns']} changed columns, "
+              f"{el['bytes'] / 1e3:.0f} kB beyond the base ({el['bytes'] / el['full_bytes']:.1%} of a full copy)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--city", help="only this city")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--report", action="store_true", help="only report the sizes of existing stores")
+    args = parser.parse_args(argv)
+
+    options = {}
+    for city, dataset_date in find_bundle_snapshots(args.data_dir):
+        if args.city is None or city == args.city:
+            options.setdefault(city, []).append(dataset_date)
+    if not options:
+        parser.error(f"no city snapshots found in {args.data_dir}")
+    for city, dates in sorted(options.items()):
+        if not args.report:
+            start = time.perf_counter()
+            build_store(city, dates, args.data_dir)
+            print(f"Built {store_path(city, args.data_dir)} in {time.perf_counter() - start:.1f}s")
+        store = open_store(city, args.data_dir)
+        if store is not None:
+            report(store)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Grid index over listing coordinates for sending only the map points inside the viewport.
+
+GridIndex buckets the listings of a city into a regular latitude/longitude grid and stores
+their row numbers sorted by cell, so the rows in a bounding box are a few contiguous slices
+(one per grid row) plus an exact check on the border cells. When more rows than `limit` are
+in view, the ones with the lowest fixed random rank are kept: the sample is deterministic and
+mostly stable while panning, instead of points flickering in and out.
+"""
+import math
+
+import numpy as np
+
+# Mapbox GL renders 512 px tiles, i.e. the world is 512 * 2**zoom pixels wide
+TILE_SIZE = 512
+
+
+class GridIndex:
+
+    def __init__(self, latitude, longitude, cells=64, seed=0):
+        self.lat = np.asarray(latitude, dtype=float)
+        self.lon = np.asarray(longitude, dtype=float)
+        self.cells = cells
+        n = len(self.lat)
+        if n:
+            self.lat_min, self.lat_max = float(np.nanmin(self.lat)), float(np.nanmax(self.lat))
+            self.lon_min, self.lon_max = float(np.nanmin(self.lon)), float(np.nanmax(self.lon))
+        else:
+            self.lat_min = self.lat_max = self.lon_min = self.lon_max = 0.0
+        self.lat_step = (self.lat_max - self.lat_min) / cells or 1.0
+        self.lon_step = (self.lon_max - self.lon_min) / cells or 1.0
+
+        rows, cols = self._cell(self.lat, self.lon)
+        cell = rows * cells + cols
+        self.order = np.argsort(cell, kind='stable')
+        # starts[c]:starts[c + 1] are the positions in `order` of the rows in cell c
+        self.starts = np.searchsorted(cell[self.order], np.arange(cells * cells + 1))
+        self.rank = np.random.RandomState(seed).permutation(n)
+
+    def __len__(self):
+        return len(self.lat)
+
+    @property
+    def bounds(self):
+        return self.lat_min, self.lat_max, self.lon_min, self.lon_max
+
+    def _cell(self, lat, lon):
+        rows = np.clip(((lat - self.lat_min) / self.lat_step).astype(int), 0, self.cells - 1)
+        cols = np.clip(((lon - self.lon_min) / self.lon_step).astype(int), 0, self.cells - 1)
+        return rows, cols
+
+    def query(self, lat_min, lat_max, lon_min, lon_max, limit=None):
+        """Row numbers of the points inside the box, at most `limit` of them, in ascending order."""
+        if not len(self) or lat_min > self.lat_max or lat_max < self.lat_min \
+                or lon_min > self.lon_max or lon_max < self.lon_min:
+            return np.empty(0, dtype=np.intp)
+        (row0, row1), (col0, col1) = self._cell(np.array([lat_min, lat_max]), np.array([lon_min, lon_max]))
+        slices = [self.order[self.starts[row * self.cells + col0]:self.starts[row * self.cells + col1 + 1]]
+                  for row in range(row0, row1 + 1)]
+        rows = np.concatenate(slices)
+        inside = ((self.lat[rows] >= lat_min) & (self.lat[rows] <= lat_max)
+                  & (self.lon[rows] >= lon_min) & (self.lon[rows] <= lon_max))
+        rows = rows[inside]
+        if limit is not None and len(rows) > limit:
+            rows = rows[np.argpartition(self.rank[rows], limit)[:limit]]
+        return np.sort(rows)
+
+
+def viewport_bounds(relayout_data, width, height):
+    """(lat_min, lat_max, lon_min, lon_max) of a mapbox viewport from Graph.relayoutData, or None.
+
+    Uses the corner coordinates plotly.js reports as "mapbox._derived" and otherwise
+    approximates them from center and zoom for a map of width x height pixels.
+    """
+    if not relayout_data:
+        return None
+    derived = relayout_data.get('mapbox._derived')
+    if derived and derived.get('coordinates'):
+        lons, lats = zip(*derived['coordinates'])
+        return min(lats), max(lats), min(lons), max(lons)
+    center, zoom = relayout_data.get('mapbox.center'), relayout_data.get('mapbox.zoom')
+    if not center or zoom is None:
+        return None
+    world = TILE_SIZE * 2 ** zoom
+    half_lon = width / 2 * 360 / world
+    # Latitudes are linear in Web Mercator y, not in degrees
+    y = math.log(math.tan(math.pi / 4 + math.radians(center['lat']) / 2))
+    half_y = height / 2 * 2 * math.pi / world
+    lat_min = math.degrees(2 * math.atan(math.exp(y - half_y)) - math.pi / 2)
+    lat_max = math.degrees(2 * math.atan(math.exp(y + half_y)) - math.pi / 2)
+    return lat_min, lat_max, center['lon'] - half_lon, center['lon'] + half_lon
@@ -0,0 +1,237 @@
+"""Retrain the xgboost model of each city snapshot and publish it as a new bundle version.
+
+Scripted version of sections 5, 6.2 and 8 of 1_Predictive_Modeling.ipynb: the engineered
+features (features.parquet written by pricing.ingest, or APP_data_engineered.pkl) are split
+into train/test sets, a randomized hyperparameter search with k-fold cross validation picks
+the model, which is refit on the whole training set and evaluated on the test set
+(APP_MAPE_median). The APP_*.pkl files are then replaced and APP_bundle.bin recompiled, so the
+app picks up the new version (see pricing.registry).
+
+All fits of all cities (candidates x folds, then one refit per city) share one pool of
+processes; each fit uses a configurable number of xgboost threads:
+
+    python -m pricing.train --processes 8 --xgb-threads 1   # many small fits side by side
+    python -m pricing.train --city paris --processes 2 --xgb-threads 4
+
+Results of a run (model, preprocessor, search results) are also saved to
+data/<city>_<date>/<model_run>/ like the notebook does.
+"""
+import argparse
+import functools
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+
+import joblib
+import numpy as np
+import pandas as pd
+from scipy.stats import randint
+
+from pricing.bundle import DATA_DIR, bundle_dir, compile_bundle
+from pricing.features import CATEGORICAL_FEATURES
+from pricing.ingest import FEATURE_FILE
+from pricing.segments import build_segments
+
+TARGET = "price_log"
+# key_features of the notebook: the columns of APP_X_test
+KEY_FEATURES = [
+    "accommodates_per_bed", "am_balcony", "am_breakfast", "am_child_friendly", "am_elevator", "am_essentials",
+    "am_pets_allowed", "am_private_entrance", "am_smoking_allowed", "am_tv", "bathrooms_log", "bedrooms",
+    "calc_host_lst_count_sqrt_log", "cancellation_policy", "guests_included_calc", "host_is_superhost",
+    "instant_bookable", "maximum_nights", "minimum_nights_sqrt", "property_type", "room_type", "wk_mth_discount",
+    "zipcode",
+]
+TEST_SIZE = 0.2
+RANDOM_STATE = 42
+# Search space of the notebook's RandomizedSearchCV (without the arguments xgboost ignores)
+PARAM_DISTRIBUTIONS = {
+    'n_estimators': randint(low=80, high=300),
+    'gamma': [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1],
+    'max_depth': randint(low=1, high=7),
+    'learning_rate': [0.01, 0.02, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5],
+}
+
+
+def load_features(city, dataset_date, data_dir=DATA_DIR):
+    path = bundle_dir(city, dataset_date, data_dir)
+    if os.path.exists(f"{path}/{FEATURE_FILE}"):
+        return pd.read_parquet(f"{path}/{FEATURE_FILE}")
+    return joblib.load(f"{path}/APP_data_engineered.pkl")
+
+
+def find_feature_snapshots(data_dir=DATA_DIR, city=None, dataset_date=None):
+    """(city, date) of all folders in data_dir with engineered features."""
+    folders = set()
+    for name in [FEATURE_FILE, "APP_data_engineered.pkl"]:
+        folders.update(os.path.dirname(path) for path in glob.glob(f"{data_dir}/*_*/{name}"))
+    snapshots = []
+    for folder in sorted(folders):
+        snap_city, snap_date = os.path.basename(folder).rsplit("_", 1)
+        if (city is None or snap_city == city) and (dataset_date is None or snap_date == dataset_date):
+            snapshots.append((snap_city, snap_date))
+    return snapshots
+
+
+def make_preprocessor(X):
+    """Unfitted preprocessor of the notebook (median imputer + scaler, constant imputer + one-hot)."""
+    from sklearn.compose import ColumnTransformer
+    from sklearn.impute import SimpleImputer
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+    cat_features = [col for col in X.columns if X[col].dtype == object]
+    num_features = [col for col in X.columns if col not in cat_features]
+    num_pipeline = Pipeline([('imputer_num', SimpleImputer(strategy='median')),
+                             ('std_scaler', StandardScaler())])
+    cat_pipeline = Pipeline([('imputer_cat', SimpleImputer(strategy='constant', fill_value='missing')),
+                             ('1hot', OneHotEncoder(drop='first', handle_unknown='error'))])
+    return ColumnTransformer([('num', num_pipeline, num_features), ('cat', cat_pipeline, cat_features)])
+
+
+@functools.lru_cache(maxsize=None)
+def load_split(city, dataset_date, data_dir=DATA_DIR):
+    """(data, X_train, X_test, y_train, y_test) of a snapshot; cached per worker process."""
+    from sklearn.model_selection import train_test_split
+
+    data = load_features(city, dataset_date, data_dir)
+    X = data[KEY_FEATURES].copy()
+    for col in CATEGORICAL_FEATURES:
+        X[col] = X[col].astype(object)
+    X_train, X_test, y_train, y_test = train_test_split(X, data[TARGET], test_size=TEST_SIZE,
+                                                        random_state=RANDOM_STATE, shuffle=True)
+    return data, X_train, X_test, y_train, y_test
+
+
+def _fit(X, y, params, xgb_threads):
+    from xgboost import XGBRegressor
+
+    preprocessor = make_preprocessor(X).fit(X)
+    model = XGBRegressor(random_state=RANDOM_STATE, n_jobs=xgb_threads, **params)
+    model.fit(preprocessor.transform(X), y)
+    return preprocessor, model
+
+
+def fit_fold(task):
+    """Fit one candidate on one fold; returns its validation median absolute error."""
+    from sklearn.metrics import median_absolute_error
+    from sklearn.model_selection import KFold
+
+    city, dataset_date, data_dir, candidate, params, fold, cv, xgb_threads = task
+    _, X_train, _, y_train, _ = load_split(city, dataset_date, data_dir)
+    train_rows, valid_rows = list(KFold(n_splits=cv).split(X_train))[fold]
+    preprocessor, model = _fit(X_train.iloc[train_rows], y_train.iloc[train_rows], params, xgb_threads)
+    y_pred = model.predict(preprocessor.transform(X_train.iloc[valid_rows]))
+    return city, dataset_date, candidate, fold, median_absolute_error(y_train.iloc[valid_rows], y_pred)
+
+
+def refit(task):
+    """Fit the best candidate on the whole training set; returns it with its test set MAPE median."""
+    city, dataset_date, data_dir, params, xgb_threads = task
+    _, X_train, X_test, y_train, y_test = load_split(city, dataset_date, data_dir)
+    preprocessor, model = _fit(X_train, y_train, params, xgb_threads)
+    y_pred = model.predict(preprocessor.transform(X_test))
+    # As APP_MAPE_median in the notebook: median absolute percentage error as a fraction
+    MAPE_median = float(np.median(np.abs((y_test - y_pred) / y_test)))
+    return city, dataset_date, preprocessor, model, MAPE_median
+
+
+def _dump(value, path):
+    # Replace atomically so that the app never loads a half-written pickle
+    joblib.dump(value, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+def publish(city, dataset_date, preprocessor, model, MAPE_median, data_dir=DATA_DIR):
+    """Replace the snapshot's APP_*.pkl files, recompile its bundle and segment bands; returns the new version."""
+    data, _, X_test, _, _ = load_split(city, dataset_date, data_dir)
+    path = bundle_dir(city, dataset_date, data_dir)
+    _dump(data, f"{path}/APP_data_engineered.pkl")
+    _dump(preprocessor, f"{path}/APP_preprocessor.pkl")
+    _dump(X_test, f"{path}/APP_X_test.pkl")
+    _dump(MAPE_median, f"{path}/APP_MAPE_median.pkl")
+    _dump(sorted(set(data.zipcode)), f"{path}/APP_zipcode.pkl")
+    # The model goes last: the pickles' version stamp changes with it
+    _dump(model, f"{path}/APP_best_model.pkl")
+    _, version = compile_bundle(city, dataset_date, data_dir=data_dir)
+    # The segment bands are the new model's errors on the new test split
+    build_segments(city, dataset_date, data_dir)
+    return version
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--city", help="only this city")
+    parser.add_argument("--date", help="only this snapshot date (YYYY-MM-DD)")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--processes", type=int, help="worker processes (default: cores / xgb threads)")
+    parser.add_argument("--xgb-threads", type=int, default=1, help="xgboost threads per fit")
+    parser.add_argument("--n-iter", type=int, default=10, help="candidates of the randomized search")
+    parser.add_argument("--cv", type=int, default=5, help="cross validation folds")
+    parser.add_argument("--model-run", default=date.today().isoformat(),
+                        help="subfolder for the run's results (default: today)")
+    parser.add_argument("--no-publish", action="store_true", help="keep the app's APP_*.pkl and bundle as they are")
+    args = parser.parse_args(argv)
+    from sklearn.model_selection import ParameterSampler
+
+    snapshots = find_feature_snapshots(args.data_dir, args.city, args.date)
+    if not snapshots:
+        parser.error(f"no engineered features found in {args.data_dir}/<city>_<date>/")
+    processes = args.processes or max(1, (os.cpu_count() or 1) // args.xgb_threads)
+    candidates = list(ParameterSampler(PARAM_DISTRIBUTIONS, n_iter=args.n_iter, random_state=RANDOM_STATE))
+    print(f"{len(snapshots)} snapshots x {len(candidates)} candidates x {args.cv} folds on {processes} processes "
+          f"x {args.xgb_threads} xgboost threads")
+
+    start = time.perf_counter()
+    errors = {snapshot: np.zeros((len(candidates), args.cv)) for snapshot in snapshots}
+    remaining = {snapshot: len(candidates) * args.cv for snapshot in snapshots}
+    with ProcessPoolExecutor(processes) as pool:
+        # future -> True for the refit of a city, False for a cross validation fit
+        pending = {pool.submit(fit_fold, (city, dataset_date, args.data_dir, candidate, params, fold, args.cv,
+                                          args.xgb_threads)): False
+                   for city, dataset_date in snapshots
+                   for candidate, params in enumerate(candidates) for fold in range(args.cv)}
+        while pending:
+            future = next(as_completed(pending))
+            is_refit = pending.pop(future)
+            if not is_refit:
+                city, dataset_date, candidate, fold, error = future.result()
+                snapshot = (city, dataset_date)
+                errors[snapshot][candidate, fold] = error
+                remaining[snapshot] -= 1
+                if remaining[snapshot] == 0:
+                    # Search of this city done: refit its best candidate while other cities go on
+                    best = int(errors[snapshot].mean(axis=1).argmin())
+                    pending[pool.submit(refit, (city, dataset_date, args.data_dir, candidates[best],
+                                                args.xgb_threads))] = True
+                continue
+
+            city, dataset_date, preprocessor, model, MAPE_median = future.result()
+            snapshot = (city, dataset_date)
+            best = int(errors[snapshot].mean(axis=1).argmin())
+            run_dir = f"{bundle_dir(city, dataset_date, args.data_dir)}/{args.model_run}"
+            os.makedirs(run_dir, exist_ok=True)
+            joblib.dump(model, f"{run_dir}/best_model_xgb_reg.pkl")
+            joblib.dump(preprocessor, f"{run_dir}/preprocessor.pkl")
+            previous_path = f"{bundle_dir(city, dataset_date, args.data_dir)}/APP_MAPE_median.pkl"
+            previous = joblib.load(previous_path) if os.path.exists(previous_path) else None
+            report = {
+                'city': city, 'dataset_date': dataset_date, 'model_run': args.model_run,
+                'params': candidates[best], 'cv_median_absolute_error': float(errors[snapshot][best].mean()),
+                'MAPE_median': MAPE_median, 'previous_MAPE_median': previous,
+                'version': None if args.no_publish else publish(city, dataset_date, preprocessor, model,
+                                                                MAPE_median, args.data_dir),
+                'time_to_model': time.perf_counter() - start,
+            }
+            with open(f"{run_dir}/train_report.json", "w") as f:
+                json.dump(report, f, indent=1, default=int)
+            previous_text = f" (was {previous:.4f})" if previous is not None else ""
+            print(f"{city:<10} {dataset_date}: MAPE_median {MAPE_median:.4f}{previous_text}, "
+                  f"version {report['version'] or '-'}, time to model {report['time_to_model']:.1f}s")
+    print(f"Trained {len(snapshots)} snapshots in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
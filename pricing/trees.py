@@ -0,0 +1,136 @@
+"""Pure-numpy evaluation of a city's xgboost regressor for single rows and small batches.
+
+A single-row model.predict builds a DMatrix and goes through the sklearn wrapper, which costs
+far more than walking the trees. TreeEnsemble flattens the booster (from its JSON dump) into
+contiguous node arrays once and then walks all trees of all rows at the same time, one tree
+level per step. Comparisons are done in float32 like xgboost; NaN inputs follow each split's
+default ("missing") branch. Leaves are summed like xgboost does: in float32, one tree after the
+other, and the sum is then added to base_score, so results match model.predict.
+
+Enable it per city through NUMPY_TREE_CITIES (see 4_App.py) and check it against
+model.predict on each city's APP_X_test with
+
+    python -m pricing.trees
+"""
+import argparse
+import json
+
+import numpy as np
+from scipy import sparse as sp
+
+SUPPORTED_OBJECTIVES = ("reg:linear", "reg:squarederror")
+
+
+class TreeEnsemble:
+
+    def __init__(self, model):
+        objective = model.get_params().get('objective')
+        if objective not in SUPPORTED_OBJECTIVES:
+            raise ValueError(f"Unsupported objective {objective!r}")
+        booster = model.get_booster()
+        feature_index = {name: i for i, name in enumerate(booster.feature_names or [])}
+        dumps = booster.get_dump(dump_format='json')
+        ntree_limit = getattr(model, 'best_ntree_limit', 0) or len(dumps)
+
+        features, thresholds, left, right, missing, values, roots = [], [], [], [], [], [], []
+        depth = 0
+        for dump in dumps[:ntree_limit]:
+            # Node ids are only unique within a tree; map them to positions in the flat arrays
+            nodes = []
+            stack = [json.loads(dump)]
+            while stack:
+                node = stack.pop()
+                nodes.append(node)
+                stack.extend(node.get('children', []))
+            base = len(features)
+            position = {node['nodeid']: base + i for i, node in enumerate(nodes)}
+            roots.append(position[0])
+            for node in nodes:
+                pos = position[node['nodeid']]
+                if 'leaf' in node:
+                    # Leaves point to themselves, so walking past them is a no-op
+                    features.append(0)
+                    thresholds.append(0.0)
+                    left.append(pos)
+                    right.append(pos)
+                    missing.append(pos)
+                    values.append(node['leaf'])
+                else:
+                    split = node['split']
+                    features.append(feature_index[split] if split in feature_index else int(split.lstrip('f')))
+                    thresholds.append(node['split_condition'])
+                    left.append(position[node['yes']])
+                    right.append(position[node['no']])
+                    missing.append(position[node['missing']])
+                    values.append(0.0)
+                    depth = max(depth, node.get('depth', 0) + 1)
+
+        self.feature = np.asarray(features, dtype=np.intp)
+        self.threshold = np.asarray(thresholds, dtype=np.float32)
+        self.left = np.asarray(left, dtype=np.intp)
+        self.right = np.asarray(right, dtype=np.intp)
+        self.missing = np.asarray(missing, dtype=np.intp)
+        self.value = np.asarray(values, dtype=np.float32)
+        self.roots = np.asarray(roots, dtype=np.intp)
+        self.depth = depth
+        self.base_score = np.float32(model.get_params().get('base_score', 0.5))
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def predict(self, X):
+        """Predict rows of a dense array; for sparse matrices, entries not stored are missing."""
+        X = _dense(X)
+        rows = np.arange(X.shape[0])[:, None]
+        node = np.broadcast_to(self.roots, (X.shape[0], self.n_trees))
+        for _ in range(self.depth):
+            x = X[rows, self.feature[node]]
+            node = np.where(np.isnan(x), self.missing[node],
+                            np.where(x < self.threshold[node], self.left[node], self.right[node]))
+        # cumsum accumulates sequentially in tree order; sum() would add pairwise and round differently
+        return self.base_score + self.value[node].cumsum(axis=1, dtype=np.float32)[:, -1]
+
+
+def _dense(X):
+    if sp.issparse(X):
+        coo = X.tocoo()
+        dense = np.full(X.shape, np.nan, dtype=np.float32)
+        dense[coo.row, coo.col] = coo.data
+        return dense
+    return np.asarray(X, dtype=np.float32)
+
+
+def check_parity(model, X_prep):
+    """Largest absolute difference between TreeEnsemble and model.predict."""
+    expected = model.predict(X_prep)
+    actual = TreeEnsemble(model).predict(X_prep)
+    return float(np.abs(expected.astype(np.float64) - actual).max())
+
+
+def main(argv=None):
+    import joblib
+
+    from pricing.bundle import DATA_DIR, bundle_dir
+    from pricing.compile_bundles import find_snapshots
+
+    parser = argparse.ArgumentParser(description="Check TreeEnsemble against model.predict on X_test")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--atol", type=float, default=1e-5)
+    args = parser.parse_args(argv)
+
+    failed = False
+    for city, dataset_date in find_snapshots(args.data_dir):
+        path = bundle_dir(city, dataset_date, args.data_dir)
+        preprocessor = joblib.load(f"{path}/APP_preprocessor.pkl")
+        X_prep = preprocessor.transform(joblib.load(f"{path}/APP_X_test.pkl"))
+        diff = check_parity(joblib.load(f"{path}/APP_best_model.pkl"), X_prep)
+        ok = diff <= args.atol
+        failed |= not ok
+        print(f"{city:<10} {dataset_date}: max abs diff {diff:.3g} {'OK' if ok else 'MISMATCH'}")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
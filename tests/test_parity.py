@@ -0,0 +1,53 @@
+"""The numpy FeatureEncoder and TreeEnsemble against the fitted preprocessor and model of each snapshot.
+
+Snapshots whose pickles do not load with the installed scikit-learn/xgboost are skipped.
+
+    python -m pytest tests
+"""
+import os
+
+import numpy as np
+import pytest
+from scipy import sparse as sp
+
+joblib = pytest.importorskip("joblib")
+
+from pricing.compile_bundles import find_snapshots  # noqa: E402
+from pricing.encoder import FeatureEncoder, check_parity  # noqa: E402
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+SNAPSHOTS = find_snapshots(DATA_DIR)
+
+
+def _load(city, dataset_date, name):
+    path = os.path.join(DATA_DIR, f"{city}_{dataset_date}", name)
+    try:
+        return joblib.load(path)
+    except Exception as exc:
+        pytest.skip(f"{name} does not load here: {exc!r}")
+
+
+@pytest.mark.parametrize("city, dataset_date", SNAPSHOTS)
+def test_encoder_matches_preprocessor(city, dataset_date):
+    preprocessor = _load(city, dataset_date, "APP_preprocessor.pkl")
+    X_test = _load(city, dataset_date, "APP_X_test.pkl")
+    try:
+        preprocessor.transform(X_test.head())
+    except Exception as exc:
+        pytest.skip(f"preprocessor.transform fails with this scikit-learn: {exc!r}")
+    assert check_parity(preprocessor, X_test) <= 1e-12
+
+
+@pytest.mark.parametrize("city, dataset_date", SNAPSHOTS)
+def test_trees_match_model(city, dataset_date):
+    pytest.importorskip("xgboost")
+    from pricing.trees import TreeEnsemble
+
+    model = _load(city, dataset_date, "APP_best_model.pkl")
+    # The encoder's output is the model's input either way; it keeps the test independent of
+    # whether this scikit-learn can run the pickled preprocessor
+    X_prep = FeatureEncoder(_load(city, dataset_date, "APP_preprocessor.pkl")).transform(
+        _load(city, dataset_date, "APP_X_test.pkl"))
+    expected = model.predict(X_prep)
+    actual = TreeEnsemble(model).predict(X_prep.tocsr() if sp.issparse(X_prep) else X_prep)
+    np.testing.assert_array_equal(actual, expected)